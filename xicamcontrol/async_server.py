@@ -0,0 +1,307 @@
+# async_server.py
+
+import os, asyncio
+from aiohttp import web
+import logger_tools
+import stream_tools
+import metrics
+
+logger = logger_tools.get_logger(__name__)
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class FrameHub:
+    """
+    Hand the frames of a FrameEncoder to asyncio tasks.
+    All stream handlers wait on one future per frame, so a new frame costs one
+    wake-up per viewer and no thread per viewer. The multipart part is built once
+    and the same bytes object is written to every viewer.
+    """
+
+    def __init__(self, encoder, loop):
+        self.loop = loop
+        self.encoder = encoder
+        self.latest = (0, None)
+        # (seq, jpeg bytes, metadata, encode ms) of the latest frame for WebSocket viewers
+        self.frame = (0, None, None, 0.0)
+        self.message = (0, None)
+        self.future = loop.create_future()
+        encoder.add_listener(self.on_frame)
+        # viewers using this hub
+        self.users = 0
+
+    def close(self):
+        self.encoder.remove_listener(self.on_frame)
+
+    def on_frame(self, seq, frame):
+        # called from the encoder thread, right after it published frame seq
+        metadata, encode_ms = self.encoder.frame_info(seq)
+        self.loop.call_soon_threadsafe(self._resolve, seq, frame, metadata, encode_ms)
+
+    def _resolve(self, seq, frame, metadata, encode_ms):
+        self.latest = (seq, stream_tools.mjpeg_part(frame))
+        self.frame = (seq, frame, metadata, encode_ms)
+        future, self.future = self.future, self.loop.create_future()
+        future.set_result(self.latest)
+
+    def ws_message(self, seq, frame=None):
+        """
+        WebSocket message of the latest frame, built once and shared by all viewers.
+        frame: jpeg bytes replacing the broadcast frame (a lower quality variant)
+        """
+        seq_, jpeg, metadata, encode_ms = self.frame
+        if frame is not None:
+            return stream_tools.ws_frame(seq, frame, metadata if seq == seq_ else None, encode_ms)
+        if self.message[0] != seq_:
+            self.message = (seq_, stream_tools.ws_frame(seq_, jpeg, metadata, encode_ms))
+        return self.message
+
+    async def next_part(self, last_seq, timeout=1.0):
+        """
+        The newest frame after last_seq, frames published while the caller was busy are skipped.
+        returns: (seq, multipart part) or (last_seq, None) on timeout
+        """
+        if self.latest[0] > last_seq:
+            return self.latest
+        try:
+            return await asyncio.wait_for(asyncio.shield(self.future), timeout)
+        except asyncio.TimeoutError:
+            return last_seq, None
+
+
+# frames sent to a WebSocket viewer without an ack yet
+MAX_UNACKED = 2
+
+
+def client_name(request):
+    """host:port of the viewer, for the per viewer metrics"""
+    peer = request.transport.get_extra_info("peername") if request.transport is not None else None
+    return f"{peer[0]}:{peer[1]}" if peer else str(request.remote)
+
+
+def create_app(camera, broadcaster, still_pool=None, adaptive=True, stats_hz=4):
+    """
+    aiohttp application with the routes of cam_server, sharing its camera and broadcaster.
+    still_pool: executor encoding full resolution stills (default: the loop's executor)
+    adaptive: lower quality and resolution for viewers that fall behind
+    stats_hz: rate of the /stats events
+    """
+    app = web.Application()
+    routes = web.RouteTableDef()
+    # FrameEncoder -> FrameHub, one per (width, quality) in use
+    hubs = {}
+
+    def acquire_hub(query):
+        """The hub of the encoder for the width and quality query parameters. raises: ValueError"""
+        encoder = broadcaster.acquire(query.get("width"), query.get("quality"))
+        if encoder not in hubs:
+            hubs[encoder] = FrameHub(encoder, asyncio.get_running_loop())
+        hub = hubs[encoder]
+        hub.users += 1
+        return hub
+
+    def release_hub(hub):
+        hub.users -= 1
+        if hub.users == 0 and hub.encoder is not broadcaster:
+            hub.close()
+            del hubs[hub.encoder]
+        # stopping the last viewer's encoder joins its thread and pool, keep that off the event loop
+        asyncio.get_running_loop().run_in_executor(None, broadcaster.release, hub.encoder)
+
+    @routes.get("/")
+    async def index(request):
+        return web.FileResponse(os.path.join(BASE_DIR, "templates", "index.html"))
+
+    @routes.get("/start_capture")
+    async def start_capture(request):
+        logger.debug(f"start_capture called with args: {dict(request.query)}")
+        loop = asyncio.get_running_loop()
+        try:
+            # opening the camera blocks, keep the event loop serving the streams
+            success = await loop.run_in_executor(None, camera.start_capture_from_query, request.query)
+        except ValueError as e:
+            logger.warning(str(e))
+            success = False
+        return web.Response(text="Capture started." if success else "Capture start failed.")
+
+    @routes.get("/stop_capture")
+    async def stop_capture(request):
+        logger.debug("stop_capture called")
+        success = await asyncio.get_running_loop().run_in_executor(None, camera.stop_capture)
+        return web.Response(text="Capture stopped." if success else "Capture stop failed.")
+
+    @routes.get("/trigger")
+    async def trigger(request):
+        logger.debug("trigger called")
+        folder = camera.trigger_event("http")
+        return web.Response(text="Trigger accepted." if folder is not None else "Trigger failed.")
+
+    @routes.get("/snapshot.jpg")
+    async def snapshot(request):
+        status, headers, body = stream_tools.snapshot(broadcaster, request.headers.get("If-None-Match"))
+        return web.Response(body=body, status=status, headers=headers)
+
+    @routes.get("/still")
+    async def still(request):
+        image = camera.latest_frame()
+        status, headers, body = await asyncio.get_running_loop().run_in_executor(
+            still_pool, stream_tools.still, image, request.query.get("format", "png")
+        )
+        return web.Response(body=body, status=status, headers=headers)
+
+    @routes.get("/params")
+    async def get_params(request):
+        try:
+            values = await asyncio.get_running_loop().run_in_executor(None, camera.get_params)
+        except RuntimeError as e:
+            return web.Response(text=str(e), status=409)
+        return web.json_response(values)
+
+    @routes.post("/params")
+    async def set_params(request):
+        if request.content_type == "application/json":
+            changes = await request.json()
+        else:
+            changes = dict(await request.post())
+        wait = request.query.get("wait", "true").lower() != "false"
+        try:
+            # camera calls block, and waiting for the frames even more
+            report = await asyncio.get_running_loop().run_in_executor(None, camera.set_params, changes, wait)
+        except ValueError as e:
+            return web.Response(text=str(e), status=400)
+        except RuntimeError as e:
+            return web.Response(text=str(e), status=409)
+        return web.json_response(report)
+
+    @routes.get("/params/changes")
+    async def param_changes(request):
+        return web.json_response(camera.cam.params.changes())
+
+    @routes.get("/stats")
+    async def stats(request):
+        response = web.StreamResponse(headers=dict(stream_tools.SSE_HEADERS, **{"Content-Type": "text/event-stream"}))
+        await response.prepare(request)
+        try:
+            while True:
+                await response.write(stream_tools.sse_event(stream_tools.live_stats(camera)))
+                await asyncio.sleep(1.0 / stats_hz)
+        except ConnectionResetError:
+            logger.debug("stats client disconnected")
+        return response
+
+    @routes.get("/metrics")
+    async def metrics_endpoint(request):
+        return web.Response(
+            text=metrics.REGISTRY.render(), headers={"Content-Type": metrics.CONTENT_TYPE}
+        )
+
+    @routes.get("/image_stream")
+    async def image_stream(request):
+        logger.debug(f"image_stream called with args: {dict(request.query)}")
+        try:
+            hub = acquire_hub(request.query)
+        except ValueError as e:
+            return web.Response(text=str(e), status=400)
+        response = web.StreamResponse(
+            headers=dict(stream_tools.MJPEG_HEADERS, **{"Content-Type": stream_tools.MJPEG_MIMETYPE})
+        )
+        pacer = stream_tools.ViewerPacer(adaptive, client=client_name(request))
+        try:
+            # inside the try, a viewer gone before the headers are sent still releases the hub
+            await response.prepare(request)
+            await response.write(stream_tools.mjpeg_start())
+            sock = request.transport.get_extra_info("socket")
+            loop = asyncio.get_running_loop()
+            seq = 0
+            while camera.capture_started:
+                seq, part = await hub.next_part(seq)
+                if part is None or not pacer.ready(sock):
+                    # this viewer is still busy with earlier frames, wait for a newer one
+                    continue
+                scale, quality = pacer.update(seq)
+                if pacer.level > 0:
+                    seq, frame = await loop.run_in_executor(None, hub.encoder.variant, seq, scale, quality)
+                    part = stream_tools.mjpeg_part(frame)
+                pacer.sent_part(len(part))
+                # waits while the transport buffer of this viewer is full, other viewers go on
+                await response.write(part)
+        except ConnectionResetError:
+            logger.debug("image_stream client disconnected")
+        finally:
+            pacer.close()
+            release_hub(hub)
+        return response
+
+    @routes.get("/ws_stream")
+    async def ws_stream(request):
+        """
+        Binary frames (stream_tools.WS_HEADER + jpeg) over a WebSocket. The viewer acks the
+        frames it showed with their seq as text, at most MAX_UNACKED frames are in flight and the viewer
+        always gets the newest frame once it has room again.
+        """
+        logger.debug(f"ws_stream called with args: {dict(request.query)}")
+        try:
+            hub = acquire_hub(request.query)
+        except ValueError as e:
+            return web.Response(text=str(e), status=400)
+        ws = web.WebSocketResponse(heartbeat=10)
+        unacked = set()
+        acked = asyncio.Event()
+        pacer = stream_tools.ViewerPacer(adaptive, client=client_name(request))
+        sender = None
+
+        async def send_frames():
+            loop = asyncio.get_running_loop()
+            seq = 0
+            while camera.capture_started and not ws.closed:
+                if len(unacked) >= MAX_UNACKED:
+                    acked.clear()
+                    try:
+                        await asyncio.wait_for(acked.wait(), 1.0)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                seq, part = await hub.next_part(seq)
+                if part is None:
+                    continue
+                scale, quality = pacer.update(seq)
+                if pacer.level > 0:
+                    seq, frame = await loop.run_in_executor(None, hub.encoder.variant, seq, scale, quality)
+                    message = hub.ws_message(seq, frame)
+                else:
+                    seq, message = hub.ws_message(seq)
+                unacked.add(seq)
+                pacer.sent_part(len(message))
+                try:
+                    await ws.send_bytes(message)
+                except ConnectionResetError:
+                    logger.debug("ws_stream client disconnected")
+                    return
+            await ws.close()
+
+        try:
+            await ws.prepare(request)
+            sender = asyncio.create_task(send_frames())
+            async for msg in ws:
+                if msg.type == web.WSMsgType.TEXT and msg.data.isdigit():
+                    # acks are cumulative, the viewer may drop a frame when the next one arrives first
+                    ack = int(msg.data)
+                    unacked.difference_update([s for s in unacked if s <= ack])
+                    acked.set()
+        except ConnectionResetError:
+            logger.debug("ws_stream client disconnected")
+        finally:
+            if sender is not None:
+                sender.cancel()
+            pacer.close()
+            release_hub(hub)
+        return ws
+
+    app.add_routes(routes)
+    app.router.add_static("/static", os.path.join(BASE_DIR, "static"))
+    return app
+
+
+def run(camera, broadcaster, still_pool=None, host="0.0.0.0", port=5000, adaptive=True, stats_hz=4):
+    web.run_app(create_app(camera, broadcaster, still_pool, adaptive, stats_hz), host=host, port=port)
@@ -0,0 +1,582 @@
+# benchmark.py
+
+import argparse, os, time, glob, tempfile, asyncio, urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import cv2
+import logger_tools
+import save_tools
+import video_sink
+import hdf5_sink
+import raw_sink
+import metadata_export
+import change_gate
+import stream_tools
+import jpeg_tools
+import opencv_tools
+
+logger = logger_tools.get_logger(__name__)
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".tif", ".tiff", ".bmp", ".npy")
+
+
+def synthetic_frames(width, height, count=10, channels=3):
+    """
+    Generate frames with smooth gradients and sensor-like noise.
+    Pure noise would be the worst case for every compressing codec,
+    a flat frame the best case, this is closer to a real scene.
+    """
+    rng = np.random.default_rng(0)
+    x = np.linspace(0, 200, width, dtype=np.float32)[None, :]
+    y = np.linspace(0, 50, height, dtype=np.float32)[:, None]
+    base = (x + y)[..., None]
+
+    frames = []
+    for i in range(count):
+        noise = rng.normal(0, 4, (height, width, channels)).astype(np.float32)
+        frame = np.clip(base + noise + i, 0, 255).astype(np.uint8)
+        frames.append(frame)
+
+    return frames
+
+
+def load_frames(path, count=10):
+    """Load up to count recorded frames from a session folder."""
+    files = sorted(
+        f
+        for f in glob.glob(os.path.join(path, "**", "*"), recursive=True)
+        if f.lower().endswith(IMAGE_EXTENSIONS)
+    )[:count]
+
+    frames = []
+    for f in files:
+        if f.lower().endswith(".npy"):
+            frames.append(np.load(f))
+        else:
+            frames.append(cv2.imread(f, cv2.IMREAD_UNCHANGED))
+
+    return frames
+
+
+def benchmark_codec(codec, frames, out_dir, repeat=3):
+    """
+    Encode and write all frames repeat times.
+    returns: dict with encode ms/frame, write ms/frame, MB/frame and max sustained fps
+    """
+    encode_time = 0.0
+    write_time = 0.0
+    total_bytes = 0
+    n = 0
+
+    for r in range(repeat):
+        for i, frame in enumerate(frames):
+            t0 = time.perf_counter()
+            buffer = codec.encode(frame)
+            t1 = time.perf_counter()
+            filepath = os.path.join(out_dir, f"bench_{i:06d}{codec.extension}")
+            with open(filepath, "wb") as f:
+                f.write(buffer)
+            t2 = time.perf_counter()
+
+            encode_time += t1 - t0
+            write_time += t2 - t1
+            total_bytes += len(buffer)
+            n += 1
+
+    encode_ms = encode_time / n * 1000
+    write_ms = write_time / n * 1000
+
+    return {
+        "codec": repr(codec),
+        "encode_ms": encode_ms,
+        "write_ms": write_ms,
+        "mb_per_frame": total_bytes / n / 1e6,
+        "max_fps": 1000 / (encode_ms + write_ms),
+    }
+
+
+def benchmark_codecs(frames, out_dir, png_levels=(1, 3, 6), jpeg_qualities=(90, 95), repeat=3):
+    codecs = [save_tools.PngCodec(level) for level in png_levels]
+    codecs += [save_tools.JpegCodec(quality) for quality in jpeg_qualities]
+    codecs += [save_tools.TiffCodec(), save_tools.BmpCodec(), save_tools.NpyCodec()]
+
+    results = []
+    with tempfile.TemporaryDirectory(dir=out_dir) as tmp_dir:
+        for codec in codecs:
+            results.append(benchmark_codec(codec, frames, tmp_dir, repeat))
+
+    return results
+
+
+def print_results(title, results):
+    print(f"\n{title}")
+    print(f"{'codec':<28}{'encode ms':>12}{'write ms':>12}{'MB/frame':>12}{'max fps':>10}")
+    for r in results:
+        print(
+            f"{r['codec']:<28}{r['encode_ms']:>12.2f}{r['write_ms']:>12.2f}"
+            f"{r['mb_per_frame']:>12.2f}{r['max_fps']:>10.1f}"
+        )
+
+
+class BenchMetadata:
+    """Stand-in for ximea_camera.Metadata, so benchmarks run without the camera API."""
+
+    def __init__(self, frame_id):
+        self.frame_id = frame_id
+        self.timestamp = frame_id / 30
+        self.host_timestamp = time.time()
+        self.gain = 0.0
+        self.exposure = 10000.0
+        self.width = 0
+        self.height = 0
+        self.gpi_level = 0
+
+
+class BenchImage:
+    """Stand-in for ximea_camera.Image."""
+
+    def __init__(self, data, frame_id):
+        self.data = data
+        self.metadata = BenchMetadata(frame_id)
+
+
+def folder_size(path):
+    total = 0
+    for root, dirs, files in os.walk(path):
+        total += sum(os.path.getsize(os.path.join(root, f)) for f in files)
+    return total
+
+
+def benchmark_sink(make_sink, frames, out_dir, repeat=3):
+    """
+    Write all frames repeat times through a sink created by make_sink(folder).
+    Measures the sink itself, not the SinkThread queue in front of it.
+    returns: dict with ms/frame, MB/frame on disk and max sustained fps
+    """
+    with tempfile.TemporaryDirectory(dir=out_dir) as tmp_dir:
+        sink = make_sink(tmp_dir)
+        n = 0
+        t0 = time.perf_counter()
+        for r in range(repeat):
+            for frame in frames:
+                sink.write(BenchImage(frame, n))
+                n += 1
+        sink.close()
+        elapsed = time.perf_counter() - t0
+        size = folder_size(tmp_dir)
+
+    return {
+        "sink": sink.__class__.__name__,
+        "ms_per_frame": elapsed / n * 1000,
+        "mb_per_frame": size / n / 1e6,
+        "max_fps": n / elapsed,
+    }
+
+
+def run_codecs(args):
+    os.makedirs(args.out, exist_ok=True)
+    png_levels = [int(v) for v in args.png_levels.split(",")]
+    jpeg_qualities = [int(v) for v in args.jpeg_qualities.split(",")]
+
+    frames = synthetic_frames(args.width, args.height, args.count)
+    results = benchmark_codecs(frames, args.out, png_levels, jpeg_qualities, args.repeat)
+    print_results(f"Synthetic frames {args.width}x{args.height}", results)
+
+    if args.frames is not None:
+        frames = load_frames(args.frames, args.count)
+        if len(frames) == 0:
+            logger.warning(f"No recorded frames found in {args.frames}")
+        else:
+            h, w = frames[0].shape[:2]
+            results = benchmark_codecs(frames, args.out, png_levels, jpeg_qualities, args.repeat)
+            print_results(f"Recorded frames {w}x{h} from {args.frames}", results)
+
+
+def run_sinks(args):
+    os.makedirs(args.out, exist_ok=True)
+
+    if args.frames is not None:
+        frames = load_frames(args.frames, args.count)
+    else:
+        frames = synthetic_frames(args.width, args.height, args.count)
+
+    sinks = {
+        f"images png {args.png_level}": lambda d: save_tools.ImageFileSink(
+            d, save_tools.PngCodec(args.png_level)
+        ),
+        f"hdf5 deflate {args.hdf5_level}": lambda d: hdf5_sink.HDF5Sink(
+            d,
+            chunk_frames=args.chunk_frames,
+            compression=args.hdf5_level,
+            workers=args.workers,
+        ),
+        "video auto": lambda d: video_sink.VideoSink(d),
+    }
+
+    h, w = frames[0].shape[:2]
+    print(f"\nSinks with {len(frames) * args.repeat} frames {w}x{h}")
+    print(f"{'sink':<24}{'ms/frame':>12}{'MB/frame':>12}{'max fps':>10}")
+    for name, make_sink in sinks.items():
+        r = benchmark_sink(make_sink, frames, args.out, args.repeat)
+        print(f"{name:<24}{r['ms_per_frame']:>12.2f}{r['mb_per_frame']:>12.2f}{r['max_fps']:>10.1f}")
+
+
+def page_cache_mb():
+    """Size of the page cache from /proc/meminfo (Linux only), None elsewhere."""
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("Cached:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        return None
+
+
+def run_rawio(args):
+    os.makedirs(args.out, exist_ok=True)
+    frames = synthetic_frames(args.width, args.height, 4)
+    frame_mb = frames[0].nbytes / 1e6
+
+    print(f"\nRaw writes, {args.count} frames of {frame_mb:.1f} MB, fsync {args.fsync}")
+    print(f"{'writer':<12}{'GB/s':>10}{'ms/frame':>12}{'page cache MB':>16}")
+    for direct in (False, True):
+        with tempfile.TemporaryDirectory(dir=args.out) as tmp_dir:
+            sink = raw_sink.RawSink(
+                tmp_dir,
+                direct=direct,
+                fsync=args.fsync,
+                fsync_frames=args.fsync_frames,
+                fsync_seconds=args.fsync_seconds,
+            )
+            cache_before = page_cache_mb()
+            t0 = time.perf_counter()
+            for i in range(args.count):
+                sink.write(BenchImage(frames[i % len(frames)], i))
+            sink.close()
+            elapsed = time.perf_counter() - t0
+            # before the folder is removed, which drops its cached pages
+            cache_after = page_cache_mb()
+
+        name = "O_DIRECT" if sink.data_file.direct else "buffered"
+        cache = "n/a" if cache_before is None else f"{cache_after - cache_before:.0f}"
+        print(
+            f"{name:<12}{args.count * frame_mb / 1000 / elapsed:>10.2f}"
+            f"{elapsed / args.count * 1000:>12.2f}{cache:>16}"
+        )
+
+
+def run_metadata(args):
+    os.makedirs(args.out, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=args.out) as tmp_dir:
+        recorder = metadata_export.MetadataRecorder(tmp_dir, batch_size=args.batch)
+        metadata = BenchMetadata(0)
+
+        t0 = time.perf_counter()
+        for i in range(args.count):
+            metadata.frame_id = i
+            recorder.add(metadata)
+        t1 = time.perf_counter()
+        recorder.close()
+        t2 = time.perf_counter()
+        columns = metadata_export.load_metadata(tmp_dir)
+        t3 = time.perf_counter()
+
+    print(f"\nMetadata of {args.count} frames")
+    print(f"add: {(t1 - t0) / args.count * 1e6:.2f} us/frame")
+    print(f"close (merge, npz, parquet): {t2 - t1:.2f} s")
+    print(f"load {len(columns['frame_id'])} rows: {(t3 - t2) * 1000:.1f} ms")
+
+
+def run_gate(args):
+    rng = np.random.default_rng(0)
+    shape = (args.height, args.width, 3) if args.color else (args.height, args.width)
+    base = rng.integers(0, 256, shape, dtype=np.uint8)
+    # half the frames are the base frame with sensor noise, half have a moving bright square
+    frames = []
+    for i in range(8):
+        frame = np.clip(base + rng.normal(0, 2, shape), 0, 255).astype(np.uint8)
+        if i % 2:
+            x = i * args.width // 10
+            frame[args.height // 3 : args.height // 3 + 80, x : x + 80] = 255
+        frames.append(frame)
+
+    print(f"\nChange gate, {args.count} frames of {args.width}x{args.height}{' color' if args.color else ''}")
+    print(f"{'metric':<8}{'ms/frame':>10}{'saved':>8}")
+    for metric in change_gate.METRICS:
+        gate = change_gate.ChangeGate(args.threshold, metric, keepalive_seconds=0, size=args.size)
+        t0 = time.perf_counter()
+        for i in range(args.count):
+            gate.check(frames[i % len(frames)])
+        elapsed = time.perf_counter() - t0
+        print(f"{metric:<8}{elapsed / args.count * 1000:>10.3f}{gate.passed:>8}")
+
+
+def run_jpeg(args):
+    frames = synthetic_frames(args.width, args.height, 8, 1 if args.mono else 3)
+    widths = sorted({int(w) for w in args.widths.split(",")} | {args.width})
+    backends = [jpeg_tools.get_backend(name) for name in jpeg_tools.available_backends()]
+
+    print(f"\nJPEG encoding, quality {args.quality}, frames of {args.width}x{args.height}{' mono' if args.mono else ''}")
+    print(f"{'backend':<12}{'width':>8}{'ms/frame':>10}{'kB/frame':>10}{f'fps ({args.workers} thr)':>16}")
+    for width in widths:
+        scaled = [opencv_tools.resize_with_aspect_ratio(f, width) if width != args.width else f for f in frames]
+        for backend in backends:
+            nbytes = 0
+            t0 = time.perf_counter()
+            for i in range(args.count):
+                nbytes += len(backend.encode(scaled[i % len(scaled)], args.quality))
+            elapsed = time.perf_counter() - t0
+
+            # consecutive frames in parallel, as with STREAM: ENCODE_WORKERS
+            with ThreadPoolExecutor(max_workers=args.workers) as pool:
+                t1 = time.perf_counter()
+                list(pool.map(lambda i: backend.encode(scaled[i % len(scaled)], args.quality), range(args.count)))
+                parallel = time.perf_counter() - t1
+
+            print(
+                f"{backend.name:<12}{width:>8}{elapsed / args.count * 1000:>10.2f}"
+                f"{nbytes / args.count / 1000:>10.1f}{args.count / parallel:>16.1f}"
+            )
+
+
+async def read_stream(url, seconds, max_kbs=None, boundary=b"--frame\r\n"):
+    """
+    Read an MJPEG stream for seconds, at most at max_kbs kB/s to simulate a slow link.
+    returns: dict with parts/s, distinct frames/s, MB/s (repeated parts are not distinct) and mean part size
+    """
+    target = urllib.parse.urlsplit(url)
+    reader, writer = await asyncio.open_connection(target.hostname, target.port or 80)
+    path = target.path + ("?" + target.query if target.query else "")
+    writer.write(f"GET {path} HTTP/1.1\r\nHost: {target.netloc}\r\n\r\n".encode())
+    await writer.drain()
+
+    parts = 0
+    distinct = 0
+    nbytes = 0
+    previous = None
+    pending = b""
+    loop = asyncio.get_running_loop()
+    t0 = loop.time()
+    while loop.time() - t0 < seconds:
+        try:
+            data = await asyncio.wait_for(reader.read(4096 if max_kbs else 65536), seconds - (loop.time() - t0))
+        except asyncio.TimeoutError:
+            break
+        if not data:
+            break
+        nbytes += len(data)
+        pending += data
+        if max_kbs:
+            await asyncio.sleep(len(data) / (max_kbs * 1000))
+        chunks = pending.split(boundary)
+        pending = chunks.pop()
+        for part in chunks:
+            if not part:
+                continue
+            parts += 1
+            if part != previous:
+                distinct += 1
+            previous = part
+    elapsed = loop.time() - t0
+    writer.close()
+    return {
+        "fps": parts / elapsed,
+        "distinct_fps": distinct / elapsed,
+        "mbs": nbytes / elapsed / 1e6,
+        "kb_per_part": nbytes / max(parts, 1) / 1000,
+    }
+
+
+async def read_ws(url, seconds, max_kbs=None):
+    """
+    Read the WebSocket stream (/ws_stream) for seconds and ack every frame, like the web page.
+    max_kbs: delay each ack as if the frame came over a link of this bandwidth
+    returns: same as read_stream, kB/part includes the header
+    """
+    import aiohttp
+
+    parts = 0
+    nbytes = 0
+    loop = asyncio.get_running_loop()
+    async with aiohttp.ClientSession() as session:
+        async with session.ws_connect(url) as ws:
+            t0 = loop.time()
+            while loop.time() - t0 < seconds:
+                try:
+                    msg = await ws.receive(timeout=seconds - (loop.time() - t0))
+                except asyncio.TimeoutError:
+                    break
+                if msg.type != aiohttp.WSMsgType.BINARY:
+                    break
+                parts += 1
+                nbytes += len(msg.data)
+                if max_kbs:
+                    await asyncio.sleep(len(msg.data) / (max_kbs * 1000))
+                await ws.send_str(str(stream_tools.WS_HEADER.unpack_from(msg.data)[1]))
+            elapsed = loop.time() - t0
+    # every message is a new frame
+    return {
+        "fps": parts / elapsed,
+        "distinct_fps": parts / elapsed,
+        "mbs": nbytes / elapsed / 1e6,
+        "kb_per_part": nbytes / max(parts, 1) / 1000,
+    }
+
+
+def process_cpu_seconds(pid):
+    """User + system CPU time of a process, from /proc (Linux only)."""
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+async def stream_clients(url, clients, seconds, slow=0, slow_kbs=None):
+    read = read_ws if url.startswith("ws") else read_stream
+    readers = [read(url, seconds) for i in range(clients)]
+    readers += [read(url, seconds, slow_kbs) for i in range(slow)]
+    results = await asyncio.gather(*readers, return_exceptions=True)
+    for r in results:
+        if isinstance(r, Exception):
+            logger.warning(f"Client failed: {r!r}")
+    results = [None if isinstance(r, Exception) else r for r in results]
+    return results[:clients], results[clients:]
+
+
+def print_viewers(title, results):
+    ok = [r for r in results if r is not None]
+    print(f"{title}: {len(ok)}/{len(results)} connected")
+    print(f"{'per viewer':<12}{'parts/s':>10}{'frames/s':>10}{'MB/s':>10}{'kB/part':>10}")
+    for name, reduce in (("mean", np.mean), ("min", np.min)):
+        if ok:
+            print(
+                f"{name:<12}{reduce([r['fps'] for r in ok]):>10.1f}"
+                f"{reduce([r['distinct_fps'] for r in ok]):>10.1f}{reduce([r['mbs'] for r in ok]):>10.2f}"
+                f"{reduce([r['kb_per_part'] for r in ok]):>10.1f}"
+            )
+    if ok:
+        print(f"total {sum(r['mbs'] for r in ok):.1f} MB/s")
+
+
+def run_stream(args):
+    cpu_before = process_cpu_seconds(args.pid) if args.pid else None
+    t0 = time.perf_counter()
+    fast, slow = asyncio.run(stream_clients(args.url, args.clients, args.seconds, args.slow, args.slow_kbs))
+    elapsed = time.perf_counter() - t0
+
+    print(f"\nStream {args.url} for {args.seconds} s")
+    print_viewers("viewers", fast)
+    if slow:
+        print_viewers(f"slow viewers ({args.slow_kbs} kB/s)", slow)
+    if cpu_before is not None:
+        cpu = (process_cpu_seconds(args.pid) - cpu_before) / elapsed * 100
+        print(f"server CPU {cpu:.0f} % of one core")
+
+
+###############################################
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmarks for the capture, save and streaming pipeline",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    codecs_parser = subparsers.add_parser(
+        "codecs",
+        help="Encode speed and size of the save codecs",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    codecs_parser.add_argument("--width", type=int, default=2048)
+    codecs_parser.add_argument("--height", type=int, default=1536)
+    codecs_parser.add_argument("--count", help="Number of frames", type=int, default=10)
+    codecs_parser.add_argument("--repeat", type=int, default=3)
+    codecs_parser.add_argument("--frames", help="Folder with recorded frames to benchmark")
+    codecs_parser.add_argument("--out", help="Folder to write to (use the target disk)", default="data")
+    codecs_parser.add_argument("--png-levels", default="1,3,6")
+    codecs_parser.add_argument("--jpeg-qualities", default="90,95")
+    codecs_parser.set_defaults(func=run_codecs)
+
+    sinks_parser = subparsers.add_parser(
+        "sinks",
+        help="Throughput of the recording sinks (png files, hdf5, video)",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    sinks_parser.add_argument("--width", type=int, default=2048)
+    sinks_parser.add_argument("--height", type=int, default=1536)
+    sinks_parser.add_argument("--count", help="Number of frames", type=int, default=16)
+    sinks_parser.add_argument("--repeat", type=int, default=4)
+    sinks_parser.add_argument("--frames", help="Folder with recorded frames to benchmark")
+    sinks_parser.add_argument("--out", help="Folder to write to (use the target disk)", default="data")
+    sinks_parser.add_argument("--png-level", type=int, default=1)
+    sinks_parser.add_argument("--hdf5-level", type=int, default=4)
+    sinks_parser.add_argument("--chunk-frames", type=int, default=8)
+    sinks_parser.add_argument("--workers", type=int, default=4)
+    sinks_parser.set_defaults(func=run_sinks)
+
+    rawio_parser = subparsers.add_parser(
+        "rawio",
+        help="Buffered vs O_DIRECT raw writes: throughput and page cache growth",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    rawio_parser.add_argument("--width", type=int, default=2048)
+    rawio_parser.add_argument("--height", type=int, default=1536)
+    rawio_parser.add_argument("--count", help="Number of frames", type=int, default=200)
+    rawio_parser.add_argument("--out", help="Folder to write to (use the target disk)", default="data")
+    rawio_parser.add_argument("--fsync", choices=raw_sink.FSYNC_POLICIES, default="none")
+    rawio_parser.add_argument("--fsync-frames", type=int, default=100)
+    rawio_parser.add_argument("--fsync-seconds", type=float, default=1.0)
+    rawio_parser.set_defaults(func=run_rawio)
+
+    metadata_parser = subparsers.add_parser(
+        "metadata",
+        help="Cost of recording and loading per-frame metadata",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    metadata_parser.add_argument("--count", help="Number of frames", type=int, default=1000000)
+    metadata_parser.add_argument("--batch", type=int, default=10000)
+    metadata_parser.add_argument("--out", help="Folder to write to", default="data")
+    metadata_parser.set_defaults(func=run_metadata)
+
+    gate_parser = subparsers.add_parser(
+        "gate",
+        help="Cost of the change gate per frame",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    gate_parser.add_argument("--width", type=int, default=2048)
+    gate_parser.add_argument("--height", type=int, default=1536)
+    gate_parser.add_argument("--color", action="store_true")
+    gate_parser.add_argument("--count", help="Number of frames", type=int, default=1000)
+    gate_parser.add_argument("--threshold", type=float, default=2.0)
+    gate_parser.add_argument("--size", type=int, default=64)
+    gate_parser.set_defaults(func=run_gate)
+
+    jpeg_parser = subparsers.add_parser(
+        "jpeg",
+        help="Preview JPEG encoding per backend (cv2, pil, turbojpeg, if installed)",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    jpeg_parser.add_argument("--width", type=int, default=2048, help="Camera frame width")
+    jpeg_parser.add_argument("--height", type=int, default=1536)
+    jpeg_parser.add_argument("--widths", default="480,600,1280", help="Stream widths to encode at")
+    jpeg_parser.add_argument("--mono", action="store_true")
+    jpeg_parser.add_argument("--quality", type=int, default=95)
+    jpeg_parser.add_argument("--count", help="Number of frames", type=int, default=200)
+    jpeg_parser.add_argument("--workers", type=int, default=2, help="Threads for the parallel run")
+    jpeg_parser.set_defaults(func=run_jpeg)
+
+    stream_parser = subparsers.add_parser(
+        "stream",
+        help="Load test: frame rate and bandwidth per viewer of a running cam_server",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    stream_parser.add_argument(
+        "--url", default="http://localhost:5000/image_stream", help="MJPEG stream, or ws://.../ws_stream"
+    )
+    stream_parser.add_argument("--clients", type=int, default=1)
+    stream_parser.add_argument("--seconds", type=float, default=10)
+    stream_parser.add_argument("--pid", type=int, help="Server process id, to report its CPU load (Linux)")
+    stream_parser.add_argument("--slow", type=int, default=0, help="Additional viewers on a slow link")
+    stream_parser.add_argument("--slow-kbs", type=float, default=100, help="Bandwidth of the slow viewers in kB/s")
+    stream_parser.set_defaults(func=run_stream)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -1,24 +1,61 @@
-import signal, time, argparse
-from threading import Event, Lock
+import signal, time, argparse, os, datetime
+from threading import Event, Lock, Thread
 import opencv_tools as ocv_tools
 import ximea_camera as xi_cam
 import logger_tools
+import config_tools
+import save_tools
+import ring_recorder
+import metrics
+
+BUFFER_LATENCY = metrics.STAGE_LATENCY.labels("buffer")
 
 
 class CameraController:
-    def __init__(self):
+    def __init__(self, config=None):
         self.cam = xi_cam.XimeaCamera()
+        self.config = {} if config is None else config
+        self.sink = None
         self.stop_event = Event()
         self.capture_started = False
         self.save = False
         self.manual = False
         self.save_dir = "data"
+        self.codec = ocv_tools.default_codec
         self.logger = logger_tools.get_logger(self.__class__.__name__)
-
-    def start_capture(self, manual=False, save=False, save_dir="data"):
-        self.logger.debug(f"Cam Controller start called: {manual}, {save}")
+        self.register_metrics()
+
+    def register_metrics(self):
+        """Gauges read when /metrics is scraped, nothing to update while capturing."""
+        metrics.gauge(
+            "xicam_capture_fps", "Frames per second read from the camera",
+            function=lambda: self.cam.fps_meter.rate if self.capture_started else 0.0,
+        )
+        metrics.gauge("xicam_buffer_frames", "Frames waiting in the camera buffer", function=lambda: len(self.cam.image_buffer))
+        metrics.gauge("xicam_buffer_capacity_frames", "Size of the camera buffer", function=lambda: self.cam.buffer_size)
+        metrics.gauge(
+            "xicam_save_queue_frames", "Frames waiting in the save queue",
+            function=lambda: self.sink.queue.qsize() if self.sink is not None else 0,
+        )
+        metrics.gauge("xicam_capture_running", "1 while capturing", function=lambda: int(self.capture_started))
+
+    def start_capture(
+        self, manual=False, save=False, save_dir="data", codec=None, sink=None, ring=False
+    ):
+        self.logger.debug(f"Cam Controller start called: {manual}, {save}, {codec}, {sink}, {ring}")
 
         try:
+            self.codec = ocv_tools.default_codec if codec is None else codec
+            if save:
+                self.sink = save_tools.sink_from_config(self.config, save_dir, self.codec, sink)
+            if ring:
+                # the ring recorder needs free-running capture, events come from gpi, key or http
+                manual = False
+                self.cam.ring_recorder = ring_recorder.ring_from_config(
+                    self.config, save_dir, self.codec
+                )
+                self.cam.read_gpi = self.cam.ring_recorder.gpi_trigger
+
             num = self.cam.get_xicam_instance().get_number_devices()
             self.logger.debug("Number of cameras: " + str(num))
 
@@ -37,8 +74,37 @@ class CameraController:
 
         except Exception:
             self.logger.error("Camera cannot be opened!", exc_info=True)
+            self.close_sink()
+            self.cam.ring_recorder = None
+            self.cam.read_gpi = False
             return False
 
+    def start_capture_from_query(self, query):
+        """
+        Start capture with the parameters of a web request (a dict-like of strings):
+        manual, save, ring, sink, codec, png_compression, jpeg_quality.
+        Every capture saves to a new timestamped folder in data.
+        Raises ValueError for an unknown codec.
+        """
+
+        def flag(name):
+            return str(query.get(name)).lower() == "true"
+
+        def number(name):
+            value = query.get(name)
+            return int(value) if value not in (None, "") else None
+
+        codec = save_tools.codec_from_config(
+            self.config, query.get("codec"), number("png_compression"), number("jpeg_quality")
+        )
+
+        save_dir = os.path.join("data", datetime.datetime.now().strftime("%Y-%m-%d-%H-%M-%S"))
+        os.makedirs(save_dir)
+
+        return self.start_capture(
+            flag("manual"), flag("save"), save_dir, codec, query.get("sink"), flag("ring")
+        )
+
     def stop_capture(self):
         self.logger.debug("Cam Controller stop called")
         try:
@@ -48,45 +114,111 @@ class CameraController:
             self.cam.close_device()
             self.capture_started = False
             self.save = False
+            self.close_sink()
+            self.close_ring()
             return True
 
         except Exception:
             self.logger.error("Camera cannot be closed!", exc_info=True)
             return False
 
-    def retrive_image(self):
+    def close_sink(self):
+        """Flush queued frames and close the sink, if any."""
+        if self.sink is not None:
+            self.sink.close()
+            self.sink = None
+
+    def close_ring(self):
+        """Wait for running ring dumps and remove the ring recorder, if any."""
+        if self.cam.ring_recorder is not None:
+            self.cam.ring_recorder.close()
+            self.cam.ring_recorder = None
+            self.cam.read_gpi = False
+
+    def trigger_event(self, source="api"):
+        """
+        Dump the ring buffer around now to disk.
+        returns: the dump folder or None if no ring recorder is running
+        """
+        if not self.capture_started or self.cam.ring_recorder is None:
+            self.logger.warning("Ring recorder not running.")
+            return None
+        return self.cam.ring_recorder.trigger(source)
+
+    def get_params(self):
+        """
+        Current camera parameters with their limits, see camera_params.PARAMETERS.
+        raises: RuntimeError if the camera is not open
+        """
+        if not self.capture_started:
+            raise RuntimeError("Capture not started, the camera is not open.")
+        return self.cam.params.get()
+
+    def set_params(self, changes, wait=True):
+        """
+        Change camera parameters during acquisition, e.g. set_params({"exposure": 5000, "gain": 2.0}).
+        wait: return once the frames show the change
+        returns: report with the time until the change was applied and until the frames showed it
+        raises: ValueError for invalid values, RuntimeError if the camera is not open
+        """
+        if not self.capture_started:
+            raise RuntimeError("Capture not started, the camera is not open.")
+        return self.cam.params.set(changes, wait, saving=self.save)
+
+    def latest_frame(self):
+        """
+        The newest full resolution Image, or None. Every frame has its own array,
+        so the reference stays valid while capture goes on.
+        """
+        if not self.capture_started:
+            return None
+        return self.cam.latest_image
+
+    def retrive_image(self, width=600):
+        """Next frame resized to width for the preview, frames are saved on the way. None if there is none."""
+        image = self.retrive_frame()
+        if image is None:
+            return None
+        return ocv_tools.resize_with_aspect_ratio(image.data, width)
+
+    def retrive_frame(self, timeout=0):
+        """
+        Next full resolution Image from the camera buffer, saved on the way. None if there is none.
+        timeout: seconds to wait for the next frame
+        """
         # self.logger.debug("Cam Controller get_image called")
         if self.capture_started:
-            image = self.cam.get_image_from_buffer()
+            image = self.cam.get_image_from_buffer(timeout)
 
-            if image.data is None or image.metadata is None:
-                self.logger.warning("No image available")
+            if image is None or image.data is None or image.metadata is None:
+                self.logger.debug("No image available")
                 return None
             
             else:
+                BUFFER_LATENCY.observe(time.time() - image.metadata.host_timestamp)
                 if self.manual:
                     timestamp = image.metadata.timestamp
                     if timestamp != self.manual_timestamp:
                         self.manual_timestamp = image.metadata.timestamp
                         if self.save:
                             # self.logger.debug("Saving image to folder: " + os.path.abspath(self.save_dir))
-                            ocv_tools.save_image(image.data, image.metadata, self.save_dir)
+                            self.sink.put(image)
 
-                        return ocv_tools.resize_with_aspect_ratio(image.data, 600)
+                        return image
                     else:
                         return None
                 else:
                     if self.save:
                         # self.logger.debug("Saving image to folder: " + os.path.abspath(self.save_dir))
-                        ocv_tools.save_image(image.data, image.metadata, self.save_dir)
+                        self.sink.put(image)
 
-                    return ocv_tools.resize_with_aspect_ratio(image.data, 600)
+                    return image
         else:
             self.logger.warning("Capture not started")
             return None
 
 
-def main(mode, timer=None):
+def main(mode, timer=None, codec=None, config=None, sink=None):
     global stop_event
 
     cam = xi_cam.XimeaCamera()
@@ -114,7 +246,7 @@ def main(mode, timer=None):
 
     elif mode == "save":
         image = cam.get_image_from_device(skip_frames)
-        ocv_tools.save_image(image, save_dir)
+        ocv_tools.save_image(image.data, image.metadata, save_dir, codec)
 
     elif mode == "video":
         cam.start_capture_thread(stop_event)
@@ -128,13 +260,41 @@ def main(mode, timer=None):
 
     elif mode == "output":
         cam.start_capture_thread(stop_event)
-        ocv_tools.manual_trigger_save(cam, save_dir)
+        ocv_tools.manual_trigger_save(cam, save_dir, codec, config)
         cam.stop_capture_thread()
 
     elif mode == "timer":
         cam.start_capture_thread(stop_event)
-        ocv_tools.capture_with_timer(cam, timer, save_dir, percent=25)
+        ocv_tools.capture_with_timer(cam, timer, save_dir, percent=25, codec=codec, config=config)
+        cam.stop_capture_thread()
+
+    elif mode == "record":
+        record_dir = os.path.join(save_dir, datetime.datetime.now().strftime("%Y-%m-%d-%H-%M-%S"))
+        os.makedirs(record_dir)
+        logger.info("Using folder: " + os.path.abspath(record_dir))
+
+        sink_thread = save_tools.sink_from_config(config or {}, record_dir, codec, sink)
+        cam.start_capture_thread(stop_event)
+        ocv_tools.record_stream(cam, sink_thread, stop_event)
         cam.stop_capture_thread()
+        sink_thread.close()
+
+    elif mode == "ring":
+        ring_dir = os.path.join(save_dir, datetime.datetime.now().strftime("%Y-%m-%d-%H-%M-%S"))
+        os.makedirs(ring_dir)
+        logger.info("Using folder: " + os.path.abspath(ring_dir))
+
+        ring = ring_recorder.ring_from_config(config or {}, ring_dir, codec)
+        cam.ring_recorder = ring
+        cam.read_gpi = ring.gpi_trigger
+        cam.start_capture_thread(stop_event)
+
+        logger.info("Ring recorder running. Press ENTER to dump, CTRL+C to exit.")
+        Thread(target=ring_recorder.trigger_on_enter, args=(ring,), daemon=True).start()
+        stop_event.wait()
+
+        cam.stop_capture_thread()
+        ring.close()
 
     # except KeyboardInterrupt:
     #     print("Keyboard Interrupt. Exiting in main.")
@@ -195,11 +355,57 @@ if __name__ == "__main__":
         action="store_true",
     )
 
+    argparse.add_argument(
+        "-r",
+        "--record",
+        help="Record all frames to the configured sink",
+        action="store_true",
+    )
+    argparse.add_argument(
+        "--ring",
+        help="Keep the last seconds in RAM and dump them around GPI or ENTER events",
+        action="store_true",
+    )
+    argparse.add_argument(
+        "--sink",
+        help="Sink used by --record (default from config file)",
+        choices=save_tools.SINKS,
+    )
+    argparse.add_argument(
+        "--codec",
+        help="Codec used to save images (default from config file)",
+        choices=list(save_tools.CODECS),
+    )
+    argparse.add_argument(
+        "--png-compression",
+        help="PNG compression level 0-9 (default from config file)",
+        type=int,
+    )
+    argparse.add_argument(
+        "--jpeg-quality",
+        help="JPEG quality 0-100 (default from config file)",
+        type=int,
+    )
+    argparse.add_argument(
+        "--config",
+        help="Path to the config file",
+        default=config_tools.DEFAULT_CONFIG_PATH,
+    )
+
     args = argparse.parse_args()
     config = vars(args)
 
-    mod_config = {k: v for k, v in config.items() if k != "timer"}
-    options = [k for k, v in mod_config.items() if v == True]
+    file_config = config_tools.load_config(args.config)
+    codec = save_tools.codec_from_config(
+        file_config,
+        args.codec,
+        args.png_compression,
+        args.jpeg_quality,
+    )
+    logger.info(f"Saving with {codec}.")
+
+    mode_keys = ["image", "save", "video", "manual", "output", "record", "ring"]
+    options = [k for k in mode_keys if config[k] == True]
     if config["timer"] > 0:
         options.append("timer")
 
@@ -217,7 +423,7 @@ if __name__ == "__main__":
             logger.info(
                 f"Running in {options[0]} mode with {config['timer']} seconds interval."
             )
-            main(options[0], config["timer"])
+            main(options[0], config["timer"], codec, file_config)
         else:
             logger.info(f"Running in {options[0]} mode.")
-            main(options[0])
+            main(options[0], codec=codec, config=file_config, sink=args.sink)
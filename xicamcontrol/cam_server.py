@@ -1,32 +1,61 @@
-from flask import Flask, render_template, Response, request
-import cv2, os, datetime
+from flask import Flask, render_template, Response, request, jsonify
+import argparse, time
+from concurrent.futures import ThreadPoolExecutor
 import cam_control as cam_control
 import logger_tools
+import config_tools
+import save_tools
+import stream_tools
+import jpeg_tools
+import metrics
 
 logger = logger_tools.get_logger(__name__)
 
 app = Flask(__name__, static_url_path="/static")
 
-camera = cam_control.CameraController()
-
-
-def gen_frames():
-    while camera.capture_started:
-        # logger.debug("gen_frames called")
-        data = camera.retrive_image()
-        if data is None:
-            continue
-        else:
-            # logger.debug("sending image data")
-            # opencv_tools.save_image(data, metadata, "data")
-            ret, buffer = cv2.imencode(".jpg", data)
-            frame = buffer.tobytes()
-            yield (
-                b"--frame\r\n" b"Content-Type: image/jpeg\r\n\r\n" + frame + b"\r\n"
-            )  # concat frame one by one and show result
-            yield (
-                b"--frame\r\n" b"Content-Type: image/jpeg\r\n\r\n" + frame + b"\r\n"
-            )  # send same frame twice to fix the problem of alwasys showing the previous frame
+config = config_tools.load_config()
+
+camera = cam_control.CameraController(config)
+
+# one encoder per stream width and quality in use, every client only sends the latest JPEG
+stream_config = config.get("STREAM") or {}
+broadcaster = stream_tools.FrameBroadcaster(
+    camera,
+    jpeg_quality=stream_config.get("JPEG_QUALITY", 95),
+    width=stream_config.get("WIDTH", 600),
+    backend=jpeg_tools.get_backend(stream_config.get("JPEG_BACKEND", "auto")),
+    workers=stream_config.get("ENCODE_WORKERS", 1),
+)
+broadcaster.start()
+
+# full resolution stills are encoded here, never on the capture or the stream threads
+still_pool = ThreadPoolExecutor(max_workers=2)
+
+
+def gen_frames(width, quality, sock=None, client="unknown"):
+    # acquired here, a viewer gone before the first part never runs the finally below
+    encoder = broadcaster.acquire(width, quality)
+    pacer = stream_tools.ViewerPacer(stream_config.get("ADAPTIVE", True), client=client)
+    try:
+        yield stream_tools.mjpeg_start()
+        seq = 0
+        while camera.capture_started:
+            seq, frame = encoder.wait_frame(seq)
+            if frame is None or not pacer.ready(sock):
+                # this viewer is still busy with earlier frames, wait for a newer one
+                continue
+            else:
+                scale, quality = pacer.update(seq)
+                if pacer.level > 0:
+                    seq, frame = encoder.variant(seq, scale, quality)
+                # each part ends with the next boundary, so the browser shows it right away
+                part = stream_tools.mjpeg_part(frame)
+                pacer.sent_part(len(part))
+                yield part
+    finally:
+        # runs when the stream ends or the viewer disconnects
+        pacer.close()
+        broadcaster.release(encoder)
 
 
 # main page
@@ -40,15 +69,12 @@ def index():
 def start_capture():
     logger.debug(f"start_capture called with args: {request.args}")
 
-    manual = True if (str(request.args.get("manual")).lower() == "true") else False
-    save = True if (str(request.args.get("save")).lower() == "true") else False
-
-    save_dir = os.path.join(
-        "data", datetime.datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
-    )
-    os.makedirs(save_dir)
+    try:
+        success = camera.start_capture_from_query(request.args)
+    except ValueError as e:
+        logger.warning(str(e))
+        success = False
 
-    success = camera.start_capture(manual, save, save_dir)
     if success:
         return "Capture started."
     else:
@@ -67,12 +93,108 @@ def stop_capture():
         return "Capture stop failed."
 
 
-# serve images
+# dump the ring buffer around now
+@app.route("/trigger")
+def trigger():
+    logger.debug("trigger called")
+
+    folder = camera.trigger_event("http")
+    if folder is not None:
+        return "Trigger accepted."
+    else:
+        return "Trigger failed."
+
+
+# latest preview frame for pollers, answers 304 while the frame did not change
+@app.route("/snapshot.jpg")
+def snapshot():
+    status, headers, body = stream_tools.snapshot(broadcaster, request.headers.get("If-None-Match"))
+    return Response(body, status=status, headers=headers)
+
+
+# newest full resolution frame as a download: /still?format=png|tiff|raw
+@app.route("/still")
+def still():
+    image = camera.latest_frame()
+    status, headers, body = still_pool.submit(stream_tools.still, image, request.args.get("format", "png")).result()
+    return Response(body, status=status, headers=headers)
+
+
+# live camera stats for the web UI as server-sent events, STREAM: STATS_HZ times per second
+@app.route("/stats")
+def stats():
+    interval = 1.0 / stream_config.get("STATS_HZ", 4)
+
+    def gen_stats():
+        while True:
+            yield stream_tools.sse_event(stream_tools.live_stats(camera))
+            time.sleep(interval)
+
+    return Response(gen_stats(), mimetype="text/event-stream", headers=stream_tools.SSE_HEADERS)
+
+
+# camera parameters: GET reads them with their limits, POST changes them during acquisition
+# (JSON or form body, e.g. {"exposure": 5000, "gain": 2}, ?wait=false returns without waiting for the frames)
+@app.route("/params", methods=["GET", "POST"])
+def params():
+    try:
+        if request.method == "GET":
+            return jsonify(camera.get_params())
+        changes = request.get_json(silent=True) or request.form.to_dict()
+        wait = request.args.get("wait", "true").lower() != "false"
+        return jsonify(camera.set_params(changes, wait))
+    except ValueError as e:
+        return Response(str(e), status=400)
+    except RuntimeError as e:
+        return Response(str(e), status=409)
+
+
+# reports of the recent parameter changes, with the time until the frames showed them
+@app.route("/params/changes")
+def param_changes():
+    return jsonify(camera.cam.params.changes())
+
+
+# pipeline counters in Prometheus text format
+@app.route("/metrics")
+def metrics_endpoint():
+    return Response(metrics.REGISTRY.render(), headers={"Content-Type": metrics.CONTENT_TYPE})
+
+
+# serve images: /image_stream?width=...&quality=...
 @app.route("/image_stream")
 def video_feed():
-    logger.debug("image_stream called")
-    return Response(gen_frames(), mimetype="multipart/x-mixed-replace; boundary=frame")
+    logger.debug(f"image_stream called with args: {request.args}")
+    try:
+        width, quality = broadcaster.settings(request.args.get("width"), request.args.get("quality"))
+    except ValueError as e:
+        return Response(str(e), status=400)
+    # the dev server exposes the connection, used to watch the send queue of this viewer
+    sock = request.environ.get("werkzeug.socket")
+    client = f"{request.remote_addr}:{request.environ.get('REMOTE_PORT', '')}"
+    return Response(gen_frames(width, quality, sock, client), mimetype=stream_tools.MJPEG_MIMETYPE, headers=stream_tools.MJPEG_HEADERS)
 
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", debug=True)
+    parser = argparse.ArgumentParser(
+        description="Web interface for the Ximea camera",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument(
+        "--async", dest="use_async", action="store_true",
+        help="Serve with asyncio (aiohttp), scales to many stream viewers",
+    )
+    args = parser.parse_args()
+
+    if args.use_async:
+        import async_server
+
+        async_server.run(
+            camera, broadcaster, still_pool, args.host, args.port, stream_config.get("ADAPTIVE", True),
+            stream_config.get("STATS_HZ", 4),
+        )
+    else:
+        # the reloader would start a second process that opens the camera too
+        app.run(host=args.host, port=args.port, debug=True, use_reloader=False, threaded=True)
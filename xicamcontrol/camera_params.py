@@ -0,0 +1,310 @@
+# camera_params.py
+
+import time, itertools
+from collections import deque
+from threading import Event, Lock
+import logger_tools
+import metrics
+
+logger = logger_tools.get_logger(__name__)
+
+# name -> (type, can change during acquisition, Metadata field that shows the change in the frames)
+PARAMETERS = {
+    "exposure": (int, True, "exposure"),
+    "gain": (float, True, "gain"),
+    "aeag": (bool, True, None),
+    "aeag_level": (int, True, None),
+    "exp_priority": (float, True, None),
+    "width": (int, False, "width"),
+    "height": (int, False, "height"),
+    "offsetX": (int, False, None),
+    "offsetY": (int, False, None),
+}
+ROI = ("width", "height", "offsetX", "offsetY")
+# size -> offset along the same sensor axis
+ROI_AXES = {"width": "offsetX", "height": "offsetY"}
+
+CHANGE_LATENCY = metrics.histogram(
+    "xicam_param_change_seconds", "Time from a parameter change request until the frames show it"
+)
+
+
+def parse_value(name, value):
+    """Convert a value from a web request (string or JSON) to the type of the parameter."""
+    kind = PARAMETERS[name][0]
+    if kind is bool:
+        if isinstance(value, str):
+            return value.lower() in ("1", "true", "on", "yes")
+        return bool(value)
+    return kind(value)
+
+
+class ParameterChange:
+    """One batch of parameter changes and how long it took until the frames showed it."""
+
+    _ids = itertools.count(1)
+
+    def __init__(self, values):
+        self.id = next(self._ids)
+        self.values = values
+        self.requested = time.time()
+        self.applied = None
+        self.effective = None
+        self.pause_ms = 0.0
+        self.frames = 0
+        self.status = "pending"
+        self.error = None
+        self.done = Event()
+
+    def matches(self, metadata):
+        """True if a frame was taken with all values of this change that frames carry."""
+        for name, value in self.values.items():
+            field = PARAMETERS[name][2]
+            if field is None:
+                continue
+            actual = getattr(metadata, field, None)
+            if actual is None:
+                continue
+            # the camera rounds to its own increments, exposure to a few us
+            tolerance = {"exposure": max(1.0, value * 0.01), "gain": 0.1}.get(name, 0)
+            if abs(float(actual) - float(value)) > tolerance:
+                return False
+        return True
+
+    def finish(self, status, effective=None):
+        self.status = status
+        self.effective = effective
+        if effective is not None:
+            CHANGE_LATENCY.observe(effective - self.requested)
+        self.done.set()
+
+    def report(self):
+        def ms(t):
+            return None if t is None else round((t - self.requested) * 1000, 1)
+
+        return {
+            "id": self.id,
+            "values": self.values,
+            "status": self.status,
+            "error": self.error,
+            "requested": self.requested,
+            "applied_ms": ms(self.applied),
+            "effective_ms": ms(self.effective),
+            "pause_ms": round(self.pause_ms, 1),
+            "frames_until_effective": self.frames if self.effective is not None else None,
+        }
+
+
+class CameraParameters:
+    """
+    Read and change camera parameters while acquiring.
+
+    Limits (min, max, increment) are read from the camera once and cached, values are
+    checked and rounded against them before anything is sent to the camera. Parameters
+    that can change during acquisition are set directly, the others (ROI) are set together
+    in one short acquisition pause. Each change is followed in the frames (exposure, gain
+    and size are in the frame metadata) to report how long it took to show up.
+
+    effect_timeout: seconds to wait for the frames to show a change
+    """
+
+    def __init__(self, xi_camera, effect_timeout=5.0, history=50):
+        self.xi_camera = xi_camera
+        self.effect_timeout = effect_timeout
+        self.limits_cache = {}
+        # changes the capture thread is looking for in the frames
+        self.watching = []
+        self.watch_lock = Lock()
+        self.history = deque(maxlen=history)
+        self.logger = logger_tools.get_logger(self.__class__.__name__)
+
+    @property
+    def cam(self):
+        return self.xi_camera.get_xicam_instance()
+
+    def limits(self, name):
+        """returns: (min, max, increment), cached, None for on/off parameters"""
+        if PARAMETERS[name][0] is bool:
+            return None
+        if name not in self.limits_cache:
+            self.limits_cache[name] = (
+                getattr(self.cam, f"get_{name}_minimum")(),
+                getattr(self.cam, f"get_{name}_maximum")(),
+                getattr(self.cam, f"get_{name}_increment")(),
+            )
+        return self.limits_cache[name]
+
+    def sensor_size(self):
+        """
+        returns: {"width", "height"} of the full sensor, cached. The camera reports the ROI
+        limits for the current ROI only, e.g. the maximum width shrinks with offsetX.
+        """
+        if "sensor" not in self.limits_cache:
+            self.limits_cache["sensor"] = {
+                size: self.read(offset) + getattr(self.cam, f"get_{size}_maximum")()
+                for size, offset in ROI_AXES.items()
+            }
+        return self.limits_cache["sensor"]
+
+    def clear_cache(self):
+        self.limits_cache = {}
+
+    def read(self, name):
+        if name == "aeag":
+            return bool(self.cam.is_aeag())
+        return getattr(self.cam, f"get_{name}")()
+
+    def get(self):
+        """returns: {name: {"value", "min", "max", "increment"}} of all parameters"""
+        result = {}
+        for name in PARAMETERS:
+            entry = {"value": self.read(name)}
+            limits = self.limits(name)
+            if limits is not None:
+                entry.update(min=limits[0], max=limits[1], increment=limits[2])
+            result[name] = entry
+        return result
+
+    def validate(self, changes):
+        """
+        Check changes against the cached limits, values are rounded to the increment.
+        returns: dict of the values to set. raises: ValueError
+        """
+        if not isinstance(changes, dict):
+            raise ValueError("Parameter changes must be a name -> value mapping.")
+        values = {}
+        for name, value in changes.items():
+            if name not in PARAMETERS:
+                raise ValueError(f"Unknown parameter '{name}'. Available: {', '.join(PARAMETERS)}")
+            try:
+                value = parse_value(name, value)
+            except (TypeError, ValueError):
+                raise ValueError(f"Invalid value for {name}: {value!r}")
+            limits = self.limits(name)
+            if limits is not None and name not in ROI:
+                low, high, step = limits
+                if not low <= value <= high:
+                    raise ValueError(f"{name} must be between {low} and {high}, got {value}")
+                if step:
+                    value = type(value)(low + round((value - low) / step) * step)
+            values[name] = value
+
+        if any(name in ROI for name in values):
+            values.update(self.validate_roi({name: values[name] for name in ROI if name in values}))
+
+        if ("exposure" in values or "gain" in values) and "aeag" not in values and self.read("aeag"):
+            # auto exposure would overwrite the value right away
+            values["aeag"] = False
+        return values
+
+    def validate_roi(self, roi):
+        """
+        Check ROI changes as a whole against the sensor, the limits of single ROI values
+        depend on the others. Sizes and offsets are rounded to their increments.
+        returns: rounded values of the changed names. raises: ValueError
+        """
+        target = {name: roi[name] if name in roi else self.read(name) for name in ROI}
+        sensor = self.sensor_size()
+        for size, offset in ROI_AXES.items():
+            size_min, _, size_step = self.limits(size)
+            offset_step = self.limits(offset)[2]
+            if size_step:
+                target[size] = size_min + round((target[size] - size_min) / size_step) * size_step
+            if offset_step:
+                target[offset] = round(target[offset] / offset_step) * offset_step
+            if target[size] < size_min or target[offset] < 0 or target[offset] + target[size] > sensor[size]:
+                raise ValueError(
+                    f"{offset} + {size} must fit the sensor ({sensor[size]} px, {size} at least {size_min}), "
+                    f"got {target[offset]} + {target[size]}"
+                )
+        return {name: target[name] for name in roi}
+
+    def set(self, changes, wait=True, saving=False):
+        """
+        Validate and apply a batch of parameter changes.
+        wait: block until the frames show the change (or effect_timeout)
+        saving: a recording is running, its frame size must not change
+        returns: ParameterChange.report(). raises: ValueError
+        """
+        values = self.validate(changes)
+        if saving and any(name in ROI for name in values):
+            raise ValueError("The ROI can not change while saving, stop the recording first.")
+
+        change = ParameterChange(values)
+        live = {name: value for name, value in values.items() if PARAMETERS[name][1]}
+        paused = {name: value for name, value in values.items() if not PARAMETERS[name][1]}
+        try:
+            # aeag first, so a new exposure is not overwritten by auto exposure
+            for name in sorted(live, key=lambda n: n != "aeag"):
+                self.write(name, live[name])
+            if paused:
+                self.write_paused(paused, change)
+        except Exception as e:
+            change.error = repr(e)
+            change.finish("failed")
+            self.history.append(change)
+            self.logger.error(f"Parameter change {values} failed: {e!r}")
+            raise ValueError(f"Camera rejected {values}: {e}")
+
+        change.applied = time.time()
+        self.history.append(change)
+        if any(PARAMETERS[name][2] is not None for name in values):
+            with self.watch_lock:
+                self.watching = self.watching + [change]
+        else:
+            # nothing in the frames shows it, applied is all we know
+            change.finish("applied")
+        self.logger.info(f"Parameters changed: {values}")
+
+        if wait:
+            change.done.wait(self.effect_timeout + 0.5)
+        return change.report()
+
+    def write(self, name, value):
+        if name == "aeag":
+            self.cam.enable_aeag() if value else self.cam.disable_aeag()
+        else:
+            getattr(self.cam, f"set_{name}")(value)
+
+    def write_paused(self, values, change):
+        """Set parameters that need a stopped acquisition, all in one pause."""
+        current = {name: self.read(name) for name in ("offsetX", "offsetY")}
+
+        def step(name):
+            # smaller offsets first and larger ones last, so offset + size always fits the sensor
+            if name in current:
+                return 0 if values[name] < current[name] else 2
+            return 1
+
+        order = sorted(values, key=step)
+        with self.xi_camera.device_lock:
+            t0 = time.perf_counter()
+            self.cam.stop_acquisition()
+            try:
+                for name in order:
+                    self.write(name, values[name])
+            finally:
+                self.cam.start_acquisition()
+                change.pause_ms = (time.perf_counter() - t0) * 1000
+        # the ROI limits depend on each other
+        self.clear_cache()
+
+    def check_frame(self, metadata):
+        """Called by the capture thread for every frame while changes are watched."""
+        now = time.time()
+        finished = []
+        for change in self.watching:
+            change.frames += 1
+            if metadata is not None and change.matches(metadata):
+                change.finish("effective", now)
+                finished.append(change)
+            elif now - change.applied > self.effect_timeout:
+                change.finish("timeout")
+                finished.append(change)
+        if finished:
+            with self.watch_lock:
+                self.watching = [c for c in self.watching if c not in finished]
+
+    def changes(self):
+        """Reports of the recent changes, newest last."""
+        return [change.report() for change in list(self.history)]
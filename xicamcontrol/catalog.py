@@ -0,0 +1,332 @@
+# catalog.py
+
+import os, sys, csv, glob, re, time, sqlite3, argparse, datetime
+from queue import Queue, Empty
+from threading import Thread
+from concurrent.futures import ProcessPoolExecutor
+import logger_tools
+
+logger = logger_tools.get_logger(__name__)
+
+DEFAULT_DB_PATH = os.path.join("data", "xi_catalog.sqlite")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    session TEXT PRIMARY KEY,
+    path TEXT,
+    indexed REAL
+);
+CREATE TABLE IF NOT EXISTS frames (
+    session TEXT NOT NULL,
+    frame_id INTEGER,
+    camera_ts REAL,
+    host_ts REAL,
+    exposure REAL,
+    gain REAL,
+    path TEXT,
+    bytes INTEGER
+);
+CREATE INDEX IF NOT EXISTS frames_host_ts ON frames (host_ts);
+CREATE INDEX IF NOT EXISTS frames_session ON frames (session, frame_id);
+"""
+
+COLUMNS = ["session", "frame_id", "camera_ts", "host_ts", "exposure", "gain", "path", "bytes"]
+
+
+class Catalog:
+    """SQLite catalog of saved frames across all sessions in the data folder."""
+
+    def __init__(self, db_path=DEFAULT_DB_PATH):
+        self.db_path = db_path
+        self.root = os.path.dirname(os.path.abspath(db_path))
+        os.makedirs(self.root, exist_ok=True)
+        self.conn = sqlite3.connect(db_path, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+
+    def session_name(self, save_dir):
+        """Sessions are named by their folder relative to the catalog folder."""
+        return os.path.relpath(os.path.abspath(save_dir), self.root)
+
+    def add_session(self, session, path):
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO sessions VALUES (?, ?, ?)", (session, path, time.time())
+            )
+
+    def insert(self, rows):
+        """Insert frame rows (tuples in COLUMNS order) in one transaction."""
+        with self.conn:
+            self.conn.executemany("INSERT INTO frames VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def delete_session(self, session):
+        with self.conn:
+            self.conn.execute("DELETE FROM frames WHERE session = ?", (session,))
+            self.conn.execute("DELETE FROM sessions WHERE session = ?", (session,))
+
+    def query(self, session=None, start=None, end=None, exposure=None, gain=None, limit=None):
+        """
+        Find frames. start/end are host timestamps (epoch seconds),
+        exposure and gain are (min, max) tuples, any of them may be None.
+        returns: list of dicts
+        """
+        conditions = []
+        params = []
+        if session is not None:
+            conditions.append("session = ?")
+            params.append(session)
+        if start is not None:
+            conditions.append("host_ts >= ?")
+            params.append(start)
+        if end is not None:
+            conditions.append("host_ts <= ?")
+            params.append(end)
+        for column, bounds in (("exposure", exposure), ("gain", gain)):
+            if bounds is not None:
+                conditions.append(f"{column} BETWEEN ? AND ?")
+                params.extend(bounds)
+
+        sql = "SELECT " + ", ".join(COLUMNS) + " FROM frames"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY host_ts"
+        if limit is not None:
+            sql += f" LIMIT {int(limit)}"
+
+        return [dict(zip(COLUMNS, row)) for row in self.conn.execute(sql, params)]
+
+    def sessions(self):
+        return [row[0] for row in self.conn.execute("SELECT session FROM sessions ORDER BY session")]
+
+    def close(self):
+        self.conn.close()
+
+
+class CatalogWriter(Thread):
+    """
+    Insert the frames of one session into the catalog from a background thread,
+    in batches of batch_size rows or every flush_seconds, each batch in one transaction.
+    """
+
+    def __init__(self, db_path, save_dir, batch_size=500, flush_seconds=2):
+        Thread.__init__(self, daemon=True)
+        self.db_path = db_path
+        self.save_dir = save_dir
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.queue = Queue()
+        self.logger = logger_tools.get_logger(self.__class__.__name__)
+
+    def add(self, metadata, path, nbytes):
+        if metadata is not None:
+            row = (metadata.frame_id, metadata.timestamp, metadata.host_timestamp,
+                   metadata.exposure, metadata.gain, path, nbytes)
+        else:
+            row = (None, None, time.time(), None, None, path, nbytes)
+        self.queue.put(row)
+
+    def run(self):
+        # sqlite connections must be used by the thread that created them
+        catalog = Catalog(self.db_path)
+        session = catalog.session_name(self.save_dir)
+        catalog.add_session(session, os.path.abspath(self.save_dir))
+
+        rows = []
+        last_flush = time.time()
+        while True:
+            try:
+                row = self.queue.get(timeout=self.flush_seconds)
+            except Empty:
+                row = False
+
+            if row is None:
+                break
+            if row is not False:
+                rows.append((session,) + row)
+
+            if rows and (len(rows) >= self.batch_size or time.time() - last_flush >= self.flush_seconds):
+                catalog.insert(rows)
+                rows = []
+                last_flush = time.time()
+
+        if rows:
+            catalog.insert(rows)
+        catalog.close()
+        self.logger.debug(f"CatalogWriter finished for session {session}.")
+
+    def close(self):
+        self.queue.put(None)
+        self.join()
+
+
+def _float(value):
+    return float(value) if value not in ("", None) else None
+
+
+# xi_<float seconds>.ext (old layout) or xi_<16 digit microseconds>.ext
+LEGACY_NAME = re.compile(r"^xi_(\d+\.\d+|\d{16})\.(png|jpg|tiff|bmp|npy)$")
+
+
+def index_session(session_dir):
+    """
+    Collect the frame rows of one session folder from whatever index it has:
+    manifest, raw index, hdf5 metadata, video sidecars, or file names of old sessions.
+    returns: list of (frame_id, camera_ts, host_ts, exposure, gain, path, bytes) tuples
+    """
+    rows = []
+
+    manifest = os.path.join(session_dir, "xi_manifest.csv")
+    if os.path.exists(manifest):
+        with open(manifest, newline="") as f:
+            for r in csv.DictReader(f):
+                rows.append((int(r["frame_id"]), _float(r["camera_timestamp"]), _float(r["host_timestamp"]),
+                             _float(r["exposure"]), _float(r["gain"]), r["path"], int(r["bytes"])))
+
+    raw_index = os.path.join(session_dir, "xi_raw.csv")
+    if os.path.exists(raw_index):
+        with open(raw_index, newline="") as f:
+            for r in csv.DictReader(f):
+                frame_id = int(r["frame_id"]) if r["frame_id"] else None
+                rows.append((frame_id, _float(r["timestamp"]), _float(r["host_timestamp"]),
+                             _float(r["exposure"]), _float(r["gain"]),
+                             "xi_raw.bin#" + r["offset"], int(r["nbytes"])))
+
+    h5_path = os.path.join(session_dir, "xi_frames.h5")
+    if os.path.exists(h5_path):
+        try:
+            import h5py
+
+            with h5py.File(h5_path, "r") as f:
+                for i, m in enumerate(f["metadata"][:]):
+                    rows.append((int(m["frame_id"]), float(m["timestamp"]), float(m["host_timestamp"]),
+                                 float(m["exposure"]), float(m["gain"]), f"xi_frames.h5#{i}", None))
+        except ImportError:
+            logger.warning(f"h5py not installed, skipping {h5_path}")
+
+    for sidecar in sorted(glob.glob(os.path.join(session_dir, "xi_[0-9][0-9][0-9][0-9].csv"))):
+        base = os.path.splitext(sidecar)[0]
+        video = [p for p in glob.glob(base + ".*") if not p.endswith(".csv")]
+        name = os.path.basename(video[0]) if video else os.path.basename(base)
+        with open(sidecar, newline="") as f:
+            for r in csv.DictReader(f):
+                frame_id = int(r["frame_id"]) if r["frame_id"] else None
+                rows.append((frame_id, _float(r["camera_timestamp"]), _float(r["host_timestamp"]),
+                             None, None, f"{name}#{r['index']}", None))
+
+    if not rows:
+        for entry in os.scandir(session_dir):
+            match = LEGACY_NAME.match(entry.name)
+            if match is None:
+                continue
+            value = match.group(1)
+            timestamp = float(value) if "." in value else int(value) / 1e6
+            stat = entry.stat()
+            # old sessions have no host timestamp, the file time is close enough
+            rows.append((None, timestamp, stat.st_mtime, None, None, entry.name, stat.st_size))
+
+    return rows
+
+
+def find_sessions(root):
+    """Folders below root that contain saved frames."""
+    sessions = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        if any(
+            f in ("xi_manifest.csv", "xi_raw.csv", "xi_frames.h5") or LEGACY_NAME.match(f)
+            or re.match(r"^xi_\d{4}\.csv$", f)
+            for f in filenames
+        ):
+            sessions.append(dirpath)
+            # shard folders of a session are covered by its manifest
+            dirnames[:] = [d for d in dirnames if not re.match(r"^\d{6}$", d)]
+    return sessions
+
+
+def rebuild(db_path=DEFAULT_DB_PATH, root=None, workers=None):
+    """Index all session folders below root (default: the catalog folder) in parallel."""
+    catalog = Catalog(db_path)
+    root = catalog.root if root is None else root
+    sessions = find_sessions(root)
+    logger.info(f"Indexing {len(sessions)} sessions below {root}")
+
+    total = 0
+    t0 = time.time()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for session_dir, rows in zip(sessions, pool.map(index_session, sessions)):
+            session = catalog.session_name(session_dir)
+            catalog.delete_session(session)
+            catalog.add_session(session, os.path.abspath(session_dir))
+            catalog.insert([(session,) + row for row in rows])
+            total += len(rows)
+
+    catalog.close()
+    logger.info(f"Indexed {total} frames in {time.time() - t0:.1f} s")
+    return total
+
+
+def parse_time(value):
+    """Epoch seconds or an ISO date/time like 2024-05-01T12:00:00."""
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.datetime.fromisoformat(value).timestamp()
+
+
+def parse_range(value):
+    """min:max"""
+    if value is None:
+        return None
+    low, high = value.split(":")
+    return float(low), float(high)
+
+
+###############################################
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Frame catalog of all saved sessions",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("--db", help="Catalog database", default=DEFAULT_DB_PATH)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    query_parser = subparsers.add_parser("query", help="Find frames")
+    query_parser.add_argument("--session", help="Session folder relative to the catalog folder")
+    query_parser.add_argument("--start", help="Epoch seconds or ISO time")
+    query_parser.add_argument("--end", help="Epoch seconds or ISO time")
+    query_parser.add_argument("--exposure", help="Exposure range in us, min:max")
+    query_parser.add_argument("--gain", help="Gain range in dB, min:max")
+    query_parser.add_argument("--limit", type=int, default=100)
+
+    rebuild_parser = subparsers.add_parser("rebuild", help="Index existing session folders")
+    rebuild_parser.add_argument("--root", help="Folder to scan (default: the catalog folder)")
+    rebuild_parser.add_argument("--workers", help="Indexing processes", type=int)
+
+    subparsers.add_parser("sessions", help="List indexed sessions")
+
+    args = parser.parse_args()
+
+    if args.command == "rebuild":
+        rebuild(args.db, args.root, args.workers)
+
+    elif args.command == "sessions":
+        catalog = Catalog(args.db)
+        for session in catalog.sessions():
+            print(session)
+
+    elif args.command == "query":
+        catalog = Catalog(args.db)
+        rows = catalog.query(
+            session=args.session,
+            start=parse_time(args.start),
+            end=parse_time(args.end),
+            exposure=parse_range(args.exposure),
+            gain=parse_range(args.gain),
+            limit=args.limit,
+        )
+        writer = csv.writer(sys.stdout)
+        writer.writerow(COLUMNS)
+        for row in rows:
+            writer.writerow([row[c] for c in COLUMNS])
@@ -0,0 +1,100 @@
+# change_gate.py
+
+import time
+import numpy as np
+import cv2
+import logger_tools
+
+logger = logger_tools.get_logger(__name__)
+
+METRICS = ["mean", "block"]
+
+
+class ChangeGate:
+    """
+    Decide whether a frame differs enough from the last saved frame to be saved.
+
+    Frames are compared as small grayscale thumbnails of width size: the frame (green
+    channel of color frames) is subsampled with a stride to about 4x the thumbnail, then
+    area-averaged down, which costs well below 1 ms even for large frames.
+
+    threshold: difference in 8 bit gray levels (frames of other bit depths are scaled)
+    metric: "mean" (mean absolute difference of the whole thumbnail) or "block"
+            (largest mean absolute difference of a grid x grid block, catches small local changes)
+    keepalive_seconds: save a frame at least this often, even without change (0 disables)
+    """
+
+    def __init__(self, threshold=2.0, metric="block", keepalive_seconds=10, size=64, grid=8):
+        if metric not in METRICS:
+            raise ValueError(f"Unknown change metric '{metric}'. Available: {', '.join(METRICS)}")
+        self.threshold = threshold
+        self.metric = metric
+        self.keepalive_seconds = keepalive_seconds
+        self.size = size
+        self.grid = grid
+        self.reference = None
+        self.scale = None
+        self.last_saved = 0
+        self.last_score = 0.0
+        self.passed = 0
+        self.rejected = 0
+
+    def thumbnail(self, data):
+        height, width = data.shape[:2]
+        stride = max(1, width // (self.size * 4))
+        if data.ndim == 3:
+            # the green channel carries most of the luminance, good enough to see change
+            small = np.ascontiguousarray(data[::stride, ::stride, min(1, data.shape[2] - 1)])
+        else:
+            small = data[::stride, ::stride]
+        size = (self.size, max(1, round(self.size * height / width)))
+        small = cv2.resize(small, size, interpolation=cv2.INTER_AREA).astype(np.float32)
+        if data.dtype.itemsize > 1:
+            if self.scale is None:
+                # 10/12 bit cameras deliver 16 bit words, guess the used bits from the first frame
+                bits = max(8, int(small.max()).bit_length())
+                self.scale = 255.0 / (2**bits - 1)
+            small *= self.scale
+        return small
+
+    def score(self, thumbnail):
+        diff = np.abs(thumbnail - self.reference)
+        if self.metric == "mean":
+            return float(diff.mean())
+        rows, cols = diff.shape
+        bh, bw = max(1, rows // self.grid), max(1, cols // self.grid)
+        blocks = diff[: rows - rows % bh, : cols - cols % bw].reshape(rows // bh, bh, cols // bw, bw)
+        return float(blocks.mean(axis=(1, 3)).max())
+
+    def check(self, data):
+        """returns: True if the frame should be saved"""
+        thumbnail = self.thumbnail(data)
+        now = time.time()
+        if self.reference is None or thumbnail.shape != self.reference.shape:
+            changed = True
+        else:
+            self.last_score = self.score(thumbnail)
+            changed = self.last_score >= self.threshold
+            if not changed and self.keepalive_seconds and now - self.last_saved >= self.keepalive_seconds:
+                changed = True
+
+        if changed:
+            self.reference = thumbnail
+            self.last_saved = now
+            self.passed += 1
+        else:
+            self.rejected += 1
+        return changed
+
+
+def gate_from_config(config):
+    """ChangeGate from the SAVE section of the config file, None if disabled."""
+    save_config = config.get("SAVE") or {}
+    if not save_config.get("CHANGE_GATE", False):
+        return None
+    return ChangeGate(
+        threshold=save_config.get("CHANGE_THRESHOLD", 2.0),
+        metric=save_config.get("CHANGE_METRIC", "block"),
+        keepalive_seconds=save_config.get("CHANGE_KEEPALIVE_SECONDS", 10),
+        size=save_config.get("CHANGE_SIZE", 64),
+    )
@@ -0,0 +1,24 @@
+# config_tools.py
+
+import os
+import yaml
+import logger_tools
+
+logger = logger_tools.get_logger(__name__)
+
+DEFAULT_CONFIG_PATH = "xicam_config.yaml"
+
+
+def load_config(path=DEFAULT_CONFIG_PATH):
+    """
+    Load the yaml config file and return it as a dict.
+    Returns an empty dict if the file does not exist.
+    """
+    if not os.path.exists(path):
+        logger.warning(f"Config file not found: {path}. Using defaults.")
+        return {}
+
+    with open(path, "r") as f:
+        config = yaml.safe_load(f)
+
+    return config or {}
@@ -0,0 +1,344 @@
+# export.py
+
+import os, sys, csv, glob, time, heapq, argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory, resource_tracker
+import numpy as np
+import cv2
+import logger_tools
+import save_tools
+import raw_sink
+import catalog
+import opencv_tools
+
+logger = logger_tools.get_logger(__name__)
+
+# output format -> fourcc of video exports, image formats use the save_tools codecs
+VIDEO_FORMATS = {
+    "mp4": "mp4v",
+    "avi": "MJPG",
+}
+FORMATS = list(save_tools.CODECS) + list(VIDEO_FORMATS)
+
+# Bayer pattern -> cv2 conversion
+DEMOSAIC = {
+    "RG": cv2.COLOR_BayerRG2BGR,
+    "BG": cv2.COLOR_BayerBG2BGR,
+    "GR": cv2.COLOR_BayerGR2BGR,
+    "GB": cv2.COLOR_BayerGB2BGR,
+}
+
+
+def read_session(session_dir):
+    """
+    Open a recorded session of any sink.
+    returns: (number of frames or None, iterator of (source, info))
+    source is a numpy array, or the path of an image file the worker loads itself,
+    info a dict with frame_id and timestamp
+    A session degraded to a raw dump (see save_tools.SinkThread.degrade) has two parts,
+    they are merged by frame id.
+    """
+    parts = []
+
+    if os.path.exists(os.path.join(session_dir, raw_sink.INDEX_FILENAME)):
+        with open(os.path.join(session_dir, raw_sink.INDEX_FILENAME)) as f:
+            total = sum(1 for line in f) - 1
+        frames = (
+            (frame, {"frame_id": row["frame_id"], "timestamp": row["timestamp"]})
+            for frame, row in raw_sink.read_raw(session_dir)
+        )
+        parts.append((total, frames))
+
+    if os.path.exists(os.path.join(session_dir, "xi_manifest.csv")):
+        rows = save_tools.read_manifest(session_dir)
+        frames = (
+            (os.path.join(session_dir, r["path"]), {"frame_id": r["frame_id"], "timestamp": r["camera_timestamp"]})
+            for r in rows
+        )
+        parts.append((len(rows), frames))
+
+    h5_path = os.path.join(session_dir, "xi_frames.h5")
+    if os.path.exists(h5_path):
+        import h5py
+
+        f = h5py.File(h5_path, "r")
+        parts.append((len(f["frames"]), _read_hdf5(f)))
+
+    segments = sorted(
+        p for p in glob.glob(os.path.join(session_dir, "xi_[0-9][0-9][0-9][0-9].*")) if not p.endswith(".csv")
+    )
+    if segments:
+        total = 0
+        for path in segments:
+            capture = cv2.VideoCapture(path)
+            total += int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+            capture.release()
+        parts.append((total, _read_video(segments)))
+
+    if len(parts) == 1:
+        return parts[0]
+    if parts:
+        logger.info(f"{session_dir} has {len(parts)} recorded parts, merging them by frame id.")
+        total = sum(total for total, frames in parts)
+        return total, heapq.merge(*(frames for total, frames in parts), key=_frame_order)
+
+    files = sorted(e.path for e in os.scandir(session_dir) if catalog.LEGACY_NAME.match(e.name))
+    if files:
+        return len(files), ((path, {"frame_id": i, "timestamp": ""}) for i, path in enumerate(files))
+
+    raise ValueError(f"No recording found in {session_dir}")
+
+
+def _frame_order(item):
+    frame_id = item[1]["frame_id"]
+    return int(float(frame_id)) if frame_id != "" else 0
+
+
+def _read_hdf5(f):
+    frames = f["frames"]
+    metadata = f["metadata"]
+    # read whole chunks, h5py decompresses a chunk for every partial read
+    step = frames.chunks[0]
+    for start in range(0, len(frames), step):
+        block = frames[start : start + step]
+        block_metadata = metadata[start : start + step]
+        for frame, m in zip(block, block_metadata):
+            yield frame, {"frame_id": int(m["frame_id"]), "timestamp": float(m["timestamp"])}
+    f.close()
+
+
+def _read_video(segments):
+    for path in segments:
+        sidecar = []
+        if os.path.exists(os.path.splitext(path)[0] + ".csv"):
+            with open(os.path.splitext(path)[0] + ".csv", newline="") as f:
+                sidecar = list(csv.DictReader(f))
+        capture = cv2.VideoCapture(path)
+        index = 0
+        while True:
+            ok, frame = capture.read()
+            if not ok:
+                break
+            row = sidecar[index] if index < len(sidecar) else {}
+            yield frame, {"frame_id": row.get("frame_id", index), "timestamp": row.get("camera_timestamp", "")}
+            index += 1
+        capture.release()
+
+
+def load_frame(path):
+    if path.endswith(".npy"):
+        return np.load(path)
+    return cv2.imread(path, cv2.IMREAD_UNCHANGED)
+
+
+def transform(data, info, demosaic=None, crop=None, width=None, overlay=False):
+    """
+    Apply the export operations to a frame, in this order: demosaic, crop, resize, overlay.
+    crop: (x, y, width, height)
+    width: output width, the height follows the aspect ratio
+    overlay: draw frame id and camera timestamp into the frame
+    """
+    if demosaic is not None and data.ndim == 2:
+        data = cv2.cvtColor(data, DEMOSAIC[demosaic])
+    if crop is not None:
+        x, y, w, h = crop
+        data = data[y : y + h, x : x + w]
+    if width is not None and width != data.shape[1]:
+        data = opencv_tools.resize_with_aspect_ratio(data, width)
+    if overlay:
+        data = np.ascontiguousarray(data)
+        text = f"{info['frame_id']}  {info['timestamp']}"
+        cv2.putText(data, text, (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (255, 255, 255), 2)
+    return data
+
+
+# shared memory segments attached by a worker process, by name
+_attached = {}
+
+
+def export_frame(index, source, slot, info, options, out_dir, out_format):
+    """
+    Worker: load, transform and (for image formats) write one frame.
+    slot: (shared memory name, shape, dtype) when the frame was handed over in shared memory
+    returns: (bytes written, the frame for video formats, else None)
+    """
+    if slot is not None:
+        name, shape, dtype = slot
+        if name not in _attached:
+            _attached[name] = shared_memory.SharedMemory(name=name)
+        source = np.ndarray(shape, dtype=dtype, buffer=_attached[name].buf)
+    elif isinstance(source, str):
+        source = load_frame(source)
+
+    data = transform(source, info, **options)
+    if out_format in VIDEO_FORMATS:
+        # the slot is reused as soon as this returns, never hand back a view of it
+        return data.nbytes, np.array(data, copy=True)
+
+    codec = save_tools.get_codec(out_format)
+    nbytes = codec.write(data, os.path.join(out_dir, f"xi_{index:010d}{codec.extension}"))
+    return nbytes, None
+
+
+class Progress:
+    """Progress line on stderr, at most every interval seconds."""
+
+    def __init__(self, total, interval=0.5):
+        self.total = total
+        self.interval = interval
+        self.start = time.time()
+        self.last = 0
+
+    def update(self, done, nbytes, force=False):
+        now = time.time()
+        if not force and now - self.last < self.interval:
+            return
+        self.last = now
+        elapsed = max(now - self.start, 1e-9)
+        total = self.total or "?"
+        bar = ""
+        if self.total:
+            filled = int(30 * done / self.total)
+            bar = "[" + "#" * filled + "." * (30 - filled) + "] "
+        sys.stderr.write(f"\r{bar}{done}/{total} frames  {done / elapsed:.1f} fps  {nbytes / 1e6 / elapsed:.1f} MB/s out")
+        sys.stderr.flush()
+
+
+class SlotPool:
+    """Shared memory buffers for handing frames to the workers without pickling them."""
+
+    def __init__(self):
+        self.free = []
+        self.segments = []
+
+    def get(self, nbytes):
+        for i, segment in enumerate(self.free):
+            if segment.size >= nbytes:
+                return self.free.pop(i)
+        segment = shared_memory.SharedMemory(create=True, size=max(nbytes, 1))
+        self.segments.append(segment)
+        return segment
+
+    def release(self, segment):
+        self.free.append(segment)
+
+    def close(self):
+        for segment in self.segments:
+            segment.close()
+            segment.unlink()
+
+
+def export_session(
+    session_dir, out_path, out_format="png", workers=None, demosaic=None, crop=None, width=None,
+    overlay=False, fps=30.0,
+):
+    """
+    Export a recorded session to an image set (out_path is a folder) or a video file.
+    Frames are processed by a pool of worker processes and written in recording order.
+    returns: (number of frames, seconds)
+    """
+    if out_format not in FORMATS:
+        raise ValueError(f"Unknown format '{out_format}'. Available: {', '.join(FORMATS)}")
+    workers = workers or os.cpu_count()
+    options = {"demosaic": demosaic, "crop": crop, "width": width, "overlay": overlay}
+    total, frames = read_session(session_dir)
+
+    video = out_format in VIDEO_FORMATS
+    if not video:
+        os.makedirs(out_path, exist_ok=True)
+    writer = None
+
+    slots = SlotPool()
+    # (future, slot) in recording order, at most 2 frames per worker in flight
+    pending = deque()
+    max_pending = 2 * workers
+    progress = Progress(total)
+    done = 0
+    nbytes_out = 0
+
+    def collect():
+        nonlocal writer, done, nbytes_out
+        future, segment = pending.popleft()
+        nbytes, data = future.result()
+        if segment is not None:
+            slots.release(segment)
+        if video:
+            if writer is None:
+                size = (data.shape[1], data.shape[0])
+                writer = cv2.VideoWriter(out_path, cv2.VideoWriter_fourcc(*VIDEO_FORMATS[out_format]), fps, size, data.ndim == 3)
+                if not writer.isOpened():
+                    raise RuntimeError(f"Can not write {out_format} with this OpenCV build.")
+            writer.write(data)
+        nbytes_out += nbytes
+        done += 1
+        progress.update(done, nbytes_out)
+
+    # workers forked before the first shared memory segment would start their own resource
+    # trackers, which unlink the segments of this process when they exit
+    resource_tracker.ensure_running()
+    t0 = time.time()
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for index, (source, info) in enumerate(frames):
+                if len(pending) >= max_pending:
+                    collect()
+
+                segment = None
+                slot = None
+                if isinstance(source, np.ndarray):
+                    segment = slots.get(source.nbytes)
+                    shared = np.ndarray(source.shape, dtype=source.dtype, buffer=segment.buf)
+                    np.copyto(shared, source)
+                    slot = (segment.name, source.shape, source.dtype.str)
+                    source = None
+                    del shared
+
+                future = pool.submit(export_frame, index, source, slot, info, options, out_path, out_format)
+                pending.append((future, segment))
+
+            while pending:
+                collect()
+    finally:
+        if writer is not None:
+            writer.release()
+        slots.close()
+
+    seconds = time.time() - t0
+    progress.update(done, nbytes_out, force=True)
+    sys.stderr.write("\n")
+    logger.info(
+        f"Exported {done} frames to {out_path} in {seconds:.1f} s "
+        f"({done / max(seconds, 1e-9):.1f} fps, {nbytes_out / 1e6:.0f} MB, {workers} workers)"
+    )
+    return done, seconds
+
+
+def parse_crop(value):
+    """x,y,width,height"""
+    if value is None:
+        return None
+    return tuple(int(v) for v in value.split(","))
+
+
+###############################################
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Export a recorded session to images or video",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("session_dir", help="Session folder of any sink")
+    parser.add_argument("out_path", help="Output folder for image formats, output file for video formats")
+    parser.add_argument("-f", "--format", choices=FORMATS, default="png", help="Output format")
+    parser.add_argument("-j", "--workers", type=int, help="Worker processes (default: all cores)")
+    parser.add_argument("--demosaic", choices=list(DEMOSAIC), help="Bayer pattern of raw mono frames")
+    parser.add_argument("--crop", help="x,y,width,height")
+    parser.add_argument("--width", type=int, help="Resize to this width, keeping the aspect ratio")
+    parser.add_argument("--overlay", action="store_true", help="Draw frame id and timestamp")
+    parser.add_argument("--fps", type=float, default=30.0, help="Frame rate of video exports")
+    args = parser.parse_args()
+
+    export_session(
+        args.session_dir, args.out_path, args.format, args.workers, args.demosaic,
+        parse_crop(args.crop), args.width, args.overlay, args.fps,
+    )
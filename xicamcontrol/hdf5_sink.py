@@ -0,0 +1,196 @@
+# hdf5_sink.py
+
+import os, time, zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import logger_tools
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+logger = logger_tools.get_logger(__name__)
+
+METADATA_DTYPE = np.dtype(
+    [
+        ("frame_id", np.uint64),
+        ("timestamp", np.float64),
+        ("host_timestamp", np.float64),
+        ("exposure", np.float64),
+        ("gain", np.float64),
+    ]
+)
+
+
+class HDF5Sink:
+    """
+    Write frames into a chunked, deflate compressed HDF5 dataset.
+
+    Frames are collected into chunks of chunk_frames x chunk_rows, every chunk is
+    compressed with zlib in a thread pool (zlib releases the GIL) and written with
+    write_direct_chunk, so the file stays readable with any HDF5 reader.
+    Per-frame metadata is stored in a parallel structured dataset "metadata".
+
+    save_dir: folder for the xi_frames.h5 file
+    chunk_frames: frames per chunk
+    chunk_rows: image rows per chunk, 0 for the full height
+    compression: zlib level 0-9
+    flush_seconds: interval to flush the file to disk
+    workers: compression threads
+    """
+
+    name = "hdf5"
+
+    def __init__(
+        self, save_dir, chunk_frames=8, chunk_rows=0, compression=4, flush_seconds=5, workers=4
+    ):
+        if h5py is None:
+            raise ImportError("h5py is required for the hdf5 sink. Install it with conda install h5py.")
+
+        self.path = os.path.join(save_dir, "xi_frames.h5")
+        self.chunk_frames = chunk_frames
+        self.chunk_rows = chunk_rows
+        self.compression = compression
+        self.flush_seconds = flush_seconds
+        self.workers = workers
+
+        self.file = h5py.File(self.path, "w")
+        self.frames = None
+        self.metadata = None
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        # chunks being compressed, written in order: (chunk index, buffer, futures, metadata)
+        self.pending = deque()
+        self.free_buffers = []
+        self.buffer = None
+        self.buffer_metadata = None
+        self.buffer_count = 0
+        self.chunk_index = 0
+        self.frame_count = 0
+        self.last_flush = time.time()
+        self.logger = logger_tools.get_logger(self.__class__.__name__)
+        self.logger.info(f"Recording to: {self.path}")
+
+    def _create_datasets(self, data):
+        height, width = data.shape[:2]
+        rows = self.chunk_rows if 0 < self.chunk_rows < height else height
+        self.chunk_shape = (self.chunk_frames, rows) + data.shape[1:]
+        self.frame_shape = data.shape
+        self.dtype = data.dtype
+
+        self.frames = self.file.create_dataset(
+            "frames",
+            shape=(0,) + data.shape,
+            maxshape=(None,) + data.shape,
+            chunks=self.chunk_shape,
+            dtype=data.dtype,
+            compression="gzip",
+            compression_opts=self.compression,
+        )
+        self.metadata = self.file.create_dataset(
+            "metadata", shape=(0,), maxshape=(None,), dtype=METADATA_DTYPE, chunks=(1024,)
+        )
+        self.logger.debug(f"HDF5 chunk shape is {self.chunk_shape}.")
+
+    def _new_buffer(self):
+        if self.free_buffers:
+            return self.free_buffers.pop()
+        return np.zeros((self.chunk_frames,) + self.frame_shape, dtype=self.dtype)
+
+    def _compress(self, block):
+        rows = self.chunk_shape[1]
+        if block.shape[1] < rows:
+            # edge chunks are stored with the full chunk shape
+            padded = np.zeros(self.chunk_shape, dtype=self.dtype)
+            padded[:, : block.shape[1]] = block
+            block = padded
+        return zlib.compress(block.tobytes(), self.compression)
+
+    def _submit_chunk(self):
+        """Hand the current chunk buffer to the compression pool."""
+        rows = self.chunk_shape[1]
+        futures = [
+            self.pool.submit(self._compress, self.buffer[:, r : r + rows])
+            for r in range(0, self.frame_shape[0], rows)
+        ]
+        metadata = self.buffer_metadata[: self.buffer_count].copy()
+        self.pending.append((self.chunk_index, self.buffer, futures, metadata))
+
+        self.chunk_index += 1
+        self.buffer = None
+        self.buffer_count = 0
+
+    def _write_pending(self, max_pending):
+        """
+        Write compressed chunks in order.
+        Blocks on the oldest chunk while more than max_pending chunks are in flight.
+        """
+        while self.pending:
+            chunk_index, buffer, futures, metadata = self.pending[0]
+            if len(self.pending) <= max_pending and not all(f.done() for f in futures):
+                break
+            self.pending.popleft()
+
+            start = chunk_index * self.chunk_frames
+            end = start + len(metadata)
+            if self.frames.shape[0] < end:
+                self.frames.resize(end, axis=0)
+                self.metadata.resize(end, axis=0)
+
+            rows = self.chunk_shape[1]
+            for r, future in zip(range(0, self.frame_shape[0], rows), futures):
+                offset = (start, r) + (0,) * (len(self.frame_shape) - 1)
+                self.frames.id.write_direct_chunk(offset, future.result())
+            self.metadata[start:end] = metadata
+
+            self.free_buffers.append(buffer)
+
+    def write(self, image):
+        data = image.data
+        if self.frames is None:
+            self._create_datasets(data)
+            self.buffer_metadata = np.zeros(self.chunk_frames, dtype=METADATA_DTYPE)
+
+        if self.buffer is None:
+            self.buffer = self._new_buffer()
+
+        self.buffer[self.buffer_count] = data
+        m = image.metadata
+        if m is not None:
+            self.buffer_metadata[self.buffer_count] = (
+                m.frame_id, m.timestamp, m.host_timestamp, m.exposure, m.gain
+            )
+        else:
+            self.buffer_metadata[self.buffer_count] = (0, 0, time.time(), 0, 0)
+        self.last_path = f"xi_frames.h5#{self.frame_count}"
+        self.buffer_count += 1
+        self.frame_count += 1
+
+        if self.buffer_count == self.chunk_frames:
+            self._submit_chunk()
+
+        # bound the memory held by chunks in flight
+        self._write_pending(max_pending=2 * self.workers)
+
+        if time.time() - self.last_flush >= self.flush_seconds:
+            self.file.flush()
+            self.last_flush = time.time()
+
+    def faster(self):
+        """Use the fastest deflate level for the following chunks. Returns a description or None."""
+        if self.compression > 1:
+            self.compression = 1
+            return "hdf5 deflate level 1"
+        return None
+
+    def close(self):
+        if self.buffer is not None and self.buffer_count > 0:
+            # zero the unused part of the last chunk, it lies outside the dataset extent
+            self.buffer[self.buffer_count :] = 0
+            self._submit_chunk()
+        if self.frames is not None:
+            self._write_pending(max_pending=0)
+        self.pool.shutdown()
+        self.file.close()
+        self.logger.info(f"Closed {self.path} with {self.frame_count} frames.")
@@ -0,0 +1,134 @@
+# jpeg_tools.py
+
+import io
+import numpy as np
+import cv2
+import logger_tools
+
+try:
+    from PIL import Image as PilImage
+except ImportError:
+    PilImage = None
+
+try:
+    import turbojpeg
+except ImportError:
+    turbojpeg = None
+
+logger = logger_tools.get_logger(__name__)
+
+
+def to_8bit(data):
+    """Contiguous 8 bit frame, 2D for mono. JPEG is 8 bit, 16 bit frames keep their upper byte."""
+    if data.ndim == 3 and data.shape[2] == 1:
+        data = data[..., 0]
+    if data.dtype != np.uint8:
+        data = (data >> 8).astype(np.uint8)
+    return np.ascontiguousarray(data)
+
+
+class JpegBackend:
+    """
+    Base class for the JPEG encoders of the preview stream.
+    Subclasses implement encode() which returns the JPEG bytes of a BGR or mono frame.
+    Backends must be safe to call from several threads at once.
+    """
+
+    name = ""
+
+    def encode(self, data, quality=95):
+        raise NotImplementedError
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}()"
+
+
+class CvBackend(JpegBackend):
+    """cv2.imencode, always available."""
+
+    name = "cv2"
+
+    def encode(self, data, quality=95):
+        ret, buffer = cv2.imencode(".jpg", data, [cv2.IMWRITE_JPEG_QUALITY, quality])
+        if not ret:
+            raise RuntimeError("JPEG encoding failed.")
+        return buffer.tobytes()
+
+
+class PilBackend(JpegBackend):
+    """Pillow (uses libjpeg-turbo in the conda-forge and pip builds)."""
+
+    name = "pil"
+
+    def __init__(self):
+        if PilImage is None:
+            raise ImportError("Pillow is required for the pil JPEG backend. Install it with conda install pillow.")
+
+    def encode(self, data, quality=95):
+        data = to_8bit(data)
+        height, width = data.shape[:2]
+        if data.ndim == 2:
+            image = PilImage.frombuffer("L", (width, height), data, "raw", "L", 0, 1)
+        else:
+            # reads BGR directly, no channel swap copy
+            image = PilImage.frombuffer("RGB", (width, height), data, "raw", "BGR", 0, 1)
+        buffer = io.BytesIO()
+        image.save(buffer, "JPEG", quality=quality)
+        return buffer.getvalue()
+
+
+class TurboBackend(JpegBackend):
+    """libjpeg-turbo through the PyTurboJPEG bindings, 4:2:0 subsampling like cv2."""
+
+    name = "turbojpeg"
+
+    def __init__(self):
+        if turbojpeg is None:
+            raise ImportError("PyTurboJPEG is required for the turbojpeg backend. Install it with pip install PyTurboJPEG.")
+        self.jpeg = turbojpeg.TurboJPEG()
+
+    def encode(self, data, quality=95):
+        data = to_8bit(data)
+        if data.ndim == 2:
+            return self.jpeg.encode(
+                data[..., None], quality=quality, pixel_format=turbojpeg.TJPF_GRAY, jpeg_subsample=turbojpeg.TJSAMP_GRAY
+            )
+        return self.jpeg.encode(
+            data, quality=quality, pixel_format=turbojpeg.TJPF_BGR, jpeg_subsample=turbojpeg.TJSAMP_420
+        )
+
+
+BACKENDS = {
+    "cv2": CvBackend,
+    "pil": PilBackend,
+    "turbojpeg": TurboBackend,
+}
+
+
+def available_backends():
+    """Names of the backends that can be used here."""
+    names = ["cv2"]
+    if PilImage is not None:
+        names.append("pil")
+    if turbojpeg is not None:
+        try:
+            TurboBackend()
+            names.append("turbojpeg")
+        except (OSError, RuntimeError):
+            # bindings installed, but the libturbojpeg library is missing
+            pass
+    return names
+
+
+def get_backend(name="auto"):
+    """
+    JpegBackend by name, "auto" picks turbojpeg if it is installed, else cv2.
+    raises: ValueError for unknown names, ImportError if the backend is not installed
+    """
+    if name == "auto":
+        name = "turbojpeg" if "turbojpeg" in available_backends() else "cv2"
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown JPEG backend '{name}'. Available: {', '.join(BACKENDS)}")
+    backend = BACKENDS[name]()
+    logger.debug(f"JPEG backend {backend!r}")
+    return backend
@@ -0,0 +1,142 @@
+# metadata_export.py
+
+import os, glob, time, shutil
+import numpy as np
+import logger_tools
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+logger = logger_tools.get_logger(__name__)
+
+METADATA_DTYPE = np.dtype(
+    [
+        ("frame_id", np.uint64),
+        ("timestamp", np.float64),
+        ("host_timestamp", np.float64),
+        ("exposure", np.float64),
+        ("gain", np.float64),
+        ("width", np.uint32),
+        ("height", np.uint32),
+        ("gpi_level", np.uint32),
+    ]
+)
+
+NPZ_FILENAME = "xi_metadata.npz"
+CSV_FILENAME = "xi_metadata.csv"
+PARQUET_FILENAME = "xi_metadata.parquet"
+PARTS_DIRNAME = "xi_metadata_parts"
+
+
+class MetadataRecorder:
+    """
+    Collect the metadata of every saved frame in memory and write it as columns.
+
+    Every batch_size frames or flush_seconds the batch is appended to xi_metadata.csv and
+    stored as a part file. On close the parts are merged into xi_metadata.npz (one array
+    per column) and xi_metadata.parquet when pyarrow is installed.
+    """
+
+    def __init__(self, save_dir, batch_size=10000, flush_seconds=30):
+        self.save_dir = save_dir
+        self.parts_dir = os.path.join(save_dir, PARTS_DIRNAME)
+        os.makedirs(self.parts_dir, exist_ok=True)
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.batch = np.zeros(batch_size, dtype=METADATA_DTYPE)
+        self.count = 0
+        self.parts = 0
+        self.total = 0
+        self.last_flush = time.time()
+        self.csv_file = open(os.path.join(save_dir, CSV_FILENAME), "a")
+        if self.csv_file.tell() == 0:
+            self.csv_file.write(",".join(METADATA_DTYPE.names) + "\n")
+        self.logger = logger_tools.get_logger(self.__class__.__name__)
+
+    def add(self, metadata):
+        if metadata is None:
+            self.batch[self.count] = (0, 0, time.time(), 0, 0, 0, 0, 0)
+        else:
+            self.batch[self.count] = (
+                metadata.frame_id, metadata.timestamp, metadata.host_timestamp,
+                metadata.exposure, metadata.gain, metadata.width, metadata.height,
+                getattr(metadata, "gpi_level", 0),
+            )
+        self.count += 1
+
+        if self.count == self.batch_size or time.time() - self.last_flush >= self.flush_seconds:
+            self.flush()
+
+    def flush(self):
+        self.last_flush = time.time()
+        if self.count == 0:
+            return
+
+        rows = self.batch[: self.count]
+        np.save(os.path.join(self.parts_dir, f"part_{self.parts:06d}.npy"), rows)
+        np.savetxt(self.csv_file, rows, delimiter=",", fmt=["%d", "%.6f", "%.6f", "%.1f", "%.3f", "%d", "%d", "%d"])
+        self.csv_file.flush()
+
+        self.parts += 1
+        self.total += self.count
+        self.count = 0
+
+    def close(self):
+        self.flush()
+        self.csv_file.close()
+
+        write_tables(self.save_dir, read_parts(self.parts_dir))
+        shutil.rmtree(self.parts_dir)
+
+        self.logger.debug(f"Metadata of {self.total} frames written to {self.save_dir}")
+
+
+def write_tables(save_dir, table):
+    """Write the metadata table as xi_metadata.npz, and xi_metadata.parquet when pyarrow is installed."""
+    np.savez(os.path.join(save_dir, NPZ_FILENAME), **{name: table[name] for name in METADATA_DTYPE.names})
+    if pyarrow is not None:
+        arrow_table = pyarrow.table({name: table[name] for name in METADATA_DTYPE.names})
+        pyarrow.parquet.write_table(arrow_table, os.path.join(save_dir, PARQUET_FILENAME))
+
+
+def read_parts(parts_dir, skip_torn=False):
+    """
+    Concatenate the part files of a session.
+    skip_torn: ignore parts that can not be read (cut off by a crash) instead of raising
+    """
+    files = sorted(glob.glob(os.path.join(parts_dir, "part_*.npy")))
+    parts = []
+    for f in files:
+        try:
+            parts.append(np.load(f))
+        except (ValueError, OSError, EOFError):
+            if not skip_torn:
+                raise
+            logger.warning(f"Skipping torn metadata part {f}")
+    if not parts:
+        return np.zeros(0, dtype=METADATA_DTYPE)
+    return np.concatenate(parts)
+
+
+def load_metadata(save_dir, as_dataframe=False):
+    """
+    Load the metadata table of a session.
+    returns: dict of numpy arrays, or a pandas DataFrame if as_dataframe is set
+    Sessions that were not closed cleanly are read from their part files.
+    """
+    npz_path = os.path.join(save_dir, NPZ_FILENAME)
+    if os.path.exists(npz_path):
+        with np.load(npz_path) as npz:
+            columns = {name: npz[name] for name in npz.files}
+    else:
+        table = read_parts(os.path.join(save_dir, PARTS_DIRNAME))
+        columns = {name: table[name] for name in METADATA_DTYPE.names}
+
+    if as_dataframe:
+        import pandas
+
+        return pandas.DataFrame(columns)
+    return columns
@@ -0,0 +1,245 @@
+# metrics.py
+
+import time
+from bisect import bisect_left
+from threading import Lock
+import logger_tools
+
+logger = logger_tools.get_logger(__name__)
+
+# Prometheus text exposition format
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# seconds, from a fast JPEG encode to a stalled disk
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """
+    Base class of the metrics. Updates take the lock of the metric, so request threads and
+    encoder workers can update the same value, and still cost well below a microsecond.
+
+    Labeled metrics hand out one child per label values with labels(), keep the child
+    at hand on hot paths instead of looking it up for every update.
+    """
+
+    type = ""
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.children = {}
+        self.lock = Lock()
+
+    def labels(self, *values):
+        values = tuple(str(v) for v in values)
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(values, self.new_child())
+        return child
+
+    def remove(self, *values):
+        """Drop the child of these label values, e.g. of a client that disconnected."""
+        with self.lock:
+            self.children.pop(tuple(str(v) for v in values), None)
+
+    def new_child(self):
+        raise NotImplementedError
+
+    def samples(self):
+        """returns: list of (suffix, labels dict, value) of an unlabeled metric"""
+        raise NotImplementedError
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        if self.labelnames:
+            items = [(dict(zip(self.labelnames, values)), child) for values, child in list(self.children.items())]
+        else:
+            items = [({}, self)]
+        for labels, metric in items:
+            for suffix, extra, value in metric.samples():
+                pairs = dict(labels, **extra)
+                label_text = ",".join(f'{k}="{_escape(v)}"' for k, v in pairs.items())
+                if label_text:
+                    label_text = "{" + label_text + "}"
+                lines.append(f"{self.name}{suffix}{label_text} {_format(value)}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    """Monotonic count, e.g. frames or bytes."""
+
+    type = "counter"
+
+    def __init__(self, name, help, labelnames=()):
+        Metric.__init__(self, name, help, labelnames)
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def new_child(self):
+        return Counter(self.name, self.help)
+
+    def samples(self):
+        return [("", {}, self.value)]
+
+
+class Gauge(Metric):
+    """
+    Value that goes up and down. With function the value is read when the metrics are
+    scraped, which costs nothing on the hot path, e.g. the length of a queue.
+    """
+
+    type = "gauge"
+
+    def __init__(self, name, help, labelnames=(), function=None):
+        Metric.__init__(self, name, help, labelnames)
+        self.value = 0
+        self.function = function
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        with self.lock:
+            self.value -= amount
+
+    def new_child(self):
+        return Gauge(self.name, self.help)
+
+    def samples(self):
+        if self.function is None:
+            return [("", {}, self.value)]
+        try:
+            return [("", {}, self.function())]
+        except Exception as e:
+            logger.debug(f"Gauge {self.name} not available: {e!r}")
+            return []
+
+
+class Histogram(Metric):
+    """Distribution of observed values, e.g. latencies in seconds, in cumulative buckets."""
+
+    type = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        Metric.__init__(self, name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # per bucket, not cumulative, the last one counts values above all buckets
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        i = bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    def time(self):
+        """Context manager observing the seconds its block takes."""
+        return _Timer(self)
+
+    def new_child(self):
+        return Histogram(self.name, self.help, buckets=self.buckets)
+
+    def samples(self):
+        with self.lock:
+            counts, sum_ = list(self.counts), self.sum
+        samples = []
+        total = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            total += count
+            samples.append(("_bucket", {"le": _format(float(bound))}, total))
+        samples.append(("_sum", {}, sum_))
+        samples.append(("_count", {}, total))
+        return samples
+
+
+class _Timer:
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+class RateMeter:
+    """Events per second over the last interval, e.g. the capture frame rate."""
+
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self.reset()
+
+    def reset(self):
+        self.rate = 0.0
+        self.count = 0
+        self.start = time.monotonic()
+
+    def tick(self):
+        self.count += 1
+        now = time.monotonic()
+        if now - self.start >= self.interval:
+            self.rate = self.count / (now - self.start)
+            self.count = 0
+            self.start = now
+
+
+class Registry:
+    """All metrics of the process, rendered for /metrics."""
+
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        # modules may be imported twice (e.g. as script and module), keep the first metric
+        return self.metrics.setdefault(metric.name, metric)
+
+    def render(self):
+        return "\n".join(metric.render() for metric in list(self.metrics.values())) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def counter(name, help, labelnames=()):
+    return REGISTRY.register(Counter(name, help, labelnames))
+
+
+def gauge(name, help, labelnames=(), function=None):
+    """A gauge, an existing one gets the new function (e.g. of a new camera controller)."""
+    metric = REGISTRY.register(Gauge(name, help, labelnames))
+    if function is not None:
+        metric.function = function
+    return metric
+
+
+def histogram(name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+    return REGISTRY.register(Histogram(name, help, labelnames, buckets))
+
+
+# shared by the capture, save and stream modules
+FRAMES_DROPPED = counter("xicam_frames_dropped_total", "Frames lost or not saved, by reason", ["reason"])
+STAGE_LATENCY = histogram(
+    "xicam_stage_latency_seconds", "Time frames spend in each pipeline stage", ["stage"]
+)
@@ -3,9 +3,12 @@
 import cv2, os, time, datetime
 from threading import Thread
 import logger_tools
+import save_tools
 
 logger = logger_tools.get_logger(__name__)
 
+default_codec = save_tools.PngCodec()
+
 def resize_with_aspect_ratio(image, width):
     """Resize image to a given width keeping the aspect ratio"""
     r = width / image.shape[1]
@@ -23,6 +26,36 @@ def resize_with_percent(image, percent):
     return resized
 
 
+def draw_stats(data, metadata, fps=None):
+    """
+    Copy of a preview frame with frame id, timestamp, gain and exposure drawn in.
+    The frame itself stays untouched, it may be saved or streamed as well.
+    """
+    out = data.copy()
+    text1 = "FrameID:{:d}, Timestamp:{:f} s".format(int(metadata.frame_id), metadata.timestamp)
+    text2 = "Gain:{:5.1f} dB, Exp:{:5.1f} us".format(metadata.gain, metadata.exposure)
+    if fps is not None:
+        text2 += ", {:4.1f} fps".format(fps)
+    cv2.putText(out, text1, (10, 100), cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 2)
+    cv2.putText(out, text2, (10, 150), cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 2)
+    return out
+
+
+class DisplayClock:
+    """Limit preview drawing to the display rate, frames in between are not resized or drawn."""
+
+    def __init__(self, fps=30):
+        self.interval = 1.0 / fps
+        self.next = 0
+
+    def due(self):
+        now = time.monotonic()
+        if now < self.next:
+            return False
+        self.next = now + self.interval
+        return True
+
+
 def wait_with_check_closing(win_name):
     """
     Wait for a key press and check if the window is closed
@@ -56,30 +89,42 @@ def show_image(data, metadata, width=None, percent=None):
     logger.debug("Done.")
 
 
-def save_image(data, metadata, path):
-    """Save the image to disk."""
+def save_image(data, metadata, path, codec=None):
+    """
+    Save a one-off still to disk, named by capture timestamp.
+    Sessions of frames go through session_sink instead.
+    codec is a save_tools.Codec, defaults to PNG with fast compression.
+    """
     logger.debug("Saving image...")
 
-    filename = "xi_" + str(metadata.timestamp) + ".png"
+    if codec is None:
+        codec = default_codec
+
+    timestamp = time.time() if metadata is None else metadata.timestamp
+
+    # fixed width microseconds sort by name, unlike str(float)
+    filename = f"xi_{int(timestamp * 1e6):016d}{codec.extension}"
     filepath = os.path.join(path, filename)
 
-    cv2.imwrite(filepath, data)
+    codec.write(data, filepath)
 
     logger.debug("Image saved: " + filepath)
+    return filepath
 
 
-def stream_video(cam, width=None, percent=None):
+def stream_video(cam, width=None, percent=None, display_fps=30):
     """Show a video stream. Press CTRL+C to exit."""
 
+    clock = DisplayClock(display_fps)
     try:
         logger.info("Starting video. Press CTRL+C to exit.")
 
         while True:
             if cam.capture_thread is not None and cam.capture_thread.is_alive():
                     
-                image = cam.get_image_from_buffer()
+                image = cam.get_image_from_buffer(0.1)
 
-                if image is None or image.data is None:
+                if image is None or image.data is None or not clock.due():
                     continue
 
                 if width is not None:
@@ -89,30 +134,8 @@ def stream_video(cam, width=None, percent=None):
                 else:
                     resized = image.data
 
-                text1 = "FrameID:{:f}, Timestamp:{:f} s".format(
-                    image.metadata.frame_id, image.metadata.timestamp
-                )
-                text2 = "Gain:{:5.1f} dB, Exp:{:5.1f} us".format(
-                    image.metadata.gain, image.metadata.exposure
-                )
-                cv2.putText(
-                    resized,
-                    text1,
-                    (10, 100),
-                    cv2.FONT_HERSHEY_SIMPLEX,
-                    1,
-                    (255, 255, 255),
-                    2,
-                )
-                cv2.putText(
-                    resized,
-                    text2,
-                    (10, 150),
-                    cv2.FONT_HERSHEY_SIMPLEX,
-                    1,
-                    (255, 255, 255),
-                    2,
-                )
+                if image.metadata is not None:
+                    resized = draw_stats(resized, image.metadata, cam.fps_meter.rate)
 
                 cv2.namedWindow("Preview")
                 cv2.imshow("Preview", resized)
@@ -133,18 +156,21 @@ def stream_video(cam, width=None, percent=None):
         cv2.destroyAllWindows()
 
 
-def manual_trigger_preview(cam, width=None, percent=None):
+def manual_trigger_preview(cam, width=None, percent=None, display_fps=30):
     """Show a video stream. Press CTRL+C to exit.
     Intended to use as a Thread target.
     """
     logger.info("Starting Preview. Press CTRL+C to exit.")
+    clock = DisplayClock(display_fps)
 
-    while capture_thread.is_alive():
-        data = capture_thread.data
-        metadata = capture_thread.metadata
+    while cam.capture_thread.is_alive():
+        image = cam.get_image_from_buffer(0.1)
 
-        if data is None:
+        if image is None or image.data is None:
+            continue
+        if not clock.due():
             continue
+        data, metadata = image.data, image.metadata
 
         if width is not None:
             resized = resize_with_aspect_ratio(data, width)
@@ -154,30 +180,7 @@ def manual_trigger_preview(cam, width=None, percent=None):
             resized = data
 
         if metadata is not None:
-            text1 = "FrameID:{:f}, Timestamp:{:f} s".format(
-                metadata.frame_id, metadata.timestamp
-            )
-            text2 = "Gain:{:5.1f} dB, Exp:{:5.1f} us".format(
-                metadata.gain, metadata.exposure
-            )
-            cv2.putText(
-                resized,
-                text1,
-                (10, 100),
-                cv2.FONT_HERSHEY_SIMPLEX,
-                1,
-                (255, 255, 255),
-                2,
-            )
-            cv2.putText(
-                resized,
-                text2,
-                (10, 150),
-                cv2.FONT_HERSHEY_SIMPLEX,
-                1,
-                (255, 255, 255),
-                2,
-            )
+            resized = draw_stats(resized, metadata, cam.fps_meter.rate)
 
         cv2.namedWindow("Preview")
         cv2.imshow("Preview", resized)
@@ -196,42 +199,47 @@ def manual_trigger_preview(cam, width=None, percent=None):
     logger.debug("Manual trigger thread has finished.")
 
 
-def manual_trigger_save(capture_thread, path):
-    """Save the image to disk.
-    Intended to use as a Thread target.
+def session_sink(path, codec=None, config=None):
+    """
+    Create a timestamped session folder in path with an images sink,
+    files named by frame id in shard folders plus the manifest.
     """
-    logger.info("Saving images.")
-
     save_dir = os.path.join(path, datetime.datetime.now().strftime("%Y-%m-%d-%H-%M-%S"))
     os.makedirs(save_dir)
     logger.info("Using folder: " + os.path.abspath(save_dir))
 
-    last_timestamp = time.time()
+    return save_tools.create_sink(config or {}, save_dir, codec, "images")
 
-    while capture_thread.is_alive():
-        data = capture_thread.data
-        metadata = capture_thread.metadata
 
-        if data is not None and metadata is not None:
-            timestamp = metadata.timestamp
+def manual_trigger_save(cam, path, codec=None, config=None):
+    """Save the image to disk.
+    Intended to use as a Thread target.
+    """
+    logger.info("Saving images.")
+
+    sink = session_sink(path, codec, config)
+    last_timestamp = None
 
-            if last_timestamp != timestamp:
-                last_timestamp = timestamp
+    try:
+        while cam.capture_thread.is_alive():
+            image = cam.get_image_from_buffer(0.1)
 
-                filename = "xi_" + str(timestamp) + ".png"
-                filepath = os.path.join(save_dir, filename)
-                cv2.imwrite(filepath, data)
+            if image is not None and image.data is not None and image.metadata is not None:
+                timestamp = image.metadata.timestamp
 
-                logger.debug("Saved to: " + filepath)
-        else:
-            # logger.warning("No image available.")
-            pass
+                if last_timestamp != timestamp:
+                    last_timestamp = timestamp
+                    sink.write(image)
+            else:
+                # logger.warning("No image available.")
+                pass
+    finally:
+        sink.close()
 
-    capture_thread.stop()
     logger.debug("Manual trigger thread has finished.")
 
 
-def capture_with_timer(capture_thread, interval, path, percent=None):
+def capture_with_timer(cam, interval, path, percent=None, codec=None, config=None):
     """Save the image to disk.
     Intended to use as a Thread target.
     """
@@ -239,84 +247,69 @@ def capture_with_timer(capture_thread, interval, path, percent=None):
         f"Capturing and saving images with {interval} second interval. Press CTRL+C to exit."
     )
 
-    save_dir = os.path.join(path, datetime.datetime.now().strftime("%Y-%m-%d-%H-%M-%S"))
-    os.makedirs(save_dir)
-    logger.info("Using folder: " + os.path.abspath(save_dir))
-
+    sink = session_sink(path, codec, config)
     s_time = time.time()
+    image = None
 
-    while capture_thread.is_alive():
-        n_time = time.time()
-        if n_time - s_time < interval:
-            continue
-        s_time = n_time
-
-        data = capture_thread.data
-        metadata = capture_thread.metadata
+    try:
+        while cam.capture_thread.is_alive():
+            # keep the buffer empty, only the newest frame is saved
+            newest = cam.get_image_from_buffer(0.05)
+            if newest is not None and newest.data is not None:
+                image = newest
+
+            n_time = time.time()
+            if image is None or n_time - s_time < interval:
+                continue
+            s_time = n_time
+
+            data, metadata = image.data, image.metadata
+            sink.write(image)
+            image = None
+
+            if percent is not None:
+                resized = resize_with_percent(data, percent)
+            else:
+                resized = data
 
-        if data is None:
-            continue
+            if metadata is not None:
+                resized = draw_stats(resized, metadata)
 
-        if metadata is None:
-            timestamp = time.time()
-        else:
-            timestamp = metadata.timestamp
+            cv2.namedWindow("Preview")
+            cv2.imshow("Preview", resized)
 
-        filename = "xi_" + str(timestamp) + ".png"
-        filepath = os.path.join(save_dir, filename)
-        cv2.imwrite(filepath, data)
+            # if cv2.waitKey(1) == ord("q"):
+            #     break
 
-        logger.debug("Saved to: " + filepath)
+            keyCode = cv2.waitKey(1)
+            if keyCode != -1:
+                break
+            win_prop = cv2.getWindowProperty("Preview", cv2.WND_PROP_VISIBLE)
+            if win_prop <= 0:
+                break
+    finally:
+        sink.close()
 
-        if percent is not None:
-            resized = resize_with_percent(data, percent)
-        else:
-            resized = data
+    cv2.destroyAllWindows()
+    logger.debug("Interval trigger thread has finished.")
 
-        if metadata is not None:
-            text1 = "FrameID:{:f}, Timestamp:{:f} s".format(
-                metadata.frame_id, metadata.timestamp
-            )
-            text2 = "Gain:{:5.1f} dB, Exp:{:5.1f} us".format(
-                metadata.gain, metadata.exposure
-            )
-            cv2.putText(
-                resized,
-                text1,
-                (10, 100),
-                cv2.FONT_HERSHEY_SIMPLEX,
-                1,
-                (255, 255, 255),
-                2,
-            )
-            cv2.putText(
-                resized,
-                text2,
-                (10, 150),
-                cv2.FONT_HERSHEY_SIMPLEX,
-                1,
-                (255, 255, 255),
-                2,
-            )
 
-        cv2.namedWindow("Preview")
-        cv2.imshow("Preview", resized)
+def record_stream(cam, sink, stop_event):
+    """
+    Feed every captured frame to a sink until the stop event is set.
+    sink is a save_tools.SinkThread. Press CTRL+C to exit.
+    """
+    logger.info("Recording. Press CTRL+C to exit.")
 
-        # if cv2.waitKey(1) == ord("q"):
-        #     break
+    while not stop_event.is_set():
+        image = cam.get_image_from_buffer(0.1)
 
-        keyCode = cv2.waitKey(1)
-        if keyCode != -1:
-            break
-        win_prop = cv2.getWindowProperty("Preview", cv2.WND_PROP_VISIBLE)
-        if win_prop <= 0:
-            break
+        if image is None or image.data is None:
+            continue
 
-    if capture_thread.is_alive():
-        capture_thread.stop()
+        sink.put(image)
 
-    cv2.destroyAllWindows()
-    logger.debug("Interval trigger thread has finished.")
+    logger.debug("Recording has finished.")
 
 
 class CaptureThreadWebCam(Thread):
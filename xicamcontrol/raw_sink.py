@@ -0,0 +1,324 @@
+# raw_sink.py
+
+import os, csv, time, mmap, struct, zlib
+import numpy as np
+import logger_tools
+
+logger = logger_tools.get_logger(__name__)
+
+DATA_FILENAME = "xi_raw.bin"
+INDEX_FILENAME = "xi_raw.csv"
+INDEX_HEADER = [
+    "index", "offset", "nbytes", "shape", "dtype",
+    "frame_id", "timestamp", "host_timestamp", "exposure", "gain",
+]
+
+# Every frame in the data file is preceded by a fixed size record header, so the
+# index can be rebuilt from the data file alone after a crash, see recover_raw().
+RECORD_MAGIC = b"XIFR"
+RECORD_HEADER_SIZE = 128
+# magic, header size, seq, payload bytes, crc32 (0 if disabled), dtype, ndim, shape[3],
+# frame_id, timestamp, host_timestamp, exposure, gain
+RECORD_HEADER = struct.Struct("<4sIQQI4sB3IQdddd")
+
+
+# O_DIRECT needs file offsets, lengths and buffer addresses aligned to the logical block size
+ALIGNMENT = 4096
+
+
+class BufferedFile:
+    """Append to a file through the page cache."""
+
+    direct = False
+
+    def __init__(self, path):
+        self.file = open(path, "ab")
+
+    def tell(self):
+        return self.file.tell()
+
+    def write(self, data):
+        return self.file.write(data)
+
+    def flush(self):
+        self.file.flush()
+
+    def fsync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+
+class DirectFile:
+    """
+    Append to a file with O_DIRECT, bypassing the page cache.
+
+    Data is staged in a preallocated, page aligned buffer (an anonymous mmap) and written
+    in aligned blocks of buffer_mb. On close the last partial block is written padded
+    and the file is truncated back to its real length, fsync() does the same with the tail
+    without truncating.
+    Opening raises OSError if the file system does not support O_DIRECT.
+    """
+
+    direct = True
+
+    def __init__(self, path, buffer_mb=16):
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        if size % ALIGNMENT != 0:
+            raise OSError(f"{path} length is not a multiple of {ALIGNMENT}, can not append with O_DIRECT.")
+
+        self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_DIRECT, 0o644)
+        os.lseek(self.fd, size, os.SEEK_SET)
+        self.length = size
+
+        buffer_size = max(1, int(buffer_mb * 1e6) // ALIGNMENT) * ALIGNMENT
+        self.mmap = mmap.mmap(-1, buffer_size)
+        self.buffer = np.frombuffer(self.mmap, dtype=np.uint8)
+        self.fill = 0
+
+    def _write_blocks(self, nbytes):
+        """Write the first nbytes (a multiple of ALIGNMENT) of the staging buffer."""
+        view = memoryview(self.mmap)[:nbytes]
+        written = 0
+        while written < nbytes:
+            written += os.write(self.fd, view[written:])
+        view.release()
+
+    def tell(self):
+        return self.length
+
+    def write(self, data):
+        src = np.frombuffer(data, dtype=np.uint8)
+        pos = 0
+        while pos < src.size:
+            n = min(src.size - pos, self.buffer.size - self.fill)
+            self.buffer[self.fill : self.fill + n] = src[pos : pos + n]
+            self.fill += n
+            pos += n
+            if self.fill == self.buffer.size:
+                self._write_blocks(self.fill)
+                self.fill = 0
+        self.length += src.size
+        return src.size
+
+    def flush(self):
+        """Write all complete blocks, keep the partial tail in the buffer."""
+        aligned = self.fill - self.fill % ALIGNMENT
+        if aligned == 0:
+            return
+        self._write_blocks(aligned)
+        tail = self.fill - aligned
+        # the file position stays aligned, the tail goes out with the next block
+        self.buffer[:tail] = self.buffer[aligned : self.fill]
+        self.fill = tail
+
+    def fsync(self):
+        """
+        Make all data written so far durable. The partial tail block is written zero padded
+        and the file position goes back to its start, so the next flush writes it again.
+        """
+        self.flush()
+        if self.fill > 0:
+            self.buffer[self.fill : ALIGNMENT] = 0
+            self._write_blocks(ALIGNMENT)
+            os.lseek(self.fd, -ALIGNMENT, os.SEEK_CUR)
+        os.fdatasync(self.fd)
+
+    def close(self):
+        if self.fill > 0:
+            padded = -(-self.fill // ALIGNMENT) * ALIGNMENT
+            self.buffer[self.fill : padded] = 0
+            self._write_blocks(padded)
+            os.ftruncate(self.fd, self.length)
+        os.close(self.fd)
+        del self.buffer
+        self.mmap.close()
+
+
+FSYNC_POLICIES = ["none", "frames", "seconds"]
+
+
+class RawSink:
+    """
+    Append the raw pixel data of every frame to a single file, without any encoding.
+    A csv index stores offset, shape, dtype and metadata of each frame, see read_raw().
+    This is the cheapest sink on CPU, at the cost of disk space.
+
+    Each frame is stored as a record header followed by the pixel data, the index is
+    only a cache of the headers and can be rebuilt with recover_raw() after a crash.
+
+    direct: write with O_DIRECT from aligned buffers, so recordings do not fill the page cache
+    fsync: durability policy, "none", "frames" (every fsync_frames frames) or "seconds" (every fsync_seconds)
+    checksum: store a crc32 of every frame, lets recovery detect corrupted data after power loss
+    """
+
+    name = "raw"
+
+    def __init__(
+        self, save_dir, direct=False, fsync="none", fsync_frames=100, fsync_seconds=1.0,
+        buffer_mb=16, checksum=False,
+    ):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"Unknown fsync policy '{fsync}'. Available: {', '.join(FSYNC_POLICIES)}")
+
+        self.logger = logger_tools.get_logger(self.__class__.__name__)
+        self.data_path = os.path.join(save_dir, DATA_FILENAME)
+        self.data_file = None
+        if direct:
+            try:
+                self.data_file = DirectFile(self.data_path, buffer_mb)
+            except (OSError, AttributeError) as e:
+                # AttributeError: no os.O_DIRECT on this platform
+                self.logger.warning(f"O_DIRECT not available ({e}), using buffered writes.")
+        if self.data_file is None:
+            self.data_file = BufferedFile(self.data_path)
+
+        self.offset = self.data_file.tell()
+        index_path = os.path.join(save_dir, INDEX_FILENAME)
+        self.count = 0
+        if self.offset > 0 and os.path.exists(index_path):
+            with open(index_path) as f:
+                self.count = sum(1 for line in f) - 1
+        self.index_file = open(index_path, "a", newline="")
+        self.index = csv.writer(self.index_file)
+        if self.index_file.tell() == 0:
+            self.index.writerow(INDEX_HEADER)
+        self.checksum = checksum
+        self.header = bytearray(RECORD_HEADER_SIZE)
+        self.fsync = fsync
+        self.fsync_frames = fsync_frames
+        self.fsync_seconds = fsync_seconds
+        self.last_fsync = time.time()
+        mode = "O_DIRECT" if self.data_file.direct else "buffered"
+        self.logger.info(f"Recording raw frames to: {self.data_path} ({mode}, fsync {fsync})")
+
+    def write(self, image):
+        data = np.ascontiguousarray(image.data)
+        m = image.metadata
+        if m is not None:
+            meta = [m.frame_id, m.timestamp, m.host_timestamp, m.exposure, m.gain]
+        else:
+            meta = [0, 0.0, time.time(), 0.0, 0.0]
+
+        shape = data.shape + (0,) * (3 - data.ndim)
+        crc = zlib.crc32(data) if self.checksum else 0
+        RECORD_HEADER.pack_into(
+            self.header, 0, RECORD_MAGIC, RECORD_HEADER_SIZE, self.count, data.nbytes, crc,
+            data.dtype.str.encode(), data.ndim, *shape, *meta
+        )
+        self.data_file.write(self.header)
+        nbytes = self.data_file.write(data.data)
+        payload_offset = self.offset + RECORD_HEADER_SIZE
+
+        shape = "x".join(str(v) for v in data.shape)
+        self.index.writerow([self.count, payload_offset, nbytes, shape, data.dtype.str] + meta)
+        self.last_path = f"{DATA_FILENAME}#{payload_offset}"
+
+        self.offset = payload_offset + nbytes
+        self.count += 1
+
+        if self.fsync == "frames" and self.count % self.fsync_frames == 0:
+            self.sync()
+        elif self.fsync == "seconds" and time.time() - self.last_fsync >= self.fsync_seconds:
+            self.sync()
+
+        return nbytes
+
+    def sync(self):
+        """Make the frames written so far durable, data first, then the index."""
+        self.data_file.fsync()
+        self.index_file.flush()
+        os.fsync(self.index_file.fileno())
+        self.last_fsync = time.time()
+
+    def close(self):
+        if self.fsync != "none":
+            self.sync()
+        self.data_file.close()
+        self.index_file.close()
+
+
+def read_raw(save_dir):
+    """
+    Iterate over the frames of a raw recording.
+    yields: (numpy array, dict with the index row)
+    """
+    data = np.memmap(os.path.join(save_dir, DATA_FILENAME), dtype=np.uint8, mode="r")
+    with open(os.path.join(save_dir, INDEX_FILENAME), newline="") as f:
+        for row in csv.DictReader(f):
+            offset, nbytes = int(row["offset"]), int(row["nbytes"])
+            shape = tuple(int(v) for v in row["shape"].split("x"))
+            frame = data[offset : offset + nbytes].view(np.dtype(row["dtype"])).reshape(shape)
+            yield frame, row
+
+
+def scan_raw(path, verify=False):
+    """
+    Walk the record headers of a raw data file, reading only the headers unless verify is set.
+    Stops at the first record that is incomplete, has a bad header or (with verify) a bad crc.
+    returns: (list of index rows, end offset of the last valid record)
+    """
+    size = os.path.getsize(path)
+    rows = []
+    offset = 0
+
+    with open(path, "rb") as f:
+        while offset + RECORD_HEADER_SIZE <= size:
+            f.seek(offset)
+            fields = RECORD_HEADER.unpack_from(f.read(RECORD_HEADER_SIZE))
+            magic, header_size, seq, nbytes, crc, dtype, ndim = fields[:7]
+            shape = fields[7 : 7 + ndim]
+            frame_id, timestamp, host_timestamp, exposure, gain = fields[10:]
+
+            if magic != RECORD_MAGIC or header_size != RECORD_HEADER_SIZE:
+                break
+            payload_offset = offset + RECORD_HEADER_SIZE
+            if payload_offset + nbytes > size:
+                break
+            if verify and crc != 0 and zlib.crc32(f.read(nbytes)) != crc:
+                break
+
+            rows.append([
+                len(rows), payload_offset, nbytes, "x".join(str(v) for v in shape),
+                dtype.rstrip(b"\0").decode(), frame_id, timestamp, host_timestamp, exposure, gain,
+            ])
+            offset = payload_offset + nbytes
+
+    return rows, offset
+
+
+def recover_raw(save_dir, verify=False):
+    """
+    Make a raw recording consistent after a crash: rebuild the index from the record
+    headers and truncate a torn frame at the end of the data file.
+    Runs in time linear in the number of frames (in the data size with verify).
+    returns: (number of frames, number of bytes truncated)
+    """
+    data_path = os.path.join(save_dir, DATA_FILENAME)
+    with open(data_path, "rb") as f:
+        magic = f.read(len(RECORD_MAGIC))
+    if magic and magic != RECORD_MAGIC:
+        raise ValueError(f"{data_path} has no record headers, it was written by an older version.")
+
+    rows, end = scan_raw(data_path, verify)
+
+    truncated = os.path.getsize(data_path) - end
+    if truncated > 0:
+        with open(data_path, "r+b") as f:
+            f.truncate(end)
+
+    # replace the index atomically, a crash during recovery leaves the old one
+    index_path = os.path.join(save_dir, INDEX_FILENAME)
+    tmp_path = index_path + ".tmp"
+    with open(tmp_path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(INDEX_HEADER)
+        writer.writerows(rows)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, index_path)
+
+    logger.info(f"Recovered {len(rows)} frames in {save_dir}, truncated {truncated} bytes.")
+    return len(rows), truncated
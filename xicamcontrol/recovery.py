@@ -0,0 +1,230 @@
+# recovery.py
+
+import os, sys, re, csv, json, time, random, signal, argparse, tempfile, subprocess
+import numpy as np
+import logger_tools
+import save_tools
+import raw_sink
+import metadata_export
+
+logger = logger_tools.get_logger(__name__)
+
+SHARD_NAME = re.compile(r"^\d{6}$")
+FRAME_NAME = re.compile(r"^xi_(\d{10})\.\w+$")
+
+
+def recover_images(save_dir):
+    """
+    Make an image session consistent after a crash: remove half written temporary files,
+    drop a torn last manifest row and add frames that were saved but not yet listed.
+    returns: (number of frames, number of frames added to the manifest)
+    """
+    manifest_path = os.path.join(save_dir, "xi_manifest.csv")
+    rows = []
+    if os.path.exists(manifest_path):
+        with open(manifest_path, newline="") as f:
+            text = f.read()
+        if not text.endswith("\n"):
+            # the last row was cut off, the frame is picked up again from its file below
+            text = text[: text.rfind("\n") + 1]
+        rows = list(csv.reader(text.splitlines()))[1:]
+
+    listed = {row[5] for row in rows}
+    added = 0
+    for shard in sorted(os.scandir(save_dir), key=lambda e: e.name):
+        if not (shard.is_dir() and SHARD_NAME.match(shard.name)):
+            continue
+        for entry in os.scandir(shard.path):
+            if entry.name.endswith(save_tools.TMP_SUFFIX):
+                os.remove(entry.path)
+                continue
+            match = FRAME_NAME.match(entry.name)
+            relpath = os.path.join(shard.name, entry.name)
+            if match is None or relpath in listed:
+                continue
+            stat = entry.stat()
+            # camera metadata of unlisted frames is lost, the file time stands in for the host time
+            rows.append([int(match.group(1)), "", stat.st_mtime, "", "", relpath, stat.st_size])
+            added += 1
+
+    rows.sort(key=lambda row: int(row[0]))
+    tmp_path = manifest_path + save_tools.TMP_SUFFIX
+    with open(tmp_path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(save_tools.Manifest.HEADER)
+        writer.writerows(rows)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, manifest_path)
+
+    logger.info(f"Recovered {len(rows)} frames in {save_dir}, {added} added to the manifest.")
+    return len(rows), added
+
+
+def recover_metadata(save_dir):
+    """Merge the metadata parts of a session that was not closed. returns: number of rows"""
+    parts_dir = os.path.join(save_dir, metadata_export.PARTS_DIRNAME)
+    table = metadata_export.read_parts(parts_dir, skip_torn=True)
+    metadata_export.write_tables(save_dir, table)
+    return len(table)
+
+
+def mark_recovered(save_dir, **details):
+    """Record the recovery in xi_session.json."""
+    path = os.path.join(save_dir, "xi_session.json")
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        data = {"events": []}
+    data["recovered"] = time.time()
+    data.setdefault("events", []).append(dict(details, time=time.time(), event="recovered"))
+    # replace atomically, a crash now must not cost the session log
+    tmp_path = path + save_tools.TMP_SUFFIX
+    with open(tmp_path, "w") as f:
+        json.dump(data, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def recover_session(save_dir, verify=False):
+    """
+    Recover a session folder after a crash or power loss.
+    Raw recordings and image sessions are repaired, metadata parts are merged.
+    verify: check the crc32 of every raw frame (when it was recorded with RAW_CHECKSUM)
+    returns: dict with the recovery results
+    """
+    results = {}
+    if os.path.exists(os.path.join(save_dir, raw_sink.DATA_FILENAME)):
+        results["raw_frames"], results["raw_truncated_bytes"] = raw_sink.recover_raw(save_dir, verify)
+    if os.path.exists(os.path.join(save_dir, "xi_manifest.csv")) or any(
+        SHARD_NAME.match(name) for name in os.listdir(save_dir)
+    ):
+        results["image_frames"], results["manifest_added"] = recover_images(save_dir)
+    if os.path.isdir(os.path.join(save_dir, metadata_export.PARTS_DIRNAME)) and not os.path.exists(
+        os.path.join(save_dir, metadata_export.NPZ_FILENAME)
+    ):
+        results["metadata_rows"] = recover_metadata(save_dir)
+
+    if results:
+        mark_recovered(save_dir, **results)
+    else:
+        logger.info(f"Nothing to recover in {save_dir}")
+    return results
+
+
+########################################################################
+# crash test
+
+
+def test_frame(seq, shape):
+    """Frame content the crash test writer uses, so recovered frames can be verified."""
+    return np.full(shape, seq % 251, dtype=np.uint8)
+
+
+def run_writer(save_dir, sink, direct, shape):
+    """Write test frames until killed."""
+    import benchmark
+
+    if sink == "raw":
+        target = raw_sink.RawSink(save_dir, direct=direct, checksum=True, buffer_mb=1)
+    else:
+        target = save_tools.ImageFileSink(save_dir, save_tools.NpyCodec(), shard_size=100, manifest_batch=16)
+    recorder = metadata_export.MetadataRecorder(save_dir, batch_size=50)
+    seq = 0
+    while True:
+        image = benchmark.BenchImage(test_frame(seq, shape), seq)
+        target.write(image)
+        recorder.add(image.metadata)
+        seq += 1
+
+
+def verify_session(save_dir, sink, shape):
+    """Check that every frame listed after recovery is complete and in order. returns: frame count"""
+    frame_ids = []
+    if sink == "raw":
+        for frame, row in raw_sink.read_raw(save_dir):
+            frame_ids.append(int(row["frame_id"]))
+            if frame.shape != shape or not (frame == frame_ids[-1] % 251).all():
+                raise AssertionError(f"Raw frame {row['frame_id']} has wrong content")
+    else:
+        for row in save_tools.read_manifest(save_dir):
+            frame_ids.append(int(row["frame_id"]))
+            frame = np.load(os.path.join(save_dir, row["path"]))
+            if frame.shape != shape or not (frame == frame_ids[-1] % 251).all():
+                raise AssertionError(f"Image {row['path']} has wrong content")
+            if int(row["bytes"]) != os.path.getsize(os.path.join(save_dir, row["path"])):
+                raise AssertionError(f"Image {row['path']} size does not match the manifest")
+
+    if frame_ids != list(range(len(frame_ids))):
+        raise AssertionError("Recovered frames are not contiguous")
+
+    # metadata may also list frames that were still in the O_DIRECT staging buffer
+    metadata = metadata_export.load_metadata(save_dir)
+    if list(metadata["frame_id"]) != list(range(len(metadata["frame_id"]))):
+        raise AssertionError("Recovered metadata is not contiguous")
+    return len(frame_ids)
+
+
+def crash_test(runs=20, sink="raw", direct=False, max_seconds=1.5, shape=(480, 640)):
+    """
+    Kill a writer process at random points, recover its session and verify it.
+    returns: number of failed runs
+    """
+    failures = 0
+    for run in range(runs):
+        with tempfile.TemporaryDirectory() as save_dir:
+            command = [sys.executable, os.path.abspath(__file__), "writer", save_dir, "--sink", sink]
+            if direct:
+                command.append("--direct")
+            writer = subprocess.Popen(command)
+            time.sleep(random.uniform(0.2, max_seconds))
+            writer.send_signal(signal.SIGKILL)
+            writer.wait()
+
+            try:
+                results = recover_session(save_dir, verify=True)
+                frames = verify_session(save_dir, sink, shape)
+                print(f"run {run}: {frames} frames ok, {results}")
+            except Exception as e:
+                failures += 1
+                print(f"run {run}: FAILED, {e!r}")
+
+    print(f"{runs - failures}/{runs} runs recovered consistently")
+    return failures
+
+
+###############################################
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Recover session folders after a crash",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    recover_parser = subparsers.add_parser("recover", help="Repair session folders")
+    recover_parser.add_argument("session_dirs", nargs="+")
+    recover_parser.add_argument("--verify", help="Check raw frame checksums", action="store_true")
+
+    test_parser = subparsers.add_parser("crashtest", help="Kill a writer at random points and verify recovery")
+    test_parser.add_argument("--runs", type=int, default=20)
+    test_parser.add_argument("--sink", choices=["raw", "images"], default="raw")
+    test_parser.add_argument("--direct", help="Raw sink with O_DIRECT", action="store_true")
+    test_parser.add_argument("--max-seconds", type=float, default=1.5, help="Latest kill time")
+
+    # used by crashtest
+    writer_parser = subparsers.add_parser("writer")
+    writer_parser.add_argument("save_dir")
+    writer_parser.add_argument("--sink", choices=["raw", "images"], default="raw")
+    writer_parser.add_argument("--direct", action="store_true")
+
+    args = parser.parse_args()
+
+    if args.command == "recover":
+        for session_dir in args.session_dirs:
+            print(session_dir, recover_session(session_dir, args.verify))
+    elif args.command == "crashtest":
+        sys.exit(1 if crash_test(args.runs, args.sink, args.direct, args.max_seconds) else 0)
+    elif args.command == "writer":
+        run_writer(args.save_dir, args.sink, args.direct, (480, 640))
@@ -0,0 +1,239 @@
+# ring_recorder.py
+
+import os, sys, time, queue, datetime
+from threading import Thread, Lock
+import numpy as np
+import logger_tools
+import save_tools
+import ximea_camera as xi_cam
+
+logger = logger_tools.get_logger(__name__)
+
+
+class RingRecorder:
+    """
+    Keep the most recent frames in a preallocated in-memory ring buffer.
+    On trigger() the frames from pre_seconds before to post_seconds after the event
+    are written to disk by a DumpThread, while capture keeps filling the ring.
+    GPI edges seen by the capture thread are handed to a trigger thread, so the capture
+    thread never touches the disk and trigger failures never reach it.
+
+    ram_mb: memory budget of the ring, the capacity in frames follows from the frame size
+    make_sink: function creating the sink for a dump folder
+    gpi_trigger: trigger on rising edges of the gpi level at exposure start
+    """
+
+    def __init__(self, save_dir, make_sink, ram_mb=2048, pre_seconds=5, post_seconds=5, gpi_trigger=True):
+        self.save_dir = save_dir
+        self.make_sink = make_sink
+        self.ram_bytes = ram_mb * 1e6
+        self.pre_seconds = pre_seconds
+        self.post_seconds = post_seconds
+        self.gpi_trigger = gpi_trigger
+
+        self.buffer = None
+        self.capacity = 0
+        self.frame_shape = None
+        self.slot_seq = None
+        self.slot_time = None
+        self.slot_metadata = None
+        self.seq = 0
+        self.last_gpi = 0
+        self.events = 0
+        self.dumps = []
+        self.lock = Lock()
+        # (source, event time) of triggers from the capture thread, None stops the trigger thread
+        self.pending = queue.Queue()
+        self.logger = logger_tools.get_logger(self.__class__.__name__)
+        self.trigger_thread = Thread(target=self.run_triggers, daemon=True)
+        self.trigger_thread.start()
+
+    def _allocate(self, data):
+        self.capacity = max(2, int(self.ram_bytes // data.nbytes))
+        self.frame_shape = data.shape
+        self.buffer = np.empty((self.capacity,) + data.shape, dtype=data.dtype)
+        # seq of the frame held by each slot, -1 while empty or being written
+        self.slot_seq = np.full(self.capacity, -1, dtype=np.int64)
+        self.slot_time = np.zeros(self.capacity, dtype=np.float64)
+        self.slot_metadata = [None] * self.capacity
+        self.logger.info(
+            f"Ring buffer holds {self.capacity} frames ({self.buffer.nbytes / 1e6:.0f} MB)."
+        )
+
+    def add(self, image):
+        """Copy a frame into the ring. Called from the capture thread, never blocks on disk."""
+        data = image.data
+        if self.buffer is None:
+            self._allocate(data)
+        elif data.shape != self.frame_shape:
+            self.logger.warning(f"Frame shape changed to {data.shape}, frame not kept in ring.")
+            return
+
+        slot = self.seq % self.capacity
+        with self.lock:
+            self.slot_seq[slot] = -1
+        np.copyto(self.buffer[slot], data)
+
+        metadata = image.metadata
+        with self.lock:
+            self.slot_seq[slot] = self.seq
+            self.slot_time[slot] = time.time() if metadata is None else metadata.host_timestamp
+            self.slot_metadata[slot] = metadata
+            self.seq += 1
+
+        if self.gpi_trigger and metadata is not None:
+            level = getattr(metadata, "gpi_level", 0)
+            if level and not self.last_gpi:
+                self.pending.put(("gpi", metadata.host_timestamp))
+            self.last_gpi = level
+
+    def run_triggers(self):
+        """Trigger thread, runs the triggers queued by the capture thread."""
+        while True:
+            item = self.pending.get()
+            if item is None:
+                return
+            try:
+                self.trigger(*item)
+            except Exception as e:
+                self.logger.error(f"Trigger from {item[0]} failed: {e!r}")
+
+    def read(self, seq, out):
+        """
+        Copy frame seq into out.
+        returns: (metadata, host timestamp) or None if the frame was already overwritten
+        """
+        slot = seq % self.capacity
+        with self.lock:
+            if self.slot_seq[slot] != seq:
+                return None
+            metadata = self.slot_metadata[slot]
+            host_time = self.slot_time[slot]
+
+        np.copyto(out, self.buffer[slot])
+
+        # the capture thread may have reused the slot while copying
+        with self.lock:
+            if self.slot_seq[slot] != seq:
+                return None
+        return metadata, host_time
+
+    def first_seq_since(self, since):
+        """Oldest frame seq in the ring captured at or after since."""
+        with self.lock:
+            valid = self.slot_seq >= 0
+            if not valid.any():
+                return self.seq
+            candidates = self.slot_seq[valid & (self.slot_time >= since)]
+            oldest = self.slot_seq[valid].min()
+        if candidates.size == 0:
+            return self.seq
+        first = int(candidates.min())
+        if first == oldest:
+            self.logger.warning("Ring buffer is shorter than the pre-event time.")
+        return first
+
+    def trigger(self, source="api", event_time=None):
+        """
+        Dump the frames around event_time (default now) to disk in the background.
+        returns: the dump folder, None if the trigger was ignored or failed
+        """
+        if self.buffer is None:
+            self.logger.warning("Trigger ignored, no frames in the ring yet.")
+            return None
+
+        event_time = time.time() if event_time is None else event_time
+        with self.lock:
+            self.events += 1
+            number = self.events
+        folder = os.path.join(
+            self.save_dir,
+            f"event_{number:04d}_" + datetime.datetime.fromtimestamp(event_time).strftime("%Y-%m-%d-%H-%M-%S"),
+        )
+        try:
+            os.makedirs(folder)
+            dump = DumpThread(self, event_time, folder, source)
+            dump.start()
+        except (OSError, RuntimeError) as e:
+            # e.g. disk full or no permission, the ring keeps running for the next event
+            self.logger.error(f"Trigger from {source} failed, no dump: {e!r}")
+            return None
+        self.logger.info(f"Trigger from {source}, dumping to {folder}")
+
+        with self.lock:
+            self.dumps = [d for d in self.dumps if d.is_alive()] + [dump]
+        return folder
+
+    def close(self):
+        """Run the queued triggers and wait for running dumps to finish."""
+        self.pending.put(None)
+        self.trigger_thread.join()
+        with self.lock:
+            dumps, self.dumps = self.dumps, []
+        for dump in dumps:
+            dump.join()
+
+
+class DumpThread(Thread):
+    """Write the frames of one event from the ring buffer to a sink."""
+
+    def __init__(self, ring, event_time, folder, source):
+        Thread.__init__(self, daemon=True)
+        self.ring = ring
+        self.event_time = event_time
+        self.folder = folder
+        self.source = source
+        self.logger = logger_tools.get_logger(self.__class__.__name__)
+
+    def run(self):
+        ring = self.ring
+        sink = ring.make_sink(self.folder)
+        out = np.empty(ring.frame_shape, dtype=ring.buffer.dtype)
+        end_time = self.event_time + ring.post_seconds
+        seq = ring.first_seq_since(self.event_time - ring.pre_seconds)
+        written = 0
+        lost = 0
+
+        while True:
+            if seq < ring.seq:
+                result = ring.read(seq, out)
+                seq += 1
+                if result is None:
+                    lost += 1
+                    continue
+                metadata, host_time = result
+                if host_time > end_time:
+                    break
+                sink.write(xi_cam.Image(out, metadata))
+                written += 1
+            elif time.time() > end_time + 1:
+                # capture stopped or stalled after the event
+                break
+            else:
+                time.sleep(0.005)
+
+        sink.close()
+        if lost > 0:
+            self.logger.warning(f"{lost} frames were overwritten before they could be dumped.")
+        self.logger.info(f"Dumped {written} frames ({self.source} trigger) to {self.folder}")
+
+
+def ring_from_config(config, save_dir, codec=None):
+    """Create a RingRecorder from the RING section of the config file."""
+    ring_config = config.get("RING") or {}
+    sink = ring_config.get("SINK", "raw")
+
+    return RingRecorder(
+        save_dir,
+        lambda folder: save_tools.create_sink(config, folder, codec, sink),
+        ram_mb=ring_config.get("RAM_MB", 2048),
+        pre_seconds=ring_config.get("PRE_SECONDS", 5),
+        post_seconds=ring_config.get("POST_SECONDS", 5),
+        gpi_trigger=ring_config.get("GPI_TRIGGER", True),
+    )
+
+
+def trigger_on_enter(ring):
+    """Trigger the ring recorder on every ENTER key press. Intended to use as a Thread target."""
+    for line in sys.stdin:
+        ring.trigger("key")
@@ -0,0 +1,643 @@
+# save_tools.py
+
+import io, os, time, json, shutil, csv
+from queue import Queue, Full, Empty
+from threading import Thread
+import numpy as np
+import cv2
+import logger_tools
+import video_sink
+import hdf5_sink
+import raw_sink
+import catalog
+import metadata_export
+import change_gate
+import metrics
+
+FRAMES_SAVED = metrics.counter("xicam_frames_saved_total", "Frames written by the save sinks")
+BYTES_SAVED = metrics.counter("xicam_saved_bytes_total", "Bytes written by the save sinks")
+DROPPED_QUEUE = metrics.FRAMES_DROPPED.labels("save_queue_full")
+DROPPED_DECIMATED = metrics.FRAMES_DROPPED.labels("save_decimated")
+DROPPED_UNCHANGED = metrics.FRAMES_DROPPED.labels("unchanged")
+QUEUE_LATENCY = metrics.STAGE_LATENCY.labels("save_queue")
+WRITE_LATENCY = metrics.STAGE_LATENCY.labels("save_write")
+
+logger = logger_tools.get_logger(__name__)
+
+# suffix of files that are still being written
+TMP_SUFFIX = ".tmp"
+
+
+class Codec:
+    """
+    Base class for image codecs used when saving frames to disk.
+    Subclasses implement encode() which returns the encoded bytes of a frame.
+    """
+
+    name = ""
+    extension = ""
+
+    def encode(self, data):
+        raise NotImplementedError
+
+    def write(self, data, filepath):
+        """
+        Encode the frame and write it to filepath. Returns the number of bytes written.
+        The file is written under a temporary name and renamed, so a crash never leaves a torn image.
+        """
+        buffer = self.encode(data)
+        tmp_path = filepath + TMP_SUFFIX
+        with open(tmp_path, "wb") as f:
+            f.write(buffer)
+        os.replace(tmp_path, filepath)
+        return len(buffer)
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}()"
+
+
+class PngCodec(Codec):
+    """PNG with selectable zlib compression level (0 fastest - 9 smallest)."""
+
+    name = "png"
+    extension = ".png"
+
+    def __init__(self, compression=1):
+        self.compression = int(compression)
+        self.params = [cv2.IMWRITE_PNG_COMPRESSION, self.compression]
+
+    def encode(self, data):
+        ret, buffer = cv2.imencode(self.extension, data, self.params)
+        return buffer
+
+    def __repr__(self):
+        return f"PngCodec(compression={self.compression})"
+
+
+class JpegCodec(Codec):
+    """JPEG with selectable quality (0 - 100)."""
+
+    name = "jpeg"
+    extension = ".jpg"
+
+    def __init__(self, quality=95):
+        self.quality = int(quality)
+        self.params = [cv2.IMWRITE_JPEG_QUALITY, self.quality]
+
+    def encode(self, data):
+        ret, buffer = cv2.imencode(self.extension, data, self.params)
+        return buffer
+
+    def __repr__(self):
+        return f"JpegCodec(quality={self.quality})"
+
+
+class TiffCodec(Codec):
+    """Uncompressed TIFF."""
+
+    name = "tiff"
+    extension = ".tiff"
+
+    def __init__(self):
+        # 1 = COMPRESSION_NONE in libtiff
+        self.params = [cv2.IMWRITE_TIFF_COMPRESSION, 1]
+
+    def encode(self, data):
+        ret, buffer = cv2.imencode(self.extension, data, self.params)
+        return buffer
+
+
+class BmpCodec(Codec):
+    """Uncompressed BMP."""
+
+    name = "bmp"
+    extension = ".bmp"
+
+    def encode(self, data):
+        ret, buffer = cv2.imencode(self.extension, data)
+        return buffer
+
+
+class NpyCodec(Codec):
+    """Raw numpy array in .npy format, keeps dtype and shape."""
+
+    name = "npy"
+    extension = ".npy"
+
+    def encode(self, data):
+        stream = io.BytesIO()
+        np.save(stream, data, allow_pickle=False)
+        return stream.getbuffer()
+
+
+CODECS = {
+    PngCodec.name: PngCodec,
+    JpegCodec.name: JpegCodec,
+    TiffCodec.name: TiffCodec,
+    BmpCodec.name: BmpCodec,
+    NpyCodec.name: NpyCodec,
+}
+
+
+def get_codec(name="png", png_compression=1, jpeg_quality=95):
+    """
+    Create a codec by name.
+    png_compression and jpeg_quality are only used by the matching codec.
+    """
+    name = str(name).lower()
+    if name == "jpg":
+        name = "jpeg"
+    elif name == "tif":
+        name = "tiff"
+
+    if name not in CODECS:
+        raise ValueError(f"Unknown codec '{name}'. Available: {', '.join(CODECS)}")
+
+    if name == "png":
+        return PngCodec(png_compression)
+    elif name == "jpeg":
+        return JpegCodec(jpeg_quality)
+    else:
+        return CODECS[name]()
+
+
+def codec_from_config(config, codec=None, png_compression=None, jpeg_quality=None):
+    """
+    Create the codec described in the SAVE section of the config file.
+    Arguments that are not None (e.g. from the CLI or a web request) override the config.
+    """
+    save_config = config.get("SAVE") or {}
+
+    if codec is None:
+        codec = save_config.get("CODEC", "png")
+    if png_compression is None:
+        png_compression = save_config.get("PNG_COMPRESSION", 1)
+    if jpeg_quality is None:
+        jpeg_quality = save_config.get("JPEG_QUALITY", 95)
+
+    return get_codec(codec, png_compression=png_compression, jpeg_quality=jpeg_quality)
+
+
+def frame_path(frame_id, extension, shard_size=1000):
+    """
+    Path of a frame relative to the session folder.
+    Frames are sharded into subfolders of shard_size frames: 000012/xi_0000012345.png
+    """
+    return os.path.join(f"{frame_id // shard_size:06d}", f"xi_{frame_id:010d}{extension}")
+
+
+class Manifest:
+    """
+    Append-only csv list of the frames of a session (xi_manifest.csv),
+    so tools can find frames without listing the folders.
+    Rows are written in batches of batch_size or every flush_seconds.
+    """
+
+    HEADER = ["frame_id", "camera_timestamp", "host_timestamp", "exposure", "gain", "path", "bytes"]
+
+    def __init__(self, save_dir, batch_size=256, flush_seconds=2):
+        self.path = os.path.join(save_dir, "xi_manifest.csv")
+        new_file = not os.path.exists(self.path)
+        self.file = open(self.path, "a", newline="")
+        self.writer = csv.writer(self.file)
+        if new_file:
+            self.writer.writerow(self.HEADER)
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.rows = []
+        self.last_flush = time.time()
+
+    def add(self, frame_id, metadata, path, nbytes):
+        if metadata is not None:
+            row = [frame_id, metadata.timestamp, metadata.host_timestamp, metadata.exposure, metadata.gain]
+        else:
+            row = [frame_id, "", time.time(), "", ""]
+        self.rows.append(row + [path, nbytes])
+
+        if len(self.rows) >= self.batch_size or time.time() - self.last_flush >= self.flush_seconds:
+            self.flush()
+
+    def flush(self):
+        self.writer.writerows(self.rows)
+        self.file.flush()
+        self.rows = []
+        self.last_flush = time.time()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+def read_manifest(save_dir):
+    """
+    Read the manifest of a session.
+    returns: list of dicts, one per frame
+    """
+    with open(os.path.join(save_dir, "xi_manifest.csv"), newline="") as f:
+        return list(csv.DictReader(f))
+
+
+class ImageFileSink:
+    """
+    Save every frame as a single image file with the given codec.
+    Files are named by zero-padded frame id, sharded into subfolders
+    and listed in the session manifest.
+    """
+
+    name = "images"
+
+    def __init__(self, save_dir, codec=None, shard_size=1000, manifest_batch=256):
+        self.save_dir = save_dir
+        self.codec = PngCodec() if codec is None else codec
+        self.shard_size = shard_size
+        self.manifest = Manifest(save_dir, manifest_batch)
+        self.count = 0
+        self.last_frame_id = -1
+        self.shards = set()
+
+    def write(self, image):
+        metadata = image.metadata
+        frame_id = self.count if metadata is None else int(metadata.frame_id)
+        if frame_id <= self.last_frame_id:
+            # the camera counter restarted (or is missing), keep names unique
+            frame_id = self.last_frame_id + 1
+        self.last_frame_id = frame_id
+        self.count += 1
+
+        relpath = frame_path(frame_id, self.codec.extension, self.shard_size)
+        shard = os.path.dirname(relpath)
+        if shard not in self.shards:
+            os.makedirs(os.path.join(self.save_dir, shard), exist_ok=True)
+            self.shards.add(shard)
+
+        nbytes = self.codec.write(image.data, os.path.join(self.save_dir, relpath))
+        self.manifest.add(frame_id, metadata, relpath, nbytes)
+        self.last_path = relpath
+        return nbytes
+
+    def faster(self):
+        """Switch to the fastest setting of the codec. Returns a description or None."""
+        if isinstance(self.codec, PngCodec) and self.codec.compression > 0:
+            self.codec = PngCodec(0)
+            return "png compression 0"
+        return None
+
+    def close(self):
+        self.manifest.close()
+
+
+class SessionLog:
+    """Session metadata, kept as xi_session.json in the save folder."""
+
+    def __init__(self, save_dir, **info):
+        self.path = os.path.join(save_dir, "xi_session.json")
+        self.data = dict(info, started=time.time(), events=[])
+        self.write()
+
+    def add_event(self, event, **details):
+        self.data["events"].append(dict(details, time=time.time(), event=event))
+        self.write()
+
+    def write(self):
+        tmp_path = self.path + TMP_SUFFIX
+        with open(tmp_path, "w") as f:
+            json.dump(self.data, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+
+class PressureMonitor:
+    """
+    Track save queue depth, write rate and free disk space of a SinkThread
+    and report pressure when any of them crosses its threshold.
+
+    queue_fraction: queue fill level (0 - 1) that counts as pressure
+    min_write_mbs: write rate (MB/s) below which a non-empty queue counts as pressure, 0 disables
+    min_free_gb: free space that counts as pressure
+    stop_free_gb: free space below which saving stops
+    hold_seconds: minimum time between two degradation steps
+    """
+
+    def __init__(
+        self, save_dir, queue_fraction=0.5, min_write_mbs=0, min_free_gb=5, stop_free_gb=1,
+        check_seconds=1, hold_seconds=5,
+    ):
+        self.save_dir = save_dir
+        self.queue_fraction = queue_fraction
+        self.min_write_mbs = min_write_mbs
+        self.min_free_gb = min_free_gb
+        self.stop_free_gb = stop_free_gb
+        self.check_seconds = check_seconds
+        self.hold_seconds = hold_seconds
+
+        self.queue_depth = 0
+        self.write_mbs = 0.0
+        self.free_gb = shutil.disk_usage(save_dir).free / 1e9
+        self.last_check = time.time()
+        self.last_step = 0
+        self.last_bytes = 0
+
+    def due(self):
+        return time.time() - self.last_check >= self.check_seconds
+
+    def check(self, queue_depth, queue_size, bytes_written):
+        """
+        Update the statistics.
+        returns: None, "stop" or the reason for the next degradation step
+        """
+        now = time.time()
+        self.write_mbs = (bytes_written - self.last_bytes) / 1e6 / (now - self.last_check)
+        self.queue_depth = queue_depth
+        self.free_gb = shutil.disk_usage(self.save_dir).free / 1e9
+        self.last_bytes = bytes_written
+        self.last_check = now
+
+        if self.free_gb < self.stop_free_gb:
+            return "stop"
+
+        if self.free_gb < self.min_free_gb:
+            reason = f"free space {self.free_gb:.1f} GB"
+        elif queue_depth >= self.queue_fraction * queue_size:
+            reason = f"queue depth {queue_depth}/{queue_size}"
+        elif queue_depth > 0 and self.write_mbs < self.min_write_mbs:
+            reason = f"write rate {self.write_mbs:.1f} MB/s"
+        else:
+            return None
+
+        if now - self.last_step < self.hold_seconds:
+            return None
+        self.last_step = now
+        return reason
+
+
+class SinkThread(Thread):
+    """
+    Feed frames to a sink from a bounded queue in a background thread,
+    so slow encoding or disk writes never block the caller.
+    Frames are dropped (and counted) when the queue is full.
+
+    With a PressureMonitor the thread degrades step by step while the disk can not keep up:
+    faster compression, then saving only every 2nd frame, then a raw dump,
+    then halving the saved frame rate further. Every step is logged in the session log.
+
+    With a ChangeGate frames that hardly differ from the last saved one are skipped.
+    """
+
+    MAX_DECIMATE = 16
+
+    def __init__(
+        self,
+        sink,
+        queue_size=64,
+        save_dir=None,
+        pressure=None,
+        catalog_writer=None,
+        raw_options=None,
+        metadata_recorder=None,
+        gate=None,
+    ):
+        Thread.__init__(self, daemon=True)
+        self.sink = sink
+        self.queue = Queue(maxsize=queue_size)
+        self.save_dir = save_dir
+        self.pressure = pressure
+        self.catalog_writer = catalog_writer
+        self.raw_options = raw_options or {}
+        self.metadata_recorder = metadata_recorder
+        self.gate = gate
+        self.session_log = None
+        if save_dir is not None:
+            self.session_log = SessionLog(save_dir, sink=sink.name)
+        self.dropped = 0
+        self.written = 0
+        self.skipped = 0
+        self.unchanged = 0
+        self.received = 0
+        self.bytes_written = 0
+        self.decimate = 1
+        self.level = 0
+        self.stopped = False
+        self.logger = logger_tools.get_logger(self.__class__.__name__)
+
+    def put(self, image):
+        try:
+            self.queue.put_nowait(image)
+        except Full:
+            self.dropped += 1
+            DROPPED_QUEUE.inc()
+            self.logger.warning(f"Save queue full, frame dropped ({self.dropped} total).")
+
+    def log_event(self, event, **details):
+        self.logger.warning(f"Save {event}: {details}")
+        if self.session_log is not None:
+            self.session_log.add_event(event, **details)
+
+    def degrade(self, reason):
+        """Apply the next degradation step."""
+        self.level += 1
+
+        if self.level == 1:
+            faster = getattr(self.sink, "faster", None)
+            action = faster() if faster is not None else None
+            if action is None:
+                # nothing to speed up in this sink, go on with the next step
+                return self.degrade(reason)
+        elif self.level == 2:
+            self.decimate = 2
+            action = "save every 2nd frame"
+        elif self.level == 3 and self.sink.name != raw_sink.RawSink.name:
+            self.sink.close()
+            self.sink = raw_sink.RawSink(self.save_dir, **self.raw_options)
+            action = "raw dump"
+        elif self.decimate < self.MAX_DECIMATE:
+            self.decimate *= 2
+            action = f"save every {self.decimate}th frame"
+        else:
+            return
+
+        self.log_event("degraded", level=self.level, action=action, reason=reason)
+
+    def check_pressure(self):
+        result = self.pressure.check(self.queue.qsize(), self.queue.maxsize, self.bytes_written)
+        if result == "stop" and not self.stopped:
+            self.stopped = True
+            self.log_event("stopped", reason=f"free space {self.pressure.free_gb:.2f} GB")
+        elif result is not None and result != "stop":
+            self.degrade(result)
+
+    def run(self):
+        self.logger.debug(f"SinkThread started for {self.sink.__class__.__name__}.")
+        while True:
+            try:
+                image = self.queue.get(timeout=0.5)
+            except Empty:
+                image = False
+
+            if self.pressure is not None and self.pressure.due():
+                self.check_pressure()
+
+            if image is False:
+                continue
+            if image is None:
+                break
+
+            self.received += 1
+            if self.stopped or self.received % self.decimate != 0:
+                self.skipped += 1
+                DROPPED_DECIMATED.inc()
+                continue
+            if self.gate is not None and not self.gate.check(image.data):
+                self.unchanged += 1
+                DROPPED_UNCHANGED.inc()
+                continue
+
+            try:
+                t0 = time.time()
+                if image.metadata is not None:
+                    QUEUE_LATENCY.observe(t0 - image.metadata.host_timestamp)
+                nbytes = self.sink.write(image)
+                WRITE_LATENCY.observe(time.time() - t0)
+                size = image.data.nbytes if nbytes is None else nbytes
+                self.bytes_written += size
+                self.written += 1
+                FRAMES_SAVED.inc()
+                BYTES_SAVED.inc(size)
+                if self.metadata_recorder is not None:
+                    self.metadata_recorder.add(image.metadata)
+                if self.catalog_writer is not None:
+                    # sinks report where the frame went, e.g. a file or "container#index"
+                    self.catalog_writer.add(image.metadata, getattr(self.sink, "last_path", ""), nbytes)
+            except Exception:
+                self.logger.error("Failed to save frame.", exc_info=True)
+
+        self.sink.close()
+        if self.catalog_writer is not None:
+            self.catalog_writer.close()
+        if self.metadata_recorder is not None:
+            self.metadata_recorder.close()
+        if self.session_log is not None:
+            self.session_log.data.update(
+                stopped=time.time(),
+                written=self.written,
+                dropped=self.dropped,
+                skipped=self.skipped,
+                unchanged=self.unchanged,
+            )
+            self.session_log.write()
+        self.logger.debug(
+            f"SinkThread finished. {self.written} written, {self.dropped} dropped, {self.skipped} skipped, "
+            f"{self.unchanged} unchanged."
+        )
+
+    def close(self):
+        """Write all queued frames, close the sink and wait for the thread to finish."""
+        self.queue.put(None)
+        self.join()
+
+
+SINKS = ["images", "video", "hdf5", "raw"]
+
+
+def raw_options_from_config(config):
+    """RawSink arguments from the SAVE section of the config file."""
+    save_config = config.get("SAVE") or {}
+    return {
+        "direct": save_config.get("RAW_DIRECT", False),
+        "fsync": save_config.get("RAW_FSYNC", "none"),
+        "fsync_frames": save_config.get("RAW_FSYNC_FRAMES", 100),
+        "fsync_seconds": save_config.get("RAW_FSYNC_SECONDS", 1.0),
+        "buffer_mb": save_config.get("RAW_BUFFER_MB", 16),
+        "checksum": save_config.get("RAW_CHECKSUM", False),
+    }
+
+
+def create_sink(config, save_dir, codec=None, sink=None):
+    """
+    Create the sink described in the SAVE section of the config file.
+    sink overrides the configured sink type.
+    """
+    save_config = config.get("SAVE") or {}
+
+    if sink is None:
+        sink = save_config.get("SINK", "images")
+
+    if sink == "images":
+        target = ImageFileSink(
+            save_dir,
+            codec,
+            shard_size=save_config.get("SHARD_SIZE", 1000),
+            manifest_batch=save_config.get("MANIFEST_BATCH", 256),
+        )
+    elif sink == "video":
+        target = video_sink.VideoSink(
+            save_dir,
+            fourcc=save_config.get("VIDEO_FOURCC", "auto"),
+            fps=save_config.get("VIDEO_FPS", 30),
+            segment_seconds=save_config.get("SEGMENT_SECONDS", 600),
+            segment_mb=save_config.get("SEGMENT_MB", 2000),
+        )
+    elif sink == "hdf5":
+        target = hdf5_sink.HDF5Sink(
+            save_dir,
+            chunk_frames=save_config.get("HDF5_CHUNK_FRAMES", 8),
+            chunk_rows=save_config.get("HDF5_CHUNK_ROWS", 0),
+            compression=save_config.get("HDF5_COMPRESSION", 4),
+            flush_seconds=save_config.get("HDF5_FLUSH_SECONDS", 5),
+            workers=save_config.get("HDF5_WORKERS", 4),
+        )
+    elif sink == "raw":
+        target = raw_sink.RawSink(save_dir, **raw_options_from_config(config))
+    else:
+        raise ValueError(f"Unknown sink '{sink}'. Available: {', '.join(SINKS)}")
+
+    return target
+
+
+def sink_from_config(config, save_dir, codec=None, sink=None):
+    """
+    Create the sink described in the SAVE section of the config file,
+    running in its own SinkThread. sink overrides the configured sink type.
+    """
+    save_config = config.get("SAVE") or {}
+    target = create_sink(config, save_dir, codec, sink)
+
+    pressure = None
+    if save_config.get("PRESSURE_ENABLED", True):
+        pressure = PressureMonitor(
+            save_dir,
+            queue_fraction=save_config.get("PRESSURE_QUEUE_FRACTION", 0.5),
+            min_write_mbs=save_config.get("PRESSURE_MIN_WRITE_MBS", 0),
+            min_free_gb=save_config.get("PRESSURE_MIN_FREE_GB", 5),
+            stop_free_gb=save_config.get("PRESSURE_STOP_FREE_GB", 1),
+            hold_seconds=save_config.get("PRESSURE_HOLD_SECONDS", 5),
+        )
+
+    catalog_writer = None
+    catalog_config = config.get("CATALOG") or {}
+    if catalog_config.get("ENABLED", True):
+        catalog_writer = catalog.CatalogWriter(
+            catalog_config.get("PATH", catalog.DEFAULT_DB_PATH),
+            save_dir,
+            batch_size=catalog_config.get("BATCH", 500),
+        )
+        catalog_writer.start()
+
+    metadata_recorder = None
+    if save_config.get("METADATA_EXPORT", True):
+        metadata_recorder = metadata_export.MetadataRecorder(
+            save_dir,
+            batch_size=save_config.get("METADATA_BATCH", 10000),
+            flush_seconds=save_config.get("METADATA_FLUSH_SECONDS", 30),
+        )
+
+    thread = SinkThread(
+        target,
+        save_config.get("QUEUE_SIZE", 64),
+        save_dir,
+        pressure,
+        catalog_writer,
+        raw_options_from_config(config),
+        metadata_recorder,
+        change_gate.gate_from_config(config),
+    )
+    thread.start()
+    return thread
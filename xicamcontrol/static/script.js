@@ -1,8 +1,23 @@
 async function startCapture() {
   let manaul = document.getElementById("btnradio32").checked;
   let save = document.getElementById("btnradio21").checked;
+  let ring = document.getElementById("btnradio33").checked;
 
-  const response = await fetch("/start_capture?manual=" + manaul + "&save=" + save);
+  let codec = document.getElementById("codecSelect").value;
+  let level = document.getElementById("codecLevel").value;
+
+  let url = "/start_capture?manual=" + manaul + "&save=" + save + "&ring=" + ring;
+  if (["video", "hdf5", "raw"].includes(codec)) {
+    url += "&sink=" + codec;
+  } else {
+    url += "&sink=images&codec=" + codec;
+  }
+  if (level !== "") {
+    // level is the PNG compression (0-9) or the JPEG quality (0-100)
+    url += (codec == "png" ? "&png_compression=" : "&jpeg_quality=") + level;
+  }
+
+  const response = await fetch(url);
   return response.text();
 }
 
@@ -11,12 +26,31 @@ async function stopCapture() {
   return response.text();
 }
 
+async function triggerEvent() {
+  const response = await fetch("/trigger");
+  return response.text();
+}
+
+const trigger_event = () => {
+  triggerEvent().then((result) => {
+    if (result == "Trigger accepted.") {
+      document.getElementById("status-msg").classList.remove("bg-danger");
+      document.getElementById("status-msg").classList.add("bg-success");
+      document.getElementById("status-msg").innerHTML = "Success: " + result;
+    } else {
+      document.getElementById("status-msg").classList.remove("bg-success");
+      document.getElementById("status-msg").classList.add("bg-danger");
+      document.getElementById("status-msg").innerHTML = "Error: " + result;
+    }
+  });
+};
+
 const start_capture = () => {
   startCapture().then((result) => {
     if (result == "Capture started.") {
       document.getElementById("startBtn").disabled = true;
       document.getElementById("stopBtn").disabled = false;
-      document.getElementById("image_feed").src = "/image_stream";
+      startStream();
 
       document.getElementById("status-msg").classList.remove("bg-danger");
       document.getElementById("status-msg").classList.add("bg-success");
@@ -34,6 +68,7 @@ const stop_capture = () => {
     if (result == "Capture stopped.") {
       document.getElementById("startBtn").disabled = false;
       document.getElementById("stopBtn").disabled = true;
+      stopStream();
       document.getElementById("image_feed").src = "static/preview.jpg";
 
       document.getElementById("status-msg").classList.remove("bg-danger");
@@ -47,13 +82,118 @@ const stop_capture = () => {
   });
 };
 
-// const save = () => {
-//   var a = document.createElement("a");
-//   a.href = document.getElementById("image_feed").src;
-//   a.download = "image.png";
-//   a.click();
-//   console.log("saving image.");
-// };
+// preview over a WebSocket with frame metadata (async server), /image_stream (multipart) otherwise
+let stream = null;
+let frameUrl = null;
+let frameTimes = [];
+
+function startStream() {
+  const protocol = location.protocol == "https:" ? "wss://" : "ws://";
+  const ws = new WebSocket(protocol + location.host + "/ws_stream");
+  ws.binaryType = "arraybuffer";
+  let opened = false;
+  stream = ws;
+
+  ws.onopen = () => {
+    opened = true;
+  };
+  ws.onmessage = (event) => {
+    const view = new DataView(event.data);
+    // stream_tools.WS_HEADER, little endian
+    const headerSize = view.getUint16(0, true);
+    const seq = Number(view.getBigUint64(2, true));
+    const info = {
+      frameId: Number(view.getBigUint64(10, true)),
+      hostTimestamp: view.getFloat64(26, true),
+      exposure: view.getFloat64(34, true),
+      gain: view.getFloat64(42, true),
+      encodeMs: view.getFloat32(50, true),
+    };
+    const url = URL.createObjectURL(new Blob([new Uint8Array(event.data, headerSize)], { type: "image/jpeg" }));
+    const img = document.getElementById("image_feed");
+    img.onload = () => {
+      // ack once the frame is shown, the server sends the next one
+      if (ws.readyState == WebSocket.OPEN) ws.send(String(seq));
+    };
+    img.src = url;
+    if (frameUrl !== null) URL.revokeObjectURL(frameUrl);
+    frameUrl = url;
+    showFrameInfo(info);
+  };
+  ws.onclose = () => {
+    if (!opened && stream === ws) {
+      // no WebSocket on this server
+      stream = null;
+      document.getElementById("image_feed").src = "/image_stream";
+    }
+  };
+}
+
+function stopStream() {
+  if (stream !== null) {
+    const ws = stream;
+    stream = null;
+    ws.close();
+  }
+  frameTimes = [];
+  document.getElementById("frame-info").innerHTML = "";
+}
+
+// a hidden tab closes its stream, the server stops encoding once no stream is left
+document.addEventListener("visibilitychange", () => {
+  if (!document.getElementById("startBtn").disabled) return;
+  if (document.hidden) {
+    stopStream();
+    document.getElementById("image_feed").src = "static/preview.jpg";
+  } else if (stream === null) {
+    startStream();
+  }
+});
+
+function showFrameInfo(info) {
+  const now = performance.now();
+  frameTimes.push(now);
+  while (frameTimes.length > 1 && now - frameTimes[0] > 2000) frameTimes.shift();
+  const fps = frameTimes.length > 1 ? ((frameTimes.length - 1) * 1000) / (now - frameTimes[0]) : 0;
+  document.getElementById("frame-info").innerHTML =
+    "shown frame " + info.frameId +
+    " | " + fps.toFixed(1) + " fps here" +
+    " | encode " + info.encodeMs.toFixed(1) + " ms";
+}
+
+// live camera stats from the server (/stats, server-sent events), never drawn into the frames
+function showStats(stats) {
+  let text = stats.running ? "capturing at " + stats.fps.toFixed(1) + " fps" : "not capturing";
+  if (stats.frame_id !== undefined) {
+    text +=
+      " | frame " + stats.frame_id +
+      " | time " + stats.timestamp.toFixed(3) + " s" +
+      " | gain " + stats.gain.toFixed(1) + " dB" +
+      " | exposure " + stats.exposure + " us";
+  }
+  const dropped = Object.values(stats.dropped).reduce((a, b) => a + b, 0);
+  text += " | saved " + stats.saved + " | save queue " + stats.save_queue + " | dropped " + dropped;
+  document.getElementById("live-stats").innerHTML = text;
+}
+
+window.addEventListener("DOMContentLoaded", () => {
+  if (!window.EventSource) return;
+  // reconnects on its own after a server restart
+  const source = new EventSource("/stats");
+  source.onmessage = (event) => showStats(JSON.parse(event.data));
+});
+
+const save = () => {
+  // full resolution still of the newest frame, tiff or raw (npy) when selected as format, else png
+  let codec = document.getElementById("codecSelect").value;
+  let format = codec == "tiff" ? "tiff" : ["npy", "raw"].includes(codec) ? "raw" : "png";
+
+  var a = document.createElement("a");
+  a.href = "/still?format=" + format;
+  a.download = "";
+  a.click();
+  console.log("saving image.");
+};
 
 // const imageElement = document.getElementById('latest-image');
 // const refreshImage = () => {
@@ -0,0 +1,553 @@
+# stream_tools.py
+
+import time, struct, json
+from threading import Thread, Condition, Event, Lock, Semaphore
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import logger_tools
+import save_tools
+import opencv_tools
+import jpeg_tools
+import metrics
+
+try:
+    import fcntl, termios
+except ImportError:
+    # not on Windows, send queues are not tracked there
+    fcntl = None
+
+logger = logger_tools.get_logger(__name__)
+
+ENCODE_SECONDS = metrics.histogram("xicam_stream_encode_seconds", "Resize and JPEG encode time of stream frames")
+STREAM_CLIENTS = metrics.gauge("xicam_stream_clients", "Connected stream viewers")
+STREAM_BYTES = metrics.counter("xicam_stream_bytes_total", "Bytes sent to each stream viewer", ["client"])
+STREAM_SKIPPED = metrics.counter(
+    "xicam_stream_frames_skipped_total", "Frames a stream viewer was too slow for", ["client"]
+)
+FRAMES_NOT_ENCODED = metrics.counter(
+    "xicam_stream_frames_not_encoded_total", "Captured frames not encoded for the preview, nobody was watching"
+)
+ENCODE_SECONDS_SAVED = metrics.counter(
+    "xicam_stream_encode_seconds_saved_total", "Estimated encode time saved while nobody was watching"
+)
+STREAM_ENCODING = metrics.gauge("xicam_stream_encoding", "1 while preview frames are encoded, 0 while nobody watches")
+
+MJPEG_BOUNDARY = "frame"
+MJPEG_MIMETYPE = f"multipart/x-mixed-replace; boundary={MJPEG_BOUNDARY}"
+# proxies must not buffer or cache the stream
+MJPEG_HEADERS = {"Cache-Control": "no-cache, no-store", "X-Accel-Buffering": "no"}
+
+
+def mjpeg_start():
+    """First boundary of a multipart stream."""
+    return f"--{MJPEG_BOUNDARY}\r\n".encode()
+
+
+def unsent_bytes(sock):
+    """
+    Bytes waiting in the kernel send queue of a socket (Linux), None if unknown.
+    Kernel buffers hide slow viewers for seconds, this shows them right away.
+    """
+    if sock is None or fcntl is None or not hasattr(termios, "TIOCOUTQ"):
+        return None
+    try:
+        return struct.unpack("i", fcntl.ioctl(sock.fileno(), termios.TIOCOUTQ, b"\0\0\0\0"))[0]
+    except (OSError, ValueError):
+        return None
+
+
+def etag_matches(if_none_match, etag):
+    """True if an If-None-Match header value matches etag."""
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags or f"W/{etag}" in tags
+
+
+def snapshot(broadcaster, if_none_match=None):
+    """
+    The latest preview JPEG for /snapshot.jpg, straight from the broadcaster, so any
+    number of pollers cost no extra encoding. The ETag is the frame sequence number.
+    returns: (status, headers, body)
+    """
+    seq, frame = broadcaster.latest()
+    if frame is None:
+        return 503, {"Retry-After": "1"}, b"No frame available."
+
+    etag = f'"xi-{seq}"'
+    # pollers may keep a copy, but must ask again before using it
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag_matches(if_none_match, etag):
+        return 304, headers, b""
+    headers["Content-Type"] = "image/jpeg"
+    return 200, headers, frame
+
+
+# still download format -> save codec
+STILL_FORMATS = {"png": "png", "tiff": "tiff", "raw": "npy"}
+
+
+def still(image, fmt="png"):
+    """
+    Encode a full resolution frame for download, meant to run in a worker thread.
+    returns: (status, headers, body)
+    """
+    if fmt not in STILL_FORMATS:
+        return 400, {}, f"Unknown format '{fmt}'. Available: {', '.join(STILL_FORMATS)}".encode()
+    if image is None:
+        return 503, {"Retry-After": "1"}, b"No frame available."
+
+    codec = save_tools.get_codec(STILL_FORMATS[fmt])
+    body = bytes(codec.encode(image.data))
+    name = f"xi_{int(image.metadata.frame_id):010d}" if image.metadata is not None else "xi_still"
+    headers = {
+        "Content-Type": {"png": "image/png", "tiff": "image/tiff"}.get(fmt, "application/octet-stream"),
+        "Content-Disposition": f'attachment; filename="{name}{codec.extension}"',
+        "Cache-Control": "no-store",
+    }
+    return 200, headers, body
+
+
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+
+def live_stats(camera):
+    """Camera and pipeline state for the web UI, taken from the newest frame and the metrics."""
+    image = camera.latest_frame()
+    stats = {
+        "running": camera.capture_started,
+        "fps": round(camera.cam.fps_meter.rate, 1) if camera.capture_started else 0.0,
+        "saved": save_tools.FRAMES_SAVED.value,
+        "save_queue": camera.sink.queue.qsize() if camera.sink is not None else 0,
+        "dropped": {values[0]: child.value for values, child in list(metrics.FRAMES_DROPPED.children.items())},
+    }
+    if image is not None and image.metadata is not None:
+        m = image.metadata
+        stats.update(frame_id=int(m.frame_id), timestamp=m.timestamp, exposure=m.exposure, gain=m.gain)
+    return stats
+
+
+def sse_event(data):
+    """One server-sent event with data as JSON."""
+    return f"data: {json.dumps(data)}\n\n".encode()
+
+
+# binary WebSocket frame: header followed by the jpeg bytes
+# header size, seq, frame id, camera timestamp, host timestamp, exposure (us), gain (dB), encode ms
+WS_HEADER = struct.Struct("<HQQddddf")
+
+
+def ws_frame(seq, frame, metadata=None, encode_ms=0.0):
+    """Binary WebSocket message with the frame metadata in front of the jpeg bytes."""
+    if metadata is None:
+        fields = (0, 0.0, time.time(), 0.0, 0.0)
+    else:
+        fields = (int(metadata.frame_id), metadata.timestamp, metadata.host_timestamp, metadata.exposure, metadata.gain)
+    return WS_HEADER.pack(WS_HEADER.size, seq, *fields, encode_ms) + frame
+
+
+def mjpeg_part(frame):
+    """
+    One multipart part with the jpeg bytes, closed by the next boundary.
+    Browsers show a part once it is complete, ending each part with the boundary
+    (instead of starting with it) shows a frame as soon as it arrives.
+    """
+    header = f"Content-Type: image/jpeg\r\nContent-Length: {len(frame)}\r\n\r\n".encode()
+    return header + frame + f"\r\n--{MJPEG_BOUNDARY}\r\n".encode()
+
+
+# limits of the width and quality query parameters of the stream
+MIN_WIDTH = 16
+MAX_WIDTH = 4096
+
+
+class FrameEncoder(Thread):
+    """
+    Resize frames to width, encode them to JPEG with quality and publish the bytes to
+    all clients of this (width, quality) pair.
+
+    Clients call wait_frame() with the sequence number of the last frame they got
+    and always receive the latest frame, frames they were too slow for are skipped.
+    Full frames are handed in with submit(), a frame that arrives while the previous one
+    is still being encoded replaces the waiting one.
+
+    backend: jpeg_tools.JpegBackend (default cv2)
+    workers: encode this many consecutive frames in parallel, frames are still published in order
+    """
+
+    def __init__(self, width=600, jpeg_quality=95, backend=None, workers=1):
+        Thread.__init__(self, daemon=True)
+        self.width = width
+        self.jpeg_quality = jpeg_quality
+        self.backend = jpeg_tools.CvBackend() if backend is None else backend
+        self.workers = workers
+        self.pool = None
+        if workers > 1:
+            self.pool = ThreadPoolExecutor(max_workers=workers)
+            self.free_workers = Semaphore(workers)
+            # futures of the frames being encoded, in frame order
+            self.in_flight = deque()
+            self.order_lock = Lock()
+        self.condition = Condition()
+        self.frame = None
+        self.data = None
+        self.metadata = None
+        self.encode_ms = 0.0
+        # moving average of the encode time, to estimate the time saved without viewers
+        self.mean_encode_seconds = 0.0
+        self.encodes = 0
+        self.seq = 0
+        self.pending = None
+        # other sizes and qualities of the current frame, encoded on demand: (scale, quality) -> bytes
+        self.variants = {}
+        self.listeners = []
+        # clients using this encoder, see FrameBroadcaster.acquire()
+        self.users = 0
+        self.stop_event = Event()
+        self.logger = logger_tools.get_logger(self.__class__.__name__)
+
+    def run(self):
+        self.logger.debug(f"FrameEncoder {self.width} px, quality {self.jpeg_quality} started.")
+        while not self.stop_event.is_set():
+            with self.condition:
+                self.condition.wait_for(lambda: self.pending is not None or self.stop_event.is_set(), 0.5)
+                image, self.pending = self.pending, None
+            if image is not None:
+                self.encode(image)
+        self.logger.debug(f"FrameEncoder {self.width} px, quality {self.jpeg_quality} finished.")
+
+    def submit(self, image):
+        with self.condition:
+            self.pending = image
+            self.condition.notify_all()
+
+    def encode(self, image):
+        """Encode and publish a frame, with workers > 1 this only waits for a free worker."""
+        if self.pool is None:
+            result = self.encode_frame(image)
+            if result is not None:
+                self.publish(*result)
+            return
+
+        self.free_workers.acquire()
+        with self.order_lock:
+            future = self.pool.submit(self.encode_frame, image)
+            self.in_flight.append(future)
+        future.add_done_callback(self.encoded)
+
+    def encoded(self, future):
+        # called by the worker that finished, publishes all frames that are done in order
+        self.free_workers.release()
+        with self.order_lock:
+            while self.in_flight and self.in_flight[0].done():
+                result = self.in_flight.popleft().result()
+                if result is not None:
+                    self.publish(*result)
+
+    def encode_frame(self, image):
+        """returns: (jpeg bytes, resized frame, metadata, encode ms), None if encoding failed"""
+        t0 = time.perf_counter()
+        # never upscale, a wall display asking for more than the sensor has gets the full frame
+        data = image.data
+        if self.width < data.shape[1]:
+            data = opencv_tools.resize_with_aspect_ratio(data, self.width)
+        try:
+            frame = self.backend.encode(data, self.jpeg_quality)
+        except Exception as e:
+            self.logger.warning(f"JPEG encoding failed: {e!r}")
+            return None
+        seconds = time.perf_counter() - t0
+        ENCODE_SECONDS.observe(seconds)
+        self.encodes += 1
+        if self.encodes <= 2:
+            # the first encode includes one time setup of the encoder
+            self.mean_encode_seconds = seconds
+        else:
+            self.mean_encode_seconds += 0.1 * (seconds - self.mean_encode_seconds)
+        return frame, data, image.metadata, seconds * 1000
+
+    def publish(self, frame, data=None, metadata=None, encode_ms=0.0):
+        with self.condition:
+            self.frame = frame
+            self.data = data
+            self.metadata = metadata
+            self.encode_ms = encode_ms
+            self.variants = {}
+            self.seq += 1
+            seq = self.seq
+            self.condition.notify_all()
+        for listener in self.listeners:
+            listener(seq, frame)
+
+    def add_listener(self, listener):
+        """Call listener(seq, jpeg bytes) from the encoder thread for every new frame."""
+        self.listeners = self.listeners + [listener]
+
+    def remove_listener(self, listener):
+        self.listeners = [l for l in self.listeners if l != listener]
+
+    def wait_frame(self, last_seq=0, timeout=1.0):
+        """
+        Wait for a frame newer than last_seq.
+        returns: (seq, jpeg bytes) or (last_seq, None) on timeout
+        """
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.seq > last_seq, timeout):
+                return last_seq, None
+            return self.seq, self.frame
+
+    def latest(self):
+        """returns: (seq, jpeg bytes) of the newest frame, (0, None) before the first one"""
+        with self.condition:
+            return self.seq, self.frame
+
+    def frame_info(self, seq):
+        """returns: (metadata, encode ms) of the newest frame, if it is still frame seq, else (None, 0)"""
+        with self.condition:
+            if seq != self.seq:
+                return None, 0.0
+            return self.metadata, self.encode_ms
+
+    def variant(self, seq, scale=1.0, quality=None):
+        """
+        The current frame resized by scale and encoded with quality. Each variant is
+        encoded at most once per frame and shared by all viewers asking for it.
+        returns: (seq, jpeg bytes), seq is newer than the requested one if a frame arrived meanwhile
+        """
+        quality = self.jpeg_quality if quality is None else quality
+        key = (scale, quality)
+        with self.condition:
+            seq, data = self.seq, self.data
+            if key in self.variants:
+                return seq, self.variants[key]
+            if data is None or key == (1.0, self.jpeg_quality):
+                return seq, self.frame
+
+        if scale != 1.0:
+            size = (max(1, int(data.shape[1] * scale)), max(1, int(data.shape[0] * scale)))
+            data = cv2.resize(data, size, interpolation=cv2.INTER_AREA)
+        frame = self.backend.encode(data, quality)
+        with self.condition:
+            if self.seq == seq:
+                self.variants[key] = frame
+        return seq, frame
+
+    def stop(self):
+        self.stop_event.set()
+        with self.condition:
+            self.condition.notify_all()
+        self.join()
+        if self.pool is not None:
+            self.pool.shutdown()
+
+
+class FrameBroadcaster(FrameEncoder):
+    """
+    Pull frames from the camera controller and encode each one once for all stream
+    clients: in this thread at the default width and quality, and in one FrameEncoder
+    per other (width, quality) pair that clients currently ask for.
+
+    Frames are pulled at full rate even without clients, pulling saves them, but they
+    are only resized and encoded while a client holds an encoder. Without clients every
+    sample_every-th frame is still encoded to keep the estimate of the saved encode time
+    current (e.g. after a ROI change), /snapshot.jpg pollers get the newest frame encoded
+    on demand, see latest().
+    """
+
+    sample_every = 100
+
+    def __init__(self, camera, jpeg_quality=95, width=600, idle_seconds=0.1, backend=None, workers=1):
+        FrameEncoder.__init__(self, width, jpeg_quality, backend, workers)
+        self.camera = camera
+        self.idle_seconds = idle_seconds
+        # (width, quality) -> running FrameEncoder
+        self.encoders = {}
+        self.encoders_lock = Lock()
+        self.snapshot_lock = Lock()
+        self.encoding = True
+        STREAM_ENCODING.set(1)
+
+    def watched(self):
+        """True while any client uses the default or another encoder."""
+        return self.users > 0 or bool(self.encoders)
+
+    def run(self):
+        self.logger.debug("FrameBroadcaster started.")
+        idle_frames = 0
+        while not self.stop_event.is_set():
+            if not self.camera.capture_started:
+                time.sleep(self.idle_seconds)
+                continue
+
+            # waits for the capture thread, stop and capture state are checked at least every 0.1 s
+            image = self.camera.retrive_frame(timeout=0.1)
+            if image is None:
+                continue
+
+            encoding = self.watched()
+            if encoding != self.encoding:
+                self.encoding = encoding
+                STREAM_ENCODING.set(int(encoding))
+                self.logger.info(f"Preview encoding {'resumed' if encoding else 'paused, no stream viewers'}.")
+            if not encoding:
+                idle_frames += 1
+                if idle_frames % self.sample_every != 1:
+                    FRAMES_NOT_ENCODED.inc()
+                    ENCODE_SECONDS_SAVED.inc(self.mean_encode_seconds)
+                    continue
+            else:
+                idle_frames = 0
+
+            for encoder in list(self.encoders.values()):
+                encoder.submit(image)
+            self.encode(image)
+
+        self.logger.debug("FrameBroadcaster finished.")
+
+    def latest(self):
+        """
+        returns: (seq, jpeg bytes) of the newest frame. Without viewers the newest camera
+        frame is encoded here first, at most once per frame however many pollers ask.
+        """
+        if self.encoding or not self.camera.capture_started:
+            return FrameEncoder.latest(self)
+        with self.snapshot_lock:
+            image = self.camera.latest_frame()
+            if image is not None and image.metadata is not self.metadata:
+                result = self.encode_frame(image)
+                if result is not None:
+                    self.publish(*result)
+        return FrameEncoder.latest(self)
+
+    def settings(self, width=None, quality=None):
+        """
+        Check the width and quality query parameters of a stream, None for the defaults.
+        returns: (width, quality). raises: ValueError
+        """
+        width = self.width if width is None else int(width)
+        quality = self.jpeg_quality if quality is None else int(quality)
+        if not MIN_WIDTH <= width <= MAX_WIDTH:
+            raise ValueError(f"Stream width must be between {MIN_WIDTH} and {MAX_WIDTH}, got {width}")
+        if not 1 <= quality <= 100:
+            raise ValueError(f"Stream quality must be between 1 and 100, got {quality}")
+        return width, quality
+
+    def acquire(self, width=None, quality=None):
+        """
+        The encoder for a stream of width px and JPEG quality, started if no other client uses it.
+        Hand it back with release() when the client is gone.
+        """
+        width, quality = self.settings(width, quality)
+        if (width, quality) == (self.width, self.jpeg_quality):
+            with self.encoders_lock:
+                self.users += 1
+            return self
+
+        with self.encoders_lock:
+            encoder = self.encoders.get((width, quality))
+            if encoder is None:
+                encoder = FrameEncoder(width, quality, self.backend, self.workers)
+                encoder.start()
+                self.encoders[(width, quality)] = encoder
+                self.logger.debug(f"{len(self.encoders) + 1} stream encoders in use.")
+            encoder.users += 1
+        return encoder
+
+    def release(self, encoder):
+        """Client of an acquired encoder is gone, stops the encoder once nobody uses it."""
+        with self.encoders_lock:
+            if encoder is self:
+                self.users -= 1
+                return
+            encoder.users -= 1
+            if encoder.users > 0:
+                return
+            del self.encoders[(encoder.width, encoder.jpeg_quality)]
+        encoder.stop()
+        self.logger.debug(f"{len(self.encoders) + 1} stream encoders in use.")
+
+    def stop(self):
+        FrameEncoder.stop(self)
+        for encoder in list(self.encoders.values()):
+            encoder.stop()
+
+
+class ViewerPacer:
+    """
+    Per-viewer backpressure. A frame is only sent when the send queue of the viewer's
+    socket holds less than max_queued_parts frames, otherwise the viewer waits for the next
+    frame. The pacer tracks how many frames a viewer skips and steps its stream down to
+    lower JPEG quality and resolution while it falls behind, and back up once it keeps up.
+    Slow viewers never hold back the broadcaster, the others or saving.
+
+    window: number of sent frames the skip ratio is computed over
+    recover_seconds: time without skipped frames before stepping up again
+    client: name of the viewer in the metrics, e.g. its address. Call close() when it is gone.
+    """
+
+    # (scale, JPEG quality), level 0 is the broadcast frame
+    LEVELS = [(1.0, None), (1.0, 60), (0.5, 60), (0.5, 40), (0.25, 40)]
+
+    def __init__(
+        self, adaptive=True, window=20, skip_ratio=0.5, recover_seconds=5, max_queued_parts=1, client="unknown"
+    ):
+        self.adaptive = adaptive
+        self.client = client
+        self.bytes_metric = STREAM_BYTES.labels(client)
+        self.skipped_metric = STREAM_SKIPPED.labels(client)
+        STREAM_CLIENTS.inc()
+        self.max_queued_parts = max_queued_parts
+        self.last_part_bytes = 0
+        self.window = window
+        self.skip_ratio = skip_ratio
+        self.recover_seconds = recover_seconds
+        self.level = 0
+        self.last_seq = 0
+        self.sent = 0
+        self.skipped = 0
+        self.window_sent = 0
+        self.window_skipped = 0
+        self.last_skip = time.time()
+        self.logger = logger_tools.get_logger(self.__class__.__name__)
+
+    def ready(self, sock):
+        """False while the socket still has more than max_queued_parts frames to send."""
+        queued = unsent_bytes(sock)
+        return queued is None or queued <= self.max_queued_parts * self.last_part_bytes
+
+    def sent_part(self, nbytes):
+        self.last_part_bytes = nbytes
+        self.bytes_metric.inc(nbytes)
+
+    def close(self):
+        STREAM_CLIENTS.dec()
+        STREAM_BYTES.remove(self.client)
+        STREAM_SKIPPED.remove(self.client)
+
+    def update(self, seq):
+        """Account for frame seq about to be sent. returns: (scale, quality) to send it with"""
+        skipped = seq - self.last_seq - 1 if self.last_seq else 0
+        self.last_seq = seq
+        self.sent += 1
+        self.skipped += skipped
+        self.skipped_metric.inc(skipped)
+        self.window_sent += 1
+        self.window_skipped += skipped
+        now = time.time()
+        if skipped:
+            self.last_skip = now
+
+        if self.adaptive and self.window_sent >= self.window:
+            ratio = self.window_skipped / (self.window_skipped + self.window_sent)
+            if ratio > self.skip_ratio and self.level < len(self.LEVELS) - 1:
+                self.level += 1
+                self.logger.debug(f"Viewer falls behind ({ratio:.0%} skipped), stream level {self.level}.")
+            elif self.level > 0 and now - self.last_skip >= self.recover_seconds:
+                self.level -= 1
+                self.last_skip = now
+                self.logger.debug(f"Viewer keeps up, stream level {self.level}.")
+            self.window_sent = 0
+            self.window_skipped = 0
+
+        return self.LEVELS[self.level]
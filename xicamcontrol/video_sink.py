@@ -0,0 +1,119 @@
+# video_sink.py
+
+import os, csv, time
+import cv2
+import logger_tools
+
+logger = logger_tools.get_logger(__name__)
+
+# fourcc -> container extension
+CONTAINERS = {
+    "FFV1": ".mkv",
+    "MJPG": ".avi",
+}
+
+
+class VideoSink:
+    """
+    Write frames into video container segments with cv2.VideoWriter.
+
+    fourcc: "FFV1" (lossless), "MJPG" or "auto" (FFV1 when the OpenCV build supports it, else MJPG)
+    fps: nominal frame rate stored in the container
+    segment_seconds / segment_mb: start a new segment when either limit is reached (0 disables)
+
+    Container timestamps assume a constant frame rate, so every segment gets a
+    csv sidecar with the camera and host timestamp of each frame.
+    """
+
+    name = "video"
+
+    def __init__(self, save_dir, fourcc="auto", fps=30.0, segment_seconds=600, segment_mb=2000):
+        self.save_dir = save_dir
+        self.fourcc = fourcc.upper()
+        self.fps = float(fps)
+        self.segment_seconds = segment_seconds
+        self.segment_bytes = segment_mb * 1e6
+        self.writer = None
+        self.sidecar_file = None
+        self.sidecar = None
+        self.segment = 0
+        self.segment_frames = 0
+        self.segment_start = 0
+        self.segment_path = None
+        self.logger = logger_tools.get_logger(self.__class__.__name__)
+
+    def _create_writer(self, path_base, fourcc, size, is_color):
+        path = path_base + CONTAINERS.get(fourcc, ".avi")
+        writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*fourcc), self.fps, size, is_color)
+        if not writer.isOpened():
+            writer.release()
+            if os.path.exists(path):
+                os.remove(path)
+            return None, None
+        return writer, path
+
+    def _open_segment(self, data):
+        height, width = data.shape[:2]
+        is_color = data.ndim == 3
+        path_base = os.path.join(self.save_dir, f"xi_{self.segment:04d}")
+
+        candidates = ["FFV1", "MJPG"] if self.fourcc == "AUTO" else [self.fourcc]
+        for fourcc in candidates:
+            self.writer, self.segment_path = self._create_writer(
+                path_base, fourcc, (width, height), is_color
+            )
+            if self.writer is not None:
+                if self.fourcc == "AUTO":
+                    # stick to the first working codec for all following segments
+                    self.fourcc = fourcc
+                break
+            self.logger.warning(f"VideoWriter with {fourcc} not available.")
+
+        if self.writer is None:
+            raise RuntimeError("No usable VideoWriter codec.")
+
+        self.sidecar_file = open(path_base + ".csv", "w", newline="")
+        self.sidecar = csv.writer(self.sidecar_file)
+        self.sidecar.writerow(["index", "frame_id", "camera_timestamp", "host_timestamp"])
+
+        self.segment_frames = 0
+        self.segment_start = time.time()
+        self.logger.info(f"Recording segment: {self.segment_path}")
+
+    def _close_segment(self):
+        if self.writer is not None:
+            self.writer.release()
+            self.writer = None
+        if self.sidecar_file is not None:
+            self.sidecar_file.close()
+            self.sidecar_file = None
+        self.segment += 1
+
+    def _segment_full(self):
+        if self.segment_seconds and time.time() - self.segment_start >= self.segment_seconds:
+            return True
+        # stat is cheap, but there is no need to do it on every frame
+        if self.segment_bytes and self.segment_frames % 30 == 0:
+            return os.path.getsize(self.segment_path) >= self.segment_bytes
+        return False
+
+    def write(self, image):
+        if self.writer is not None and self._segment_full():
+            self._close_segment()
+        if self.writer is None:
+            self._open_segment(image.data)
+
+        self.writer.write(image.data)
+
+        metadata = image.metadata
+        if metadata is not None:
+            self.sidecar.writerow(
+                [self.segment_frames, metadata.frame_id, metadata.timestamp, metadata.host_timestamp]
+            )
+        else:
+            self.sidecar.writerow([self.segment_frames, "", "", time.time()])
+        self.last_path = f"{os.path.basename(self.segment_path)}#{self.segment_frames}"
+        self.segment_frames += 1
+
+    def close(self):
+        self._close_segment()
@@ -1,9 +1,17 @@
 # ximea_camera.py
 
-from threading import Thread, Lock
+import time
+from threading import Thread, Lock, Condition
 from ximea import xiapi
 from collections import deque
 import logger_tools
+import metrics
+import camera_params
+
+FRAMES_ACQUIRED = metrics.counter("xicam_frames_acquired_total", "Frames read from the camera")
+DROPPED_CAPTURE = metrics.FRAMES_DROPPED.labels("capture_failed")
+DROPPED_BUFFER = metrics.FRAMES_DROPPED.labels("buffer_overflow")
+
 
 class Image:
     """
@@ -22,11 +30,13 @@ class Metadata:
     def __init__(self):
         self.frame_id = 0
         self.timestamp = 0
+        self.host_timestamp = 0
         self.gain = -1
         self.exposure = 0
         self.width = 0
         self.height = 0
         self.img_format = ""
+        self.gpi_level = 0
 
 
 class CaptureThread(Thread):
@@ -41,17 +51,36 @@ class CaptureThread(Thread):
         self.logger.debug(f"CaptureThread Started. Running until stop event is set.")
         self.logger.debug(f"Image buffer size is {self.cam.buffer_size}.")
         self.logger.debug(f"Trigger type is {self.cam.get_xicam_instance().get_trigger_source()}.")
+        self.cam.fps_meter.reset()
 
         while self.cam.stop_event.wait(0) is not True:
             # self.logger.debug(f"CaptureThread running. ")
 
-            image = self.cam.get_image_from_device()
+            # parameter changes that need an acquisition pause hold the lock meanwhile
+            with self.cam.device_lock:
+                image = self.cam.get_image_from_device()
             
-            if image.data is not None:
-                with self.cam.buffer_lock:
+            if image is not None and image.data is not None:
+                FRAMES_ACQUIRED.inc()
+                self.cam.fps_meter.tick()
+                with self.cam.frame_ready:
+                    if len(self.cam.image_buffer) == self.cam.buffer_size:
+                        # the oldest frame was never picked up
+                        DROPPED_BUFFER.inc()
                     self.cam.image_buffer.append(image)
+                    self.cam.frame_ready.notify_all()
+                self.cam.latest_image = image
+                if self.cam.ring_recorder is not None:
+                    try:
+                        self.cam.ring_recorder.add(image)
+                    except Exception as e:
+                        # capture goes on without the ring, e.g. out of memory for its buffer
+                        self.logger.error(f"Ring recorder failed: {e!r}")
+                if self.cam.params.watching:
+                    self.cam.params.check_frame(image.metadata)
                 # self.logger.debug(f"CaptureThread: image acquired with {self.data.shape} and added to buffer.")
             else:
+                DROPPED_CAPTURE.inc()
                 self.logger.warning("No image available, skipping frame.")
         
         self.logger.debug("CaptureThread finished. Exiting with stop event.")
@@ -69,6 +98,15 @@ class XimeaCamera:
         self.buffer_size = image_buffer_size
         self.image_buffer = deque(maxlen=self.buffer_size)
         self.buffer_lock = Lock()
+        # signalled by the capture thread for every new frame in the buffer
+        self.frame_ready = Condition(self.buffer_lock)
+        self.ring_recorder = None
+        self.read_gpi = False
+        # newest full resolution frame, only a reference, the capture thread never copies it
+        self.latest_image = None
+        self.fps_meter = metrics.RateMeter()
+        self.device_lock = Lock()
+        self.params = camera_params.CameraParameters(self)
         self.logger = logger_tools.get_logger(self.__class__.__name__)
 
     def get_xicam_instance(self):
@@ -83,6 +121,8 @@ class XimeaCamera:
         """Close the camera."""
         self.logger.info("Closing camera...")
         self.cam.close_device()
+        # limits may differ with the next camera or data format
+        self.params.clear_cache()
 
     def start_acquisition(self):
         """Start data acquisition."""
@@ -108,28 +148,34 @@ class XimeaCamera:
     def stop_capture_thread(self):
         """Stop the thread to capture images from the camera."""
         self.logger.info("Stopping capture thread...")
-        self.capture_thread.stop()
+        if self.stop_event is not None:
+            self.stop_event.set()
         self.capture_thread.join()
 
-    def get_image_from_buffer(self):
+    def get_image_from_buffer(self, timeout=0):
         """
         Get a single Image object from the image buffer.
-        returns: Image object
+        timeout: seconds to wait for a frame if the buffer is empty
+        returns: Image object, None if there is none
         """
-        with self.buffer_lock:
+        with self.frame_ready:
+            if timeout and len(self.image_buffer) == 0:
+                self.frame_ready.wait_for(lambda: len(self.image_buffer) > 0, timeout)
             if len(self.image_buffer) > 0:
                 image = self.image_buffer.popleft()
                 return image
             else:
-                self.logger.warning("Image buffer is empty.")
+                # normal between frames, consumers ask faster than the camera delivers
+                self.logger.debug("Image buffer is empty.")
                 return None
 
-    def get_metadata_from_frame(image):
+    def get_metadata_from_frame(self, image):
         """Get a single image as numpy array with metadata for a the image."""
 
         metadata = Metadata()
         metadata.frame_id = image.acq_nframe
         metadata.timestamp = image.tsSec + image.tsUSec / 1e6
+        metadata.host_timestamp = time.time()
         metadata.exposure = image.exposure_time_us
         metadata.gain = image.gain_db
         metadata.width = image.width
@@ -159,6 +205,8 @@ class XimeaCamera:
                 metadata = None
             else:
                 metadata = self.get_metadata_from_frame(self.img)
+                if self.read_gpi:
+                    metadata.gpi_level = self.cam.get_gpi_level_at_image_exp_start()
                 
             return Image(image_data, metadata)
         